@@ -2,6 +2,7 @@ import tkinter as tk
 from tkinter import ttk, messagebox
 import requests
 import io
+import threading
 from PIL import Image, ImageTk
 from datetime import datetime
 import pytz
@@ -9,11 +10,33 @@ import pytz
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-
 TZ = pytz.timezone("Asia/Ho_Chi_Minh")
 HEADERS = {"Authorization": "Bearer secret-key"}
+PAGE_SIZE = 200
+REPORT_POLL_MAX = 120   # poll báo cáo tối đa ~2 phút
+
+
+# =====================================================================
+#  /transactions: PHÂN TRANG + LỌC PHÍA CLOUD
+# =====================================================================
+def fetch_transactions_page(api, cursor=None, limit=PAGE_SIZE, **filters):
+    """1 trang giao dịch -> (list, next_cursor). filters: gate, plate, date_from, date_to, status."""
+    params = {k: v for k, v in filters.items() if v and v != "ALL"}
+    params["limit"] = limit
+    if cursor:
+        params["cursor"] = cursor
+
+    r = requests.get(api + "/transactions", params=params, headers=HEADERS)
+    j = r.json()
+    return j["transactions"], j.get("next_cursor")
+
+
+def fetch_stats(api, group_by="day", **filters):
+    """/stats: tổng hợp phía cloud -> {"totals": {...}, "series": [...]}."""
+    params = {k: v for k, v in filters.items() if v and v != "ALL"}
+    params["group_by"] = group_by
+    r = requests.get(api + "/stats", params=params, headers=HEADERS)
+    return r.json()
 
 
 # =====================================================================
@@ -215,25 +238,41 @@ class AdminUI:
 
         self.history_table.pack(fill="both", expand=True)
 
-        tk.Button(f, text="🔄 Refresh",
-                  command=self.load_history).pack(pady=10)
+        btns = tk.Frame(f)
+        btns.pack(pady=10)
+
+        tk.Button(btns, text="🔄 Refresh",
+                  command=self.load_history).pack(side="left", padx=5)
+
+        self.more_btn = tk.Button(btns, text="⬇ Tải thêm",
+                                  command=self.load_more_history)
+        self.more_btn.pack(side="left", padx=5)
 
         self.history_table.bind("<Double-1>", self.open_detail)
 
+        self.history_rows = {}      # item id -> transaction (để mở chi tiết không cần tải lại)
+        self.history_cursor = None
+
         self.load_history()
 
     def load_history(self):
-        try:
-            r = requests.get(self.api + "/transactions", headers=HEADERS)
-            txs = r.json()["transactions"]
+        self.history_table.delete(*self.history_table.get_children())
+        self.history_rows.clear()
+        self.history_cursor = None
+        self.load_more_history()
 
-            self.history_table.delete(*self.history_table.get_children())
+    def load_more_history(self):
+        try:
+            txs, self.history_cursor = fetch_transactions_page(self.api, self.history_cursor)
 
             for t in txs:
                 time_show = t["time_out"] or t["time_in"]
                 typ = "OUT" if t["time_out"] else "IN"
-                self.history_table.insert("", "end",
-                                          values=(time_show, t["plate"], t["slotid"], t["gateid"], typ))
+                item = self.history_table.insert("", "end",
+                                                 values=(time_show, t["plate"], t["slotid"], t["gateid"], typ))
+                self.history_rows[item] = t
+
+            self.more_btn.config(state="normal" if self.history_cursor else "disabled")
         except Exception as e:
             messagebox.showerror("Lỗi", str(e))
 
@@ -242,18 +281,7 @@ class AdminUI:
         if not sel:
             return
 
-        row = self.history_table.item(sel, "values")
-        time_click, plate, slot, gate, _ = row
-
-        r = requests.get(self.api + "/transactions", headers=HEADERS)
-        txs = r.json()["transactions"]
-
-        tx = next((
-            x for x in txs
-            if x["plate"] == plate and
-            (x["time_in"] == time_click or x["time_out"] == time_click)
-        ), None)
-
+        tx = self.history_rows.get(sel)
 
         if not tx:
             messagebox.showerror("Lỗi", "Không tìm thấy giao dịch")
@@ -316,6 +344,9 @@ class AdminUI:
         tk.Button(filter_frame, text="📄 Xuất PDF",
                   command=self.export_pdf).grid(row=0, column=7)
 
+        tk.Button(filter_frame, text="📥 Xuất CSV",
+                  command=self.export_csv).grid(row=0, column=8, padx=10)
+
         self.stats_container = tk.Frame(f, bg="#ecf0f1")
         self.stats_container.pack(fill="both", expand=True)
 
@@ -340,10 +371,15 @@ class AdminUI:
         for w in self.stats_container.winfo_children():
             w.destroy()
 
+        gate = self.gate_filter.get()
+        sd = self.start_date.get().strip()
+        ed = self.end_date.get().strip()
+
         try:
-            r = requests.get(self.api + "/transactions", headers=HEADERS)
-            txs = r.json()["transactions"]
-            if not txs:
+            # Cloud tự GROUP BY theo ngày, chỉ trả về tổng + series
+            st = fetch_stats(self.api, group_by="day", gate=gate, date_from=sd, date_to=ed)
+            totals, series = st["totals"], st["series"]
+            if not series:
                 tk.Label(
                     self.stats_container,
                     text="❗ Không có dữ liệu thống kê",
@@ -357,35 +393,9 @@ class AdminUI:
             tk.Label(self.stats_container, text=f"Lỗi tải dữ liệu: {e}", fg="red").pack()
             return
 
-        gate = self.gate_filter.get()
-        sd = self.start_date.get().strip()
-        ed = self.end_date.get().strip()
-
-        def valid_time(tx):
-            # ⚠️ CHỈ DÙNG time_in để thống kê
-            t = parse_time(tx["time_in"])
-            if not t:
-                return False
-
-            try:
-                if sd and t.date() < datetime.fromisoformat(sd).date():
-                    return False
-                if ed and t.date() > datetime.fromisoformat(ed).date():
-                    return False
-            except:
-                pass
-
-            return True
-
-
-        if gate != "ALL":
-            txs = [t for t in txs if t["gateid"] == gate]
-
-        txs = [t for t in txs if valid_time(t)]
-
-        total = len(txs)
-        total_out = sum(1 for t in txs if t["time_out"])
-        revenue = sum((t["fee"] or 0) for t in txs)
+        total = totals["entries"]
+        total_out = totals["exits"]
+        revenue = totals["revenue"]
 
         stats_frame = tk.Frame(self.stats_container, bg="#ecf0f1")
         stats_frame.pack(pady=10)
@@ -401,23 +411,21 @@ class AdminUI:
         stat("Xe rời bãi", total_out)
         stat("Doanh thu", f"{revenue:,} VND")
 
-        self.draw_chart(self.stats_container, txs)
+        self.draw_chart(self.stats_container, series)
 
     # =================================================================
     # DRAW CHART
     # =================================================================
-    def draw_chart(self, parent, txs):
+    def draw_chart(self, parent, series):
         for w in parent.winfo_children():
             if isinstance(w, FigureCanvasTkAgg):
                 w.get_tk_widget().destroy()
 
-        day_count = {}
-        for t in txs:
-            dt = parse_time(t["time_in"])
-            if not dt:
-                continue
-            d = dt.date()
-            day_count[d] = day_count.get(d, 0) + 1
+        # series /stats?group_by=day: [{"key": "YYYY-MM-DD", "entries": n, ...}]
+        day_count = {
+            datetime.fromisoformat(s["key"]).date(): s["entries"]
+            for s in series if s["entries"]
+        }
 
         if not day_count:
             tk.Label(
@@ -445,67 +453,102 @@ class AdminUI:
 
 
     # =================================================================
-    # EXPORT PDF
+    # EXPORT PDF (CLOUD TẠO FILE CHẠY NỀN, UI CHỈ POLL + TẢI VỀ)
     # =================================================================
     def export_pdf(self):
         filename = "parking_report.pdf"
 
         try:
-            c = canvas.Canvas(filename, pagesize=A4)
-            w, h = A4
-
-            gate = self.gate_filter.get()
-            sd = self.start_date.get()
-            ed = self.end_date.get()
-
-            c.setFont("Helvetica-Bold", 20)
-            c.drawString(40, h - 50, "BAO CAO THONG KE BAI DO XE")
-
-            c.setFont("Helvetica", 12)
-            c.drawString(40, h - 80, f"Gate: {gate}")
-            c.drawString(200, h - 80, f"TU: {sd or '---'}")
-            c.drawString(350, h - 80, f"DEN: {ed or '---'}")
-
-            # Load tất cả giao dịch
-            r = requests.get(self.api + "/transactions", headers=HEADERS)
-            txs = r.json()["transactions"]
+            r = requests.post(self.api + "/reports", json={
+                "gate": self.gate_filter.get(),
+                "date_from": self.start_date.get().strip() or None,
+                "date_to": self.end_date.get().strip() or None,
+            }, headers=HEADERS, timeout=5)
+            job = r.json()
+            if not job.get("ok"):
+                raise Exception(job.get("detail") or job.get("error") or r.text)
+        except Exception as e:
+            messagebox.showerror("Lỗi PDF", str(e))
+            return
 
-            # Lọc
-            if gate != "ALL":
-                txs = [t for t in txs if t["gateid"] == gate]
+        self.poll_report(job["job_id"], filename)
 
-            if sd:
-                txs = [t for t in txs
-                       if parse_time(t["time_out"] or t["time_in"]).date() >= datetime.fromisoformat(sd).date()]
+    def poll_report(self, job_id, filename, tries=0):
+        # GET status chạy nền (giống download_report): mạng chậm không làm đứng giao diện
+        def worker():
+            try:
+                r = requests.get(f"{self.api}/reports/{job_id}", headers=HEADERS, timeout=5)
+                job, err = r.json(), None
+            except Exception as e:
+                job, err = None, e
+            self.win.after(0, lambda: self.on_report_status(job_id, filename, tries, job, err))
 
-            if ed:
-                txs = [t for t in txs
-                       if parse_time(t["time_out"] or t["time_in"]).date() <= datetime.fromisoformat(ed).date()]
+        threading.Thread(target=worker, daemon=True).start()
 
-            revenue = sum((t["fee"] or 0) for t in txs)
+    def on_report_status(self, job_id, filename, tries, job, err):
+        try:
+            if err:
+                raise err
+            status = job.get("status")
 
-            # Tổng quan báo cáo
-            c.setFont("Helvetica-Bold", 14)
-            c.drawString(40, h - 110,
-                         f"➤ TONG: {len(txs)} giao dịch   |   Doanh thu: {revenue:,} VND")
+            if status == "done":
+                threading.Thread(target=self.download_report,
+                                 args=(job_id, filename), daemon=True).start()
+                return
+            if status == "failed":
+                raise Exception(job.get("error") or "Report failed")
+            if tries >= REPORT_POLL_MAX:
+                raise Exception("Quá thời gian chờ báo cáo")
 
-            y = h - 140
-            c.setFont("Helvetica", 11)
+        except Exception as e:
+            messagebox.showerror("Lỗi PDF", str(e))
+            return
 
-            for t in txs:
-                line = f"{fmt(parse_time(t['time_in']))} | {t['plate']} | Slot {t['slotid']} | Fee: {t['fee'] or 0:,} VND"
-                c.drawString(40, y, line)
-                y -= 18
+        self.win.after(1000, lambda: self.poll_report(job_id, filename, tries + 1))
 
-                if y < 40:
-                    c.showPage()
-                    y = h - 60
+    def download_report(self, job_id, filename):
+        try:
+            with requests.get(f"{self.api}/reports/{job_id}/file",
+                              headers=HEADERS, stream=True, timeout=(5, 60)) as r:
+                if r.status_code != 200:
+                    raise Exception(r.text)
+                with open(filename, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+            self.win.after(0, lambda: messagebox.showinfo("OK", f"Đã xuất báo cáo: {filename}"))
+        except Exception as e:
+            self.win.after(0, lambda e=e: messagebox.showerror("Lỗi PDF", str(e)))
 
-            c.save()
-            messagebox.showinfo("OK", f"Đã xuất báo cáo: {filename}")
+    # =================================================================
+    # EXPORT CSV (STREAM TỪ CLOUD, GHI THẲNG RA FILE)
+    # =================================================================
+    def export_csv(self):
+        filename = "parking_transactions.csv"
+        params = {
+            k: v for k, v in {
+                "format": "csv",
+                "gate": self.gate_filter.get(),
+                "date_from": self.start_date.get().strip(),
+                "date_to": self.end_date.get().strip(),
+            }.items() if v and v != "ALL"
+        }
+
+        def worker():
+            try:
+                with requests.get(self.api + "/transactions/export", params=params,
+                                  headers=HEADERS, stream=True, timeout=(5, 60)) as r:
+                    if r.status_code != 200:
+                        raise Exception(r.text)
+                    with open(filename, "wb") as f:
+                        for chunk in r.iter_content(chunk_size=64 * 1024):
+                            f.write(chunk)
+                self.win.after(0, lambda: messagebox.showinfo("OK", f"Đã xuất: {filename}"))
+            except Exception as e:
+                self.win.after(0, lambda e=e: messagebox.showerror("Lỗi CSV", str(e)))
+
+        # chạy nền: file lớn không làm đứng giao diện
+        threading.Thread(target=worker, daemon=True).start()
 
-        except Exception as e:
-            messagebox.showerror("Lỗi PDF", str(e))
 
 class SlotManagerUI:
     def __init__(self, parent, api):
@@ -10,6 +10,7 @@
 import os
 import json
 import time
+import hashlib
 import uuid
 import sqlite3
 import asyncio
@@ -55,6 +56,13 @@ if not CLOUD_API:
 
 CLOUD_API = CLOUD_API or DEFAULT_CLOUD
 
+# số event tối đa mỗi lần xả offline queue lên /events/batch
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "100"))
+
+# đồng bộ slot: delta (/slots/changes) mỗi vòng; tải full /slots/map định kỳ chỉ là lưới an toàn
+# (slots_local bị sửa / hỏng), feed delta tự nó không bỏ sót thay đổi
+SLOT_FULL_RESYNC_SEC = int(os.getenv("SLOT_FULL_RESYNC_SEC", "300"))
+
 # local image storage
 LOCAL_IMG_DIR = os.path.join(BASE_DIR, "local_images")
 LOCAL_IN_DIR = os.path.join(LOCAL_IMG_DIR, "in")
@@ -120,8 +128,12 @@ def init_db() -> None:
             created_at TEXT NOT NULL
         )
     """)
+    # DB cũ chưa có cột last_error (lý do Cloud từ chối event)
+    try:
+        cur.execute("ALTER TABLE local_event_queue ADD COLUMN last_error TEXT")
+    except sqlite3.OperationalError:
+        pass
 
-    
     conn.commit()
     conn.close()
 
@@ -196,6 +208,25 @@ def upsert_slots_from_cloud(slots: List[Dict[str, Any]]) -> None:
     set_state("last_cloud_ok_at", ts)
 
 
+def delete_slots_local(slotids: List[str]) -> None:
+    """Slot đã bị xóa trên Cloud (tombstone trong /slots/changes)."""
+    if not slotids:
+        return
+    conn = _db()
+    cur = conn.cursor()
+    cur.executemany("DELETE FROM slots_local WHERE slotid=?", [(s,) for s in slotids])
+    conn.commit()
+    conn.close()
+
+
+def replace_slots_from_cloud(slots: List[Dict[str, Any]]) -> None:
+    """Full snapshot: upsert + xóa slot local không còn trên Cloud."""
+    upsert_slots_from_cloud(slots)
+    keep = {s.get("slotid") for s in slots}
+    stale = [r["slotid"] for r in list_slots_local() if r["slotid"] not in keep]
+    delete_slots_local(stale)
+
+
 def list_slots_local() -> List[Dict[str, Any]]:
     conn = _db()
     cur = conn.cursor()
@@ -255,6 +286,16 @@ def mark_event_done(event_id: str) -> None:
     conn.close()
 
 
+def mark_event_rejected(event_id: str, reason: str) -> None:
+    """Cloud từ chối vĩnh viễn (slot đã có xe, xe không có trong bãi...) -> không gửi lại."""
+    conn = _db()
+    cur = conn.cursor()
+    cur.execute("UPDATE local_event_queue SET status='rejected', last_error=? WHERE event_id=?",
+                (reason, event_id))
+    conn.commit()
+    conn.close()
+
+
 def get_pending_events(limit: int = 50) -> List[Dict[str, Any]]:
     conn = _db()
     cur = conn.cursor()
@@ -288,20 +329,51 @@ def cloud_health_ok(timeout: float = 1.5) -> bool:
         return False
 
 
-def cloud_upload_image(endpoint: str, local_path: str, plate: str, gate: str) -> Optional[str]:
-    """Upload ảnh local lên Cloud, trả về cloud path nếu ok."""
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def cloud_image_exists(sha: str) -> Optional[str]:
+    """Cloud đã có ảnh này (theo SHA-256)? Trả về cloud path, None nếu chưa / Cloud cũ không hỗ trợ."""
     try:
-        with open(local_path, "rb") as f:
-            files = {"file": (os.path.basename(local_path), f.read(), "image/jpeg")}
-        data = {"plate": plate, "gate": gate}
         r = requests.post(
-            f"{CLOUD_API}{endpoint}",
-            files=files,
-            data=data,
+            f"{CLOUD_API}/upload_image/check",
+            json={"sha256": sha},
             headers={"Authorization": f"Bearer {SECRET}"},
-            timeout=10
+            timeout=5
         )
         j = r.json()
+        if r.status_code == 200 and j.get("exists") and j.get("path"):
+            return j["path"]
+    except Exception:
+        pass
+    return None
+
+
+def cloud_upload_image(endpoint: str, local_path: str, plate: str, gate: str) -> Optional[str]:
+    """
+    Upload ảnh local lên Cloud, trả về cloud path nếu ok.
+    Hỏi hash trước: replay cùng ảnh thì Cloud đã có -> không gửi lại byte nào.
+    """
+    try:
+        sha = file_sha256(local_path)
+        cloud_path = cloud_image_exists(sha)
+        if cloud_path:
+            return cloud_path
+
+        with open(local_path, "rb") as f:
+            r = requests.post(
+                f"{CLOUD_API}{endpoint}",
+                files={"file": (os.path.basename(local_path), f, "image/jpeg")},
+                data={"plate": plate, "gate": gate, "sha256": sha},
+                headers={"Authorization": f"Bearer {SECRET}"},
+                timeout=10
+            )
+        j = r.json()
         if j.get("ok") and j.get("path"):
             return j["path"]
     except Exception:
@@ -633,93 +705,130 @@ def health():
 # ==========================================================
 # BACKGROUND WORKERS (SYNC SNAPSHOT + SYNC QUEUE)
 # ==========================================================
+def sync_slot_changes(since: int) -> bool:
+    """
+    Áp dụng delta từ /slots/changes (chỉ slot thay đổi sau `since`).
+    Return False nếu Cloud yêu cầu resync (phải tải full /slots/map).
+    """
+    while True:
+        r = requests.get(f"{CLOUD_API}/slots/changes", params={"since": since}, timeout=5)
+        j = r.json()
+        if j.get("resync"):
+            return False
+
+        if j["changes"]:
+            upsert_slots_from_cloud(j["changes"])
+        else:
+            set_state("last_cloud_ok_at", now_iso())
+        delete_slots_local(j["deleted"])
+
+        if j["seq"] != since:
+            since = j["seq"]
+            set_state("slot_change_seq", str(since))
+        if not j.get("more"):
+            return True
+
+
+def sync_slot_snapshot(etag: Optional[str]) -> Optional[str]:
+    """Tải full /slots/map (If-None-Match). Trả về ETag mới."""
+    headers = {"If-None-Match": etag} if etag else {}
+    r = requests.get(f"{CLOUD_API}/slots/map", headers=headers, timeout=5)
+    # head seq của snapshot (tính cả slot bị xóa / tombstone đã prune), có cả khi 304
+    seq = r.headers.get("X-Slot-Seq")
+    if r.status_code == 304:
+        set_state("last_cloud_ok_at", now_iso())
+        if seq is not None:
+            set_state("slot_change_seq", seq)
+        return etag
+
+    data = r.json()
+    slots = data["slots"]
+    replace_slots_from_cloud(slots)
+    if seq is None:
+        # Cloud cũ chưa gửi head seq: max change_seq trong snapshot
+        seq = data.get("seq", max((int(s.get("change_seq") or 0) for s in slots), default=0))
+    set_state("slot_change_seq", str(seq))
+    return r.headers.get("ETag")
+
+
 async def worker_sync_cloud_snapshot():
     """
     Nếu Cloud ON:
-      - kéo /slots/map từ Cloud
-      - upsert vào slots_local
+      - lần đầu / mỗi SLOT_FULL_RESYNC_SEC: kéo full /slots/map (ETag, 304 nếu không đổi)
+      - còn lại: chỉ kéo delta /slots/changes?since=<seq> rồi áp vào slots_local
     """
     await asyncio.sleep(2)
+    etag = None   # ETag lần tải full gần nhất
+    last_full = 0.0
     while True:
         try:
             if cloud_health_ok():
-                r = requests.get(f"{CLOUD_API}/slots/map", timeout=5)
-                j = r.json()
-                if isinstance(j, dict) and "slots" in j:
-                    upsert_slots_from_cloud(j["slots"])
+                seq = get_state("slot_change_seq")
+                full = seq is None or time.monotonic() - last_full > SLOT_FULL_RESYNC_SEC
+                if not full:
+                    full = not sync_slot_changes(int(seq))
+                if full:
+                    etag = sync_slot_snapshot(etag)
+                    last_full = time.monotonic()
         except Exception:
-            pass
+            etag = None
 
         await asyncio.sleep(3)  # bạn chỉnh 2-5s tùy demo
 
 
+def upload_local_image(p: Dict[str, Any], key: str, endpoint: str) -> None:
+    """Ảnh chụp lúc Cloud OFF ("local:<path>") -> upload, thay bằng cloud path."""
+    img = p.get(key)
+    if isinstance(img, str) and img.startswith("local:"):
+        local_path = img.replace("local:", "", 1)
+        cloud_path = cloud_upload_image(endpoint, local_path, p.get("plate"), p.get("gate") or GATE_ID)
+        if cloud_path:
+            p[key] = cloud_path
+
+
 async def worker_sync_event_queue():
     """
-    Nếu Cloud ON:
-      - lấy pending events
+    Nếu có pending events và Cloud ON:
       - upload ảnh local (nếu cần)
-      - gọi cloud /vehicle_in hoặc /vehicle_out
-      - done nếu ok
+      - gửi cả lô (theo thứ tự) lên cloud /events/batch kèm event_id (Cloud dedup)
+      - ok / dedup -> done; Cloud từ chối hẳn -> rejected; lỗi tạm thời -> giữ pending
+        cùng mọi event sau nó (giữ thứ tự: vehicle_out không được chạy trước vehicle_in đang chờ)
     """
     await asyncio.sleep(3)
     while True:
         try:
-            if not cloud_health_ok():
+            pending = get_pending_events(limit=EVENT_BATCH_SIZE)
+            if not pending or not cloud_health_ok():
                 await asyncio.sleep(2)
                 continue
 
-            pending = get_pending_events(limit=50)
+            batch = []
             for item in pending:
-                event_id = item["event_id"]
-                et = item["event_type"]
                 p = item["payload"]
-
-                if et == "vehicle_in":
-                    plate = p.get("plate")
-                    slot = p.get("slot")
-                    gate = p.get("gate") or GATE_ID
-                    img_in = p.get("img_in")
-
-                    # upload ảnh nếu local
-                    if isinstance(img_in, str) and img_in.startswith("local:"):
-                        local_path = img_in.replace("local:", "", 1)
-                        cloud_path = cloud_upload_image("/upload_image_in", local_path, plate, gate)
-                        if cloud_path:
-                            p["img_in"] = cloud_path
-
-                    res = cloud_post_json("/vehicle_in", {
-                        "plate": plate,
-                        "slot": slot,
-                        "gate": gate,
-                        "img_in": p.get("img_in")
-                    })
-                    if res.get("ok") is True:
-                        mark_event_done(event_id)
-
-                elif et == "vehicle_out":
-                    plate = p.get("plate")
-                    gate = p.get("gate") or GATE_ID
-                    img_out = p.get("img_out")
-
-                    if isinstance(img_out, str) and img_out.startswith("local:"):
-                        local_path = img_out.replace("local:", "", 1)
-                        cloud_path = cloud_upload_image("/upload_image_out", local_path, plate, gate)
-                        if cloud_path:
-                            p["img_out"] = cloud_path
-
-                    res = cloud_post_json("/vehicle_out", {
-                        "plate": plate,
-                        "gate": gate,
-                        "img_out": p.get("img_out")
-                    })
-                    if res.get("ok") is True:
-                        mark_event_done(event_id)
-
-                # best-effort WS replay (không bắt buộc)
-                try:
-                    await send_event({"type": "sync_event", "event": p})
-                except Exception:
-                    pass
+                p["gate"] = p.get("gate") or GATE_ID
+                if item["event_type"] == "vehicle_in":
+                    upload_local_image(p, "img_in", "/upload_image_in")
+                elif item["event_type"] == "vehicle_out":
+                    upload_local_image(p, "img_out", "/upload_image_out")
+                batch.append({**p, "type": item["event_type"], "event_id": item["event_id"]})
+
+            res = cloud_post_json("/events/batch", {"events": batch}, timeout=30)
+
+            progressed = 0
+            for out in res.get("results") or []:
+                if out.get("ok") is True:
+                    mark_event_done(out["event_id"])
+                    progressed += 1
+                elif out.get("code") in ("reserved", "deferred") or not 400 <= int(out.get("status") or 500) < 500:
+                    # reserved: gate khác giữ slot (TTL ngắn); deferred / 5xx -> dừng, lần sau gửi lại từ đây
+                    break
+                else:
+                    mark_event_rejected(out["event_id"], str(out.get("detail")))
+                    progressed += 1
+
+            # lô đầy và có tiến triển => còn event, xả tiếp ngay
+            if len(pending) == EVENT_BATCH_SIZE and progressed:
+                continue
 
         except Exception:
             pass
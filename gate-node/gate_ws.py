@@ -102,6 +102,13 @@ async def listen_loop(gateid: str):
                     pass
                 continue
 
+            # Cloud gom nhiều event gửi cùng lúc thành 1 frame "batch"
+            if data.get("type") == "batch":
+                for evt in data.get("events") or []:
+                    GUI_EVENT_QUEUE.put(evt)
+                print(f"[WS] Received batch: {len(data.get('events') or [])} events")
+                continue
+
             # Tất cả event Cloud gửi (khác pong) đều đưa vào queue để GUI xử lý
             GUI_EVENT_QUEUE.put(data)
 
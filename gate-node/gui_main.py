@@ -133,6 +133,7 @@ class GateMain(tk.Tk):
         self.local_cur = self.local_conn.cursor()
 
         self.slots = []
+        self.slots_etag = None   # ETag của /slots/map lần tải gần nhất
         self.slot_boxes = []
 
         # ✅ cache hover
@@ -230,17 +231,21 @@ class GateMain(tk.Tk):
     # ==========================================================
     def load_cloud(self):
         try:
-            r = requests.get(
-                f"{self.cloud}/slots/map",
-                headers={"Authorization": "Bearer secret-key"},
-                timeout=4
-            )
-            self.slots = r.json()["slots"]
-            self.save_local()
+            headers = {"Authorization": "Bearer secret-key"}
+            if self.slots_etag and self.slots:
+                headers["If-None-Match"] = self.slots_etag
+            r = requests.get(f"{self.cloud}/slots/map", headers=headers, timeout=4)
+
+            # 304: slot map không đổi -> giữ self.slots, khỏi ghi lại local
+            if r.status_code != 304:
+                self.slots = r.json()["slots"]
+                self.slots_etag = r.headers.get("ETag")
+                self.save_local()
 
             self.status.config(text="🟢 Cloud Online")
             self.cloud_label.config(text="Cloud: Online", fg=GREEN)
         except:
+            self.slots_etag = None
             self.load_local()
             self.status.config(text="🔴 Cloud Offline — Local Mode")
             self.cloud_label.config(text="Cloud: Offline", fg=RED)
@@ -535,12 +535,24 @@ class CameraPanel:
 
         # Best-effort reserve (cloud còn thì tránh tranh chấp)
         try:
-            requests.post(
+            rr = requests.post(
                 self.cloud_api + "/reserve_slot",
                 json={"gate": self.gate_id, "slot": slot, "ttl": 15},
                 headers=AUTH_HEADER,
                 timeout=2
             )
+            if rr.status_code == 409 and not self.slot_locked:
+                # slot gợi ý đã bị gate khác giữ -> cloud cấp slot trống gần nhất (đã giữ sẵn)
+                ra = requests.post(
+                    f"{self.cloud_api}/allocate_slot/{self.gate_id}",
+                    json={"ttl": 15},
+                    headers=AUTH_HEADER,
+                    timeout=2
+                )
+                new_slot = ra.json().get("slot") if ra.status_code == 200 else None
+                if new_slot:
+                    slot = new_slot
+                    self.slot_var.set(new_slot)
         except:
             pass
 
@@ -2,53 +2,162 @@ from fastapi import APIRouter, WebSocket, WebSocketDisconnect
 import json
 import os
 import time
-import psycopg2
+import asyncio
+
+import orjson
+
+from ws_relay import publish
+from heartbeats import HEARTBEATS
 
 ws_router = APIRouter()
-active_gates = {}   # gateid -> websocket
+active_gates = {}   # gateid -> GateConnection
 
-POSTGRES_DB   = os.getenv("POSTGRES_DB", "parking")
-POSTGRES_USER = os.getenv("POSTGRES_USER", "admin")
-POSTGRES_PASS = os.getenv("POSTGRES_PASSWORD", "admin")
-POSTGRES_HOST = os.getenv("POSTGRES_HOST", "postgres")
-POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
+# ======================================================
+# GỬI WS: MỖI GATE 1 HÀNG ĐỢI + 1 WRITER TASK
+# - broadcast serialize 1 lần, chỉ put_nowait vào hàng đợi từng gate
+#   => gate chậm / treo không làm chậm gate khác
+# - hàng đợi đầy (gate không đọc kịp):
+#     WS_SLOW_POLICY=drop_oldest  bỏ message cũ nhất, giữ message mới
+#     WS_SLOW_POLICY=disconnect   đóng kết nối, gate tự reconnect + tải lại slot map
+# ======================================================
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", "256"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+WS_SLOW_POLICY = os.getenv("WS_SLOW_POLICY", "drop_oldest")
 
-def _update_gate_last_sync(gateid: str):
-    try:
-        conn = psycopg2.connect(
-            dbname=POSTGRES_DB,
-            user=POSTGRES_USER,
-            password=POSTGRES_PASS,
-            host=POSTGRES_HOST,
-            port=POSTGRES_PORT,
-        )
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE gates
-            SET last_sync = (SELECT NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh')
-            WHERE gateid=%s
-        """, (gateid,))
-        conn.commit()
-        cur.close()
-        conn.close()
-    except:
-        pass
+_loop = None   # event loop của server (nơi chạy writer task)
+WS_STATS = {"connected": 0, "disconnected": 0, "slow_disconnects": 0, "send_errors": 0}
 
-async def broadcast_all(message: dict):
-    dead = []
-    for gid, ws in active_gates.items():
+
+class GateConnection:
+    def __init__(self, gateid: str, ws: WebSocket):
+        self.gateid = gateid
+        self.ws = ws
+        self.queue = asyncio.Queue(maxsize=WS_SEND_QUEUE)
+        self.closed = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.send_total = 0.0
+        self.send_max = 0.0
+
+        self.task = asyncio.create_task(self._writer())
+
+    def offer(self, text: str) -> None:
+        """Không block. Chỉ gọi trên _loop."""
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(text)
+            return
+        except asyncio.QueueFull:
+            pass
+
+        if WS_SLOW_POLICY == "disconnect":
+            WS_STATS["slow_disconnects"] += 1
+            self.close()
+            return
+
+        try:
+            self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        self.dropped += 1
+        self.queue.put_nowait(text)
+
+    async def _writer(self):
+        while True:
+            text = await self.queue.get()
+            t0 = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.ws.send_text(text), WS_SEND_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                WS_STATS["send_errors"] += 1
+                self.close()
+                return
+
+            took = time.perf_counter() - t0
+            self.sent += 1
+            self.send_total += took
+            self.send_max = max(self.send_max, took)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if active_gates.get(self.gateid) is self:
+            active_gates.pop(self.gateid, None)
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        asyncio.ensure_future(self._close_ws())
+
+    async def _close_ws(self):
         try:
-            await ws.send_text(json.dumps(message))
-        except:
-            dead.append(gid)
+            await self.ws.close()
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "send_avg_ms": round(self.send_total / self.sent * 1000, 3) if self.sent else 0.0,
+            "send_max_ms": round(self.send_max * 1000, 3),
+        }
+
+
+def ws_stats() -> dict:
+    return {
+        **WS_STATS,
+        "active": len(active_gates),
+        "policy": WS_SLOW_POLICY,
+        "queue_max": WS_SEND_QUEUE,
+        "gates": {gid: c.stats() for gid, c in list(active_gates.items())},
+    }
+
+
+def _offer_all(text: str):
+    for conn in list(active_gates.values()):
+        conn.offer(text)
+
 
-    for gid in dead:
-        active_gates.pop(gid, None)
+def broadcast_text(text: str):
+    """Gửi message đã serialize cho mọi gate; gọi được từ thread bất kỳ."""
+    if _loop is None or not active_gates:
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+
+    if running is _loop:
+        _offer_all(text)
+    else:
+        _loop.call_soon_threadsafe(_offer_all, text)
+
+
+async def fanout(message: dict):
+    """Gate nối tới worker này + worker khác (Redis relay)."""
+    await broadcast_all(message)
+    await publish(message)
+
+async def broadcast_all(message: dict):
+    broadcast_text(orjson.dumps(message).decode())
 
 @ws_router.websocket("/ws/gate/{gateid}")
 async def ws_gate(websocket: WebSocket, gateid: str):
+    global _loop
     await websocket.accept()
-    active_gates[gateid] = websocket
+    _loop = asyncio.get_running_loop()
+
+    old = active_gates.get(gateid)
+    conn = GateConnection(gateid, websocket)
+    active_gates[gateid] = conn
+    if old:
+        old.close()   # gate reconnect: bỏ kết nối cũ
+    WS_STATS["connected"] += 1
     print(f"[WS] Gate {gateid} connected")
 
     try:
@@ -58,30 +167,33 @@ async def ws_gate(websocket: WebSocket, gateid: str):
             et = data.get("type")
 
             if et == "heartbeat":
-                _update_gate_last_sync(gateid)
-                await broadcast_all({"type": "heartbeat", "gate": gateid})
+                # 1 lệnh Redis (TTL), last_sync ghi DB theo lô (heartbeats.py); chỉ trả lời gate gửi
+                await HEARTBEATS.abeat(gateid)
+                conn.offer(orjson.dumps({"type": "heartbeat", "gate": gateid}).decode())
                 continue
 
             if et == "ping":
-                await websocket.send_text(json.dumps({
+                # qua hàng đợi luôn: không ghi song song với writer task
+                conn.offer(orjson.dumps({
                     "type": "pong",
                     "gate": gateid,
                     "ts": data.get("ts"),
                     "server_ts": int(time.time() * 1000),
-                }))
+                }).decode())
                 continue
 
             if et == "sync_event":
                 evt = data.get("event")
                 if evt:
-                    await broadcast_all(evt)
+                    await fanout(evt)
                 continue
 
             print(f"[WS] Unknown event from {gateid}:", data)
 
     except WebSocketDisconnect:
         print(f"[WS] Gate {gateid} disconnected")
-        active_gates.pop(gateid, None)
     except Exception as e:
         print(f"[WS] Error gate {gateid}:", e)
-        active_gates.pop(gateid, None)
+    finally:
+        WS_STATS["disconnected"] += 1
+        conn.close()
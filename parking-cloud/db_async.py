@@ -0,0 +1,72 @@
+# db_async.py — ASYNC DATABASE LAYER (asyncpg)
+# ==========================================================
+# - Endpoint nóng (vehicle_in/out, /fee, /slots/map, /transactions)
+#   chạy `async def` trên event loop, không chiếm threadpool của FastAPI
+# - Pool mở lúc startup, đóng lúc shutdown (gates_api.py)
+# - Cùng cấu hình Postgres với db_pool.py
+# ==========================================================
+
+import os
+import json
+
+import asyncpg
+
+from db_pool import POSTGRES_DB, POSTGRES_USER, POSTGRES_PASS, POSTGRES_HOST, POSTGRES_PORT
+
+ASYNC_DB_POOL_MIN = int(os.getenv("ASYNC_DB_POOL_MIN", "2"))
+ASYNC_DB_POOL_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", "20"))
+ASYNC_DB_TIMEOUT = float(os.getenv("ASYNC_DB_TIMEOUT", "5"))
+
+_apool: asyncpg.Pool | None = None
+
+
+async def _init_conn(conn: asyncpg.Connection):
+    # json/jsonb trả về dict thay vì str
+    for typ in ("json", "jsonb"):
+        await conn.set_type_codec(
+            typ, encoder=json.dumps, decoder=json.loads, schema="pg_catalog"
+        )
+
+
+async def init_async_pool() -> asyncpg.Pool:
+    global _apool
+    if _apool is None:
+        _apool = await asyncpg.create_pool(
+            database=POSTGRES_DB,
+            user=POSTGRES_USER,
+            password=POSTGRES_PASS,
+            host=POSTGRES_HOST,
+            port=POSTGRES_PORT,
+            min_size=ASYNC_DB_POOL_MIN,
+            max_size=ASYNC_DB_POOL_MAX,
+            timeout=ASYNC_DB_TIMEOUT,
+            init=_init_conn,
+        )
+    return _apool
+
+
+async def close_async_pool() -> None:
+    global _apool
+    if _apool is not None:
+        await _apool.close()
+        _apool = None
+
+
+def apool() -> asyncpg.Pool:
+    if _apool is None:
+        raise RuntimeError("async DB pool chưa khởi tạo (startup chưa chạy)")
+    return _apool
+
+
+def async_pool_stats() -> dict:
+    if _apool is None:
+        return {"ready": False}
+    size = _apool.get_size()
+    idle = _apool.get_idle_size()
+    return {
+        "ready": True,
+        "max_size": _apool.get_max_size(),
+        "size": size,
+        "in_use": size - idle,
+        "saturation": round((size - idle) / _apool.get_max_size(), 3),
+    }
@@ -0,0 +1,178 @@
+# db_pool.py — CONNECTION POOL DÙNG CHUNG CHO CLOUD
+# ==========================================================
+# - Giới hạn số connection Postgres (DB_POOL_MAX) cho cả process
+# - Mượn / trả connection theo từng request: `with db_conn() as conn:`
+# - Health-check khi mượn (connection chết thì bỏ, lấy cái mới)
+# - Thống kê thời gian chờ + độ bão hòa pool để chỉnh size khi tải cao
+# ==========================================================
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg2.extras import RealDictCursor
+
+POSTGRES_DB   = os.getenv("POSTGRES_DB", "parking")
+POSTGRES_USER = os.getenv("POSTGRES_USER", "admin")
+POSTGRES_PASS = os.getenv("POSTGRES_PASSWORD", "admin")
+POSTGRES_HOST = os.getenv("POSTGRES_HOST", "postgres")
+POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))          # giây chờ tối đa khi pool đầy
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))   # idle quá N giây thì SELECT 1 trước khi dùng
+
+
+class PoolTimeout(Exception):
+    """Hết connection trong pool sau DB_POOL_TIMEOUT giây."""
+
+
+class DBPool:
+    def __init__(self, minconn: int, maxconn: int, timeout: float, ping_after: float, **dsn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self._dsn = dsn
+
+        self._pool = None
+        self._init_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)   # giới hạn checkout đồng thời
+        self._stats_lock = threading.Lock()
+        self._last_used = {}    # id(conn) -> monotonic lúc trả về pool
+
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._broken = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _get_pool(self) -> pg_pool.ThreadedConnectionPool:
+        # tạo lazy: import module không cần Postgres sẵn sàng
+        if self._pool is None:
+            with self._init_lock:
+                if self._pool is None:
+                    self._pool = pg_pool.ThreadedConnectionPool(
+                        self.minconn, self.maxconn, **self._dsn
+                    )
+        return self._pool
+
+    def _healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+
+        last = self._last_used.get(id(conn))
+        if last is not None and time.monotonic() - last < self.ping_after:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        t0 = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._stats_lock:
+                self._timeouts += 1
+            raise PoolTimeout(f"DB pool exhausted ({self.maxconn} connections busy)")
+        waited = time.perf_counter() - t0
+
+        try:
+            pool = self._get_pool()
+            # sau khi Postgres restart, mọi connection idle trong pool đều chết:
+            # bỏ lần lượt, tối đa maxconn + 1 lần (pool hết connection cũ thì tự mở mới)
+            for _ in range(self.maxconn + 1):
+                conn = pool.getconn()
+                if self._healthy(conn):
+                    break
+                with self._stats_lock:
+                    self._broken += 1
+                self._last_used.pop(id(conn), None)
+                pool.putconn(conn, close=True)
+            else:
+                raise psycopg2.OperationalError("DB pool: không lấy được connection còn sống")
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._stats_lock:
+            self._checkouts += 1
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn) -> None:
+        try:
+            close = bool(conn.closed)
+            if close:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            # ThreadedConnectionPool tự rollback transaction còn mở khi trả về
+            self._get_pool().putconn(conn, close=close)
+        finally:
+            with self._stats_lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            checkouts = self._checkouts
+            return {
+                "max_size": self.maxconn,
+                "in_use": self._in_use,
+                "peak_in_use": self._peak_in_use,
+                "saturation": round(self._in_use / self.maxconn, 3) if self.maxconn else 0.0,
+                "checkouts": checkouts,
+                "timeouts": self._timeouts,
+                "broken_replaced": self._broken,
+                "wait_avg_ms": round(self._wait_total / checkouts * 1000, 3) if checkouts else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+    def closeall(self) -> None:
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+            self._last_used.clear()
+
+
+POOL = DBPool(
+    DB_POOL_MIN,
+    DB_POOL_MAX,
+    DB_POOL_TIMEOUT,
+    DB_POOL_PING_AFTER,
+    dbname=POSTGRES_DB,
+    user=POSTGRES_USER,
+    password=POSTGRES_PASS,
+    host=POSTGRES_HOST,
+    port=POSTGRES_PORT,
+    cursor_factory=RealDictCursor,
+)
+
+
+@contextmanager
+def db_conn():
+    """
+    Mượn 1 connection cho 1 request:
+        with db_conn() as conn:
+            ...
+    Luôn trả connection về pool (kể cả khi lỗi).
+    """
+    conn = POOL.getconn()
+    try:
+        yield conn
+    finally:
+        POOL.putconn(conn)
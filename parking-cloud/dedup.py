@@ -0,0 +1,75 @@
+# dedup.py — DEDUP EVENT 2 TẦNG (REDIS -> processed_events)
+# ==========================================================
+# - Tầng 1: key Redis dedup:{event_id} TTL DEDUP_TTL_SEC
+#   => gate gửi lại event (replay sau mất mạng) trả dedup ngay, không đụng Postgres
+# - Tầng 2: bảng processed_events (vehicle_in_event / vehicle_out_event tự check + ghi)
+#   giữ DEDUP_RETENTION_DAYS ngày, prune_loop() xóa dần theo lô
+# - Redis chỉ là cache: miss thì Postgres vẫn quyết định, mất Redis không sai dữ liệu
+# ==========================================================
+
+import os
+import asyncio
+from datetime import timedelta
+
+DEDUP_TTL_SEC = int(os.getenv("DEDUP_TTL_SEC", str(24 * 3600)))
+DEDUP_RETENTION_DAYS = int(os.getenv("DEDUP_RETENTION_DAYS", "30"))
+DEDUP_PRUNE_SEC = int(os.getenv("DEDUP_PRUNE_SEC", "3600"))
+DEDUP_PRUNE_BATCH = int(os.getenv("DEDUP_PRUNE_BATCH", "5000"))
+
+DEDUP_STATS = {"redis_hits": 0, "redis_misses": 0, "pruned": 0}
+
+
+def dedup_key(event_id: str) -> str:
+    return f"dedup:{event_id}"
+
+
+async def seen_recent(rds, event_ids: list) -> set:
+    """event_id đã xử lý gần đây (theo Redis). 1 MGET cho cả lô; lỗi Redis => coi như miss."""
+    ids = [e for e in event_ids if e]
+    if not ids:
+        return set()
+    try:
+        values = await rds.mget([dedup_key(e) for e in ids])
+    except Exception:
+        return set()
+
+    hits = {e for e, v in zip(ids, values) if v is not None}
+    DEDUP_STATS["redis_hits"] += len(hits)
+    DEDUP_STATS["redis_misses"] += len(ids) - len(hits)
+    return hits
+
+
+async def remember(rds, event_ids: list) -> None:
+    """Ghi event_id đã commit (ok hoặc dedup) vào Redis."""
+    ids = [e for e in event_ids if e]
+    if not ids:
+        return
+    try:
+        pipe = rds.pipeline(transaction=False)
+        for e in ids:
+            pipe.set(dedup_key(e), 1, ex=DEDUP_TTL_SEC)
+        await pipe.execute()
+    except Exception:
+        pass
+
+
+async def prune_once(pool) -> int:
+    total = 0
+    keep = timedelta(days=DEDUP_RETENTION_DAYS)
+    while True:
+        n = await pool.fetchval("SELECT processed_events_prune($1, $2)", keep, DEDUP_PRUNE_BATCH)
+        total += n
+        if n < DEDUP_PRUNE_BATCH:
+            break
+        await asyncio.sleep(0)   # nhường loop giữa các lô
+    DEDUP_STATS["pruned"] += total
+    return total
+
+
+async def prune_loop(pool):
+    while True:
+        try:
+            await prune_once(pool)
+        except Exception as e:
+            print("[dedup] prune error:", e)
+        await asyncio.sleep(DEDUP_PRUNE_SEC)
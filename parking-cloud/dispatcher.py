@@ -0,0 +1,88 @@
+# dispatcher.py — 1 TASK PHÁT EVENT DUY NHẤT TRÊN EVENT LOOP CHÍNH
+# ==========================================================
+# - broadcast() (gates_api.py) gọi submit() từ endpoint sync (threadpool) hay async
+#   => chỉ đẩy event vào hàng đợi, không tạo thread / asyncio.run mỗi event
+# - Task dispatcher gom các event tới trong BROADCAST_WINDOW_MS thành 1 frame:
+#     1 event  -> gửi nguyên event (gate cũ vẫn hiểu)
+#     >1 event -> {"type": "batch", "events": [...]} (gate_ws.py tách ra)
+# - Mỗi frame: serialize 1 lần -> WS gate local + publish Redis cho worker khác
+# ==========================================================
+
+import os
+import asyncio
+
+import orjson
+
+from cloud_ws import broadcast_text
+from ws_relay import publish
+
+BROADCAST_WINDOW_MS = float(os.getenv("BROADCAST_WINDOW_MS", "20"))
+BROADCAST_BATCH_MAX = int(os.getenv("BROADCAST_BATCH_MAX", "100"))
+
+_loop = None
+_queue = None
+_task = None
+
+DISPATCH_STATS = {"events": 0, "frames": 0, "dropped_not_started": 0}
+
+
+def submit(event: dict) -> None:
+    """Gọi được từ thread bất kỳ. Không block."""
+    if _loop is None:
+        DISPATCH_STATS["dropped_not_started"] += 1
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+
+    if running is _loop:
+        _queue.put_nowait(event)
+    else:
+        _loop.call_soon_threadsafe(_queue.put_nowait, event)
+
+
+async def _collect() -> list:
+    batch = [await _queue.get()]
+    deadline = _loop.time() + BROADCAST_WINDOW_MS / 1000
+    while len(batch) < BROADCAST_BATCH_MAX:
+        if not _queue.empty():
+            batch.append(_queue.get_nowait())
+            continue
+        timeout = deadline - _loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+async def _run():
+    while True:
+        batch = await _collect()
+        frame = batch[0] if len(batch) == 1 else {"type": "batch", "events": batch}
+
+        broadcast_text(orjson.dumps(frame).decode())
+        await publish(frame)
+
+        DISPATCH_STATS["events"] += len(batch)
+        DISPATCH_STATS["frames"] += 1
+
+
+def start() -> None:
+    """Gọi trong startup (trên event loop của server)."""
+    global _loop, _queue, _task
+    _loop = asyncio.get_running_loop()
+    _queue = asyncio.Queue()
+    _task = asyncio.create_task(_run())
+
+
+def stop() -> None:
+    if _task:
+        _task.cancel()
+
+
+def dispatch_stats() -> dict:
+    return {**DISPATCH_STATS, "pending": _queue.qsize() if _queue else 0}
@@ -1,15 +1,28 @@
 import os, asyncio, time
 import redis, orjson, psycopg2
-from psycopg2.extras import RealDictCursor
+import redis.asyncio as aioredis
 from datetime import datetime, timedelta
 import pytz
 
-from fastapi import FastAPI, Body, HTTPException, UploadFile, File, Form, Request
+from fastapi import FastAPI, Body, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 
-from cloud_ws import ws_router, broadcast_all  # ⭐ WS broadcast realtime
+from cloud_ws import ws_router, broadcast_all, ws_stats  # ⭐ WS broadcast realtime
+from db_pool import db_conn, POOL  # ⭐ connection pool dùng chung
+from db_async import init_async_pool, close_async_pool, apool, async_pool_stats  # ⭐ asyncpg cho endpoint nóng
+from schema import apply_schema  # ⭐ function/index server-side (sql/*.sql)
+from slot_cache import SLOT_MAP, etag_matches  # ⭐ slot map cache + ETag
+from slot_index import SLOT_INDEX  # ⭐ slot trống gần nhất theo gate (RAM)
+from reservations import SlotReservations, reservation_result  # ⭐ reserve slot nguyên tử (Lua)
+from slot_pool import FreeSlotPool, FreePoolRebuilder, FREE_POOL_RECONCILE_SEC, queue_mark  # ⭐ cấp slot từ Redis
+from ws_relay import EVENTS_CHANNEL, WORKER_ID, RELAY_STATS, envelope, relay_loop  # ⭐ relay event giữa worker
+from heartbeats import HEARTBEATS, alive_map, enable_expiry_events, expiry_loop  # ⭐ gate online = key Redis TTL
+from heartbeats import flush_loop as heartbeat_flush_loop, flush_once as heartbeat_flush_once
+from partitions import maintenance_loop as partition_maintenance_loop  # ⭐ partition tháng transactions / vehicles
+from image_store import IMAGE_STATS, normalize_sha, store_upload, lookup as image_lookup  # ⭐ kho ảnh theo SHA-256
+from dedup import DEDUP_STATS, seen_recent, remember, prune_loop as dedup_prune_loop  # ⭐ dedup Redis trước processed_events
 
 # ======================================================
 # INIT FASTAPI
@@ -23,32 +36,14 @@ app.include_router(ws_router)   # WS server
 TZ = pytz.timezone("Asia/Ho_Chi_Minh")
 
 # ======================================================
-# DATABASE CONFIG
+# CONFIG (Postgres cấu hình trong db_pool.py)
 # ======================================================
-
-
-POSTGRES_DB   = os.getenv("POSTGRES_DB", "parking")
-POSTGRES_USER = os.getenv("POSTGRES_USER", "admin")
-POSTGRES_PASS = os.getenv("POSTGRES_PASSWORD", "admin")
-POSTGRES_HOST = os.getenv("POSTGRES_HOST", "postgres")
-POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", "5432"))
-
 REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 SECRET_TOKEN = os.getenv("SECRET_TOKEN", "secret-key")
 
 os.makedirs("images/in", exist_ok=True)
 os.makedirs("images/out", exist_ok=True)
 
-def get_conn():
-    return psycopg2.connect(
-        dbname=POSTGRES_DB,
-        user=POSTGRES_USER,
-        password=POSTGRES_PASS,
-        host=POSTGRES_HOST,
-        port=POSTGRES_PORT,
-        cursor_factory=RealDictCursor
-    )
-
 def get_redis():
     for _ in range(5):
         try:
@@ -58,6 +53,12 @@ def get_redis():
     raise Exception("Redis connect failed")
 
 r = get_redis()
+ar = aioredis.from_url(REDIS_URL, decode_responses=True)  # dùng trong async endpoint
+
+RES = SlotReservations(r)     # reserve:{slot} cho endpoint sync
+ARES = SlotReservations(ar)   # ... và async
+FREE_POOL = FreeSlotPool(ar)  # free:{gate} ZSET
+FREE_POOL_REBUILD = FreePoolRebuilder(r)   # rebuild free:{gate} từ DB (sync, trong thread)
 
 # ======================================================
 # BROADCAST EVENT
@@ -65,30 +66,41 @@ r = get_redis()
 # ======================================================
 # BROADCAST EVENT (SAFE FOR SYNC + ASYNC)
 # ======================================================
-import threading
-
-def run_ws(event: dict):
-    try:
-        asyncio.run(broadcast_all(event))
-    except:
-        pass
+import dispatcher
 
 def broadcast(event: dict):
     """
     Redis PubSub + WS broadcast (safe cho sync/async endpoint)
+    Chỉ đẩy vào hàng đợi của dispatcher (dispatcher.py): 1 task trên loop chính
+    gom event thành frame, gửi WS gate local + publish Redis cho worker khác.
     """
-    # Redis
+    dispatcher.submit(event)
+
+
+def publish_internal(event: dict):
+    """Chỉ báo cho worker khác (xóa cache), không gửi xuống gate."""
     try:
-        r.publish("parking:events", orjson.dumps(event).decode())
+        r.publish(EVENTS_CHANNEL, envelope(event, internal=True))
     except:
         pass
 
-    # WS
-    try:
-        loop = asyncio.get_running_loop()
-        loop.create_task(broadcast_all(event))
-    except RuntimeError:
-        threading.Thread(target=run_ws, args=(event,), daemon=True).start()
+
+def on_relayed_event(event: dict, internal: bool):
+    """Event từ worker khác: cập nhật cache local trước khi gửi cho gate."""
+    et = event.get("type")
+    if et == "batch":
+        for e in event.get("events") or []:
+            on_relayed_event(e, internal)
+    elif et == "slot_update" and event.get("slotId"):
+        SLOT_MAP.invalidate()
+        SLOT_INDEX.mark(event["slotId"], bool(event.get("occupied")))
+    elif et == "slots_changed":
+        # admin sửa slot ở worker khác
+        SLOT_MAP.invalidate()
+        SLOT_INDEX.invalidate()
+
+
+relay_task = None
 
 
 # ======================================================
@@ -112,13 +124,18 @@ PUBLIC_PATHS = (
     "/view_image",
     "/upload_image_in",
     "/upload_image_out",
-    "/transactions",
     "/slot_info",
      "/slots/map",
+     "/slots/changes",
      "/payments/vietqr",
 
 )
 
+# khớp nguyên path (không theo prefix): /transactions/export vẫn cần token
+PUBLIC_EXACT_PATHS = (
+    "/transactions",
+)
+
 def verify_token(auth: str | None):
     if not auth:
         raise HTTPException(401, "Unauthorized")
@@ -132,7 +149,7 @@ def verify_token(auth: str | None):
 async def auth_middleware(request: Request, call_next):
     path = request.url.path
 
-    if any(path.startswith(p) for p in PUBLIC_PATHS):
+    if path in PUBLIC_EXACT_PATHS or any(path.startswith(p) for p in PUBLIC_PATHS):
         return await call_next(request)
 
     try:
@@ -151,6 +168,68 @@ def health():
     return {"ok": True, "time": datetime.now(TZ).isoformat()}
 
 
+@app.on_event("startup")
+async def open_async_db():
+    pool = await init_async_pool()
+    await apply_schema(pool)
+    await pool.execute("SELECT slot_tombstones_prune($1)", timedelta(days=SLOT_TOMBSTONE_KEEP_DAYS))
+
+    try:
+        await asyncio.to_thread(rebuild_free_pool)
+    except Exception as e:
+        print("[free_pool] rebuild error:", e)
+    asyncio.create_task(free_pool_reconciler())
+    asyncio.create_task(dedup_prune_loop(pool))
+    asyncio.create_task(partition_maintenance_loop(pool))
+    asyncio.create_task(reports.cleanup_loop())
+
+    dispatcher.start()
+
+    # chỉ broadcast khi gate đổi online/offline
+    HEARTBEATS.on_change = lambda gid, online: broadcast(
+        {"type": "gate_status", "gate": gid, "online": online}
+    )
+    asyncio.create_task(heartbeat_flush_loop())
+
+    # offline: mọi worker đều nhận keyspace event -> chỉ gửi gate local (không relay)
+    await enable_expiry_events()
+    asyncio.create_task(expiry_loop(
+        lambda gid: broadcast_all({"type": "gate_status", "gate": gid, "online": False})
+    ))
+
+    global relay_task
+    relay_task = asyncio.create_task(relay_loop(broadcast_all, on_relayed_event))
+
+
+@app.on_event("shutdown")
+async def close_db_pools():
+    if relay_task:
+        relay_task.cancel()
+    dispatcher.stop()
+    await heartbeat_flush_once()
+    reports.shutdown()
+    await close_async_pool()
+    POOL.closeall()
+
+
+@app.get("/metrics/db_pool")
+def db_pool_metrics():
+    # wait time + saturation để chỉnh DB_POOL_MAX khi tải cao
+    return {"ok": True, "pool": POOL.stats(), "async_pool": async_pool_stats()}
+
+
+@app.get("/metrics/dedup")
+def dedup_metrics():
+    return {"ok": True, "dedup": DEDUP_STATS}
+
+
+@app.get("/metrics/ws")
+def ws_metrics():
+    # độ sâu hàng đợi + thời gian gửi từng gate, số message bị bỏ vì gate chậm
+    return {"ok": True, "worker": WORKER_ID, "ws": ws_stats(), "relay": RELAY_STATS,
+            "dispatch": dispatcher.dispatch_stats(), "heartbeats": HEARTBEATS.stats()}
+
+
 # ======================================================
 # LOGIN
 # ======================================================
@@ -162,17 +241,14 @@ def login(data: dict = Body(...)):
     if not user or not pw:
         raise HTTPException(400, "Missing login info")
 
-    conn = get_conn()
-    cur = conn.cursor()
-
-    cur.execute("""
-        SELECT username, gateid, role 
-        FROM users 
-        WHERE username=%s AND password=%s
-    """, (user, pw))
-
-    row = cur.fetchone()
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT username, gateid, role 
+            FROM users 
+            WHERE username=%s AND password=%s
+        """, (user, pw))
+        row = cur.fetchone()
 
     if not row:
         raise HTTPException(401, "Invalid username/password")
@@ -189,19 +265,34 @@ def login(data: dict = Body(...)):
 # ======================================================
 # GATES
 # ======================================================
+GATES_META_TTL = float(os.getenv("GATES_META_TTL", "300"))   # thông tin gate (vị trí, zone...) ít đổi
+_gates_meta = {"rows": None, "at": 0.0}
+
+
+async def gates_meta() -> list:
+    if _gates_meta["rows"] is None or time.monotonic() - _gates_meta["at"] > GATES_META_TTL:
+        rows = await apool().fetch("SELECT * FROM gates ORDER BY gateid")
+        _gates_meta["rows"] = [dict(g) for g in rows]
+        _gates_meta["at"] = time.monotonic()
+    return _gates_meta["rows"]
+
+
 @app.get("/gates")
-def list_gates():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM gates ORDER BY gateid")
-    rows = cur.fetchall()
-    conn.close()
-
-    now = datetime.now(TZ)
+async def list_gates():
+    # metadata cache RAM; online + last_sync từ key gate:alive:* (heartbeats.py)
+    rows = await gates_meta()
+    alive = await alive_map([g["gateid"] for g in rows])
+
+    out = []
     for g in rows:
-        g["online"] = (now - g["last_sync"]) < timedelta(seconds=60) if g["last_sync"] else False
+        item = dict(g)
+        beat = alive.get(g["gateid"])
+        item["online"] = beat is not None
+        if beat:
+            item["last_sync"] = beat
+        out.append(item)
 
-    return {"gates": rows}
+    return {"gates": out}
 
 
 @app.post("/heartbeat")
@@ -210,56 +301,71 @@ def heartbeat(data: dict = Body(...)):
     if not gateid:
         raise HTTPException(400, "missing gateid")
 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE gates 
-        SET last_sync = (SELECT NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh')
-        WHERE gateid=%s
-    """, (gateid,))
-    conn.commit()
-    conn.close()
-
-    broadcast({"type": "heartbeat", "gate": gateid})
+    # last_sync ghi theo lô mỗi HEARTBEAT_FLUSH_SEC (heartbeats.py)
+    HEARTBEATS.beat(gateid)
     return {"ok": True}
 
 
 # ======================================================
 # RESERVE SLOT (COORDINATION TTL) — HƯỚNG 3
 # ======================================================
-@app.post("/reserve_slot")
-def reserve_slot(data: dict = Body(...), request: Request = None):
-    # auth middleware đã bảo vệ route này (không nằm trong PUBLIC_PATHS)
-
+def reservation_input(data: dict) -> tuple[str, str, int]:
     gate = (data.get("gate") or "").strip().upper()
     slot = (data.get("slot") or "").strip().upper()
     ttl  = int(data.get("ttl", 15))
 
     if not gate or not slot:
         raise HTTPException(400, "missing gate/slot")
+    return gate, slot, ttl
+
 
-    key = f"reserve:{slot}"
-    owner = r.get(key)
+@app.post("/reserve_slot")
+def reserve_slot(data: dict = Body(...), request: Request = None):
+    # auth middleware đã bảo vệ route này (không nằm trong PUBLIC_PATHS)
+    gate, slot, ttl = reservation_input(data)
 
-    if owner and owner != gate:
+    # giữ mới hoặc gia hạn (nếu đã là của gate này) — 1 lệnh nguyên tử
+    ok, owner, _ = reservation_result(RES.reserve(slot, gate, ttl * 1000))
+    if not ok:
         raise HTTPException(409, f"Slot {slot} đang được giữ bởi gate {owner}")
 
-    r.setex(key, ttl, gate)
     return {"ok": True, "slot": slot, "gate": gate, "ttl": ttl}
 
 
+@app.post("/reserve_slot/renew")
+def renew_reserve(data: dict = Body(...)):
+    gate, slot, ttl = reservation_input(data)
+
+    ok, owner, _ = reservation_result(RES.renew(slot, gate, ttl * 1000))
+    if not ok:
+        if owner:
+            raise HTTPException(409, f"Slot {slot} đang được giữ bởi gate {owner}")
+        raise HTTPException(404, f"Slot {slot} không còn được giữ")
+
+    return {"ok": True, "slot": slot, "gate": gate, "ttl": ttl}
+
+
+@app.post("/reserve_slot/release")
+def release_reserve(data: dict = Body(...)):
+    gate, slot, _ = reservation_input(data)
+
+    ok, owner, _ = reservation_result(RES.release(slot, gate))
+    if not ok and owner:
+        raise HTTPException(409, f"Slot {slot} đang được giữ bởi gate {owner}")
+
+    return {"ok": True, "slot": slot, "released": ok}
+
+
 @app.get("/reserve_slot/{slotid}")
 def get_reserve(slotid: str):
     slotid = slotid.strip().upper()
     key = f"reserve:{slotid}"
-    owner = r.get(key)
-    ttl = r.ttl(key) if owner else -1
-    return {"ok": True, "slot": slotid, "gate": owner, "ttl": ttl}
+    owner, ttl = r.pipeline().get(key).ttl(key).execute()
+    return {"ok": True, "slot": slotid, "gate": owner, "ttl": ttl if owner else -1}
 
 # ======================================================
 # SLOTS
 # ======================================================
-import math
 from fastapi import Query, HTTPException
 
 
@@ -270,41 +376,26 @@ def update_slot(slotid: str, body: dict = Body(...)):
     occupied = bool(body.get("occupied", False))
     plate = body.get("plate") or None
 
-    conn = get_conn()
-    cur = conn.cursor()
-
-    cur.execute("""
-        UPDATE slots 
-        SET occupied=%s, plate=%s, version=version+1
-        WHERE slotid=%s
-    """, (occupied, plate, slotid))
-    conn.commit()
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE slots 
+            SET occupied=%s, plate=%s, version=version+1
+            WHERE slotid=%s
+        """, (occupied, plate, slotid))
+        conn.commit()
 
+    SLOT_MAP.invalidate()
+    SLOT_INDEX.mark(slotid, occupied)
+    try:
+        pipe = r.pipeline(transaction=False)
+        queue_mark(pipe, slotid, occupied, SLOT_INDEX.distances(slotid))
+        pipe.execute()
+    except:
+        pass
     broadcast({"type": "slot_update", "slotId": slotid, "occupied": occupied, "plate": plate})
     return {"msg": "ok"}
 
-import psycopg2.errors
-
-def ensure_event_once(cur, conn, event_id: str | None, event_type: str, gate: str):
-    """
-    Return True nếu event mới (chưa xử lý)
-    Return False nếu event đã xử lý rồi (dedup)
-    """
-    if not event_id:
-        return True  # không có event_id thì không dedup được
-
-    try:
-        cur.execute(
-            "INSERT INTO processed_events(event_id, event_type, gateid) VALUES (%s,%s,%s)",
-            (event_id, event_type, gate)
-        )
-        return True
-    except psycopg2.errors.UniqueViolation:
-        conn.rollback()
-        return False
-
-
 # ======================================================
 # VEHICLE IN
 # ======================================================
@@ -315,10 +406,27 @@ import pytz
 TZ = pytz.timezone("Asia/Ho_Chi_Minh")
 
 # ======================================================
-# VEHICLE IN (IDEMPOTENT + TRANSACTION)
+# VEHICLE IN / OUT — 1 ROUND TRIP (sql/010_vehicle_events.sql)
 # ======================================================
+def event_http_error(res: dict, plate: str, slot: str | None = None) -> HTTPException:
+    """Đổi result code của vehicle_in_event / vehicle_out_event sang HTTP error."""
+    code = res.get("code")
+    if code == "slot_occupied":
+        return HTTPException(409, f"Slot {slot} đã có xe")
+    if code == "plate_in_yard":
+        return HTTPException(409, f"Xe {plate} đang ở trong bãi")
+    if code == "not_found":
+        return HTTPException(404, {
+            "gate": "Gate không tồn tại",
+            "slot": "Slot không tồn tại",
+            "vehicle": "Xe không tồn tại trong bãi",
+            "transaction": "Không tìm thấy transaction đang mở",
+        }.get(res.get("what"), "Not found"))
+    return HTTPException(500, f"Unknown result code: {code}")
+
+
 @app.post("/vehicle_in")
-def vehicle_in(data: dict = Body(...)):
+async def vehicle_in(data: dict = Body(...)):
     plate = (data.get("plate") or "").strip().upper()
     gate  = (data.get("gate") or "").strip().upper()
     slot  = (data.get("slot") or "").strip().upper()
@@ -328,95 +436,49 @@ def vehicle_in(data: dict = Body(...)):
     if not plate or not gate or not slot:
         raise HTTPException(400, "missing plate/gate/slot")
 
-    conn = get_conn()
+    # gate gửi lại event vừa xử lý: trả dedup từ Redis, không claim slot / đụng DB
+    if event_id and await seen_recent(ar, [event_id]):
+        return {"ok": True, "dedup": True}
+
+    # giữ slot trong lúc ghi DB: trống hoặc của gate này, nguyên tử (Redis, trước khi đụng DB)
+    ok, owner, _ = reservation_result(await ARES.claim(slot, gate))
+    if not ok:
+        raise HTTPException(409, f"Slot {slot} đang được giữ bởi gate {owner}")
+
+    # dedup + check + ghi: 1 câu SQL, 1 transaction
     try:
-        # ✅ dùng transaction context: lỗi là rollback, ok thì commit
-        with conn:
-            cur = conn.cursor()
-
-            # ✅ 0) DEDUP (idempotent)
-            if event_id:
-                cur.execute("SELECT 1 FROM processed_events WHERE event_id=%s", (event_id,))
-                if cur.fetchone():
-                    return {"ok": True, "dedup": True}
-
-            # 1) gate exists?
-            cur.execute("SELECT 1 FROM gates WHERE gateid=%s", (gate,))
-            if not cur.fetchone():
-                raise HTTPException(404, "Gate không tồn tại")
-
-            # 2) slot valid?
-            cur.execute("SELECT occupied FROM slots WHERE slotid=%s", (slot,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(404, "Slot không tồn tại")
-
-            # 3) conflict slot occupied
-            if row["occupied"]:
-                raise HTTPException(409, f"Slot {slot} đã có xe")
-
-            # 4) conflict plate already in yard
-            cur.execute("""
-                SELECT 1 FROM vehicles
-                WHERE plate=%s AND time_out IS NULL
-                LIMIT 1
-            """, (plate,))
-            if cur.fetchone():
-                raise HTTPException(409, f"Xe {plate} đang ở trong bãi")
-
-            # 5) conflict reserve by other gate
-            key = f"reserve:{slot}"
-            owner = r.get(key)
-            if owner and owner != gate:
-                raise HTTPException(409, f"Slot {slot} đang được giữ bởi gate {owner}")
-
-            # 6) update slot
-            cur.execute("""
-                UPDATE slots
-                SET occupied=true, plate=%s, version=version+1
-                WHERE slotid=%s
-            """, (plate, slot))
-
-            # 7) insert vehicles
-            cur.execute("""
-                INSERT INTO vehicles (plate, slotid, gateid, source_gate, time_in)
-                VALUES (%s, %s, %s, %s, (SELECT NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh'))
-            """, (plate, slot, gate, gate))
-
-            # 8) insert transactions
-            cur.execute("""
-                INSERT INTO transactions (plate, slotid, gateid, time_in, img_in)
-                VALUES (%s, %s, %s, (SELECT NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh'), %s)
-            """, (plate, slot, gate, img_in))
-
-            # ✅ 9) mark processed event
-            if event_id:
-                cur.execute("""
-                    INSERT INTO processed_events(event_id, gateid, event_type)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (event_id) DO NOTHING
-                """, (event_id, gate, "vehicle_in"))
-
-        # ngoài transaction: clear reserve + broadcast
+        res = await apool().fetchval(
+            "SELECT vehicle_in_event($1, $2, $3, $4, $5)",
+            plate, gate, slot, img_in, event_id or None
+        )
+        if res["code"] == "ok":
+            # gỡ khỏi free pool TRƯỚC khi nhả reserve => allocate không cấp lại slot này
+            await free_pool_mark([(slot, True)])
+    finally:
+        # sau commit (hoặc lỗi): nhả slot nếu vẫn là của gate này
         try:
-            r.delete(f"reserve:{slot}")
+            await ARES.release(slot, gate)
         except:
             pass
 
-        broadcast({"type": "slot_update", "slotId": slot, "occupied": True, "plate": plate})
-        broadcast({"type": "vehicle_in", "plate": plate, "slot": slot, "gate": gate})
+    if res["code"] in ("ok", "dedup"):
+        await remember(ar, [event_id])
+    if res["code"] == "dedup":
+        return {"ok": True, "dedup": True}
+    if res["code"] != "ok":
+        raise event_http_error(res, plate, slot)
 
-        return {"ok": True}
+    # sau commit: clear cache + broadcast
+    SLOT_MAP.invalidate()
+    SLOT_INDEX.mark(slot, True)
+    broadcast({"type": "slot_update", "slotId": slot, "occupied": True, "plate": plate})
+    broadcast({"type": "vehicle_in", "plate": plate, "slot": slot, "gate": gate})
 
-    finally:
-        conn.close()
+    return {"ok": True}
 
 
-# ======================================================
-# VEHICLE OUT (IDEMPOTENT + FIX UPDATE TRANSACTIONS)
-# ======================================================
 @app.post("/vehicle_out")
-def vehicle_out(data: dict = Body(...)):
+async def vehicle_out(data: dict = Body(...)):
     plate = (data.get("plate") or "").strip().upper()
     gate  = (data.get("gate") or "").strip().upper() or None
     img_out = data.get("img_out")
@@ -425,95 +487,183 @@ def vehicle_out(data: dict = Body(...)):
     if not plate:
         raise HTTPException(400, "missing plate")
 
-    conn = get_conn()
-    try:
-        with conn:
-            cur = conn.cursor()
-
-            # ✅ 0) DEDUP
-            if event_id:
-                cur.execute("SELECT 1 FROM processed_events WHERE event_id=%s", (event_id,))
-                if cur.fetchone():
-                    return {"ok": True, "dedup": True}
-
-            # 1) find current vehicle in yard
-            cur.execute("""
-                SELECT id, slotid, time_in
-                FROM vehicles
-                WHERE plate=%s AND time_out IS NULL
-                ORDER BY time_in DESC
-                LIMIT 1
-            """, (plate,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(404, "Xe không tồn tại trong bãi")
-
-            slotid = row["slotid"]
-            time_in = row["time_in"]
-
-            # tz aware
-            if getattr(time_in, "tzinfo", None) is None:
-                time_in = TZ.localize(time_in)
-
-            time_out = datetime.now(TZ)
-            fee, duration = calc_fee(time_in, time_out)
-
-            # 2) free slot
-            cur.execute("""
-                UPDATE slots
-                SET occupied=false, plate=NULL, version=version+1
-                WHERE slotid=%s
-            """, (slotid,))
-
-            # 3) close vehicles
-            cur.execute("""
-                UPDATE vehicles
-                SET time_out=%s
-                WHERE id=%s
-            """, (time_out, row["id"]))
-
-            # ✅ 4) FIX transactions: schema dùng trans_id (không phải id)
-            cur.execute("""
-                SELECT trans_id
-                FROM transactions
-                WHERE plate=%s AND time_out IS NULL
-                ORDER BY time_in DESC
-                LIMIT 1
-            """, (plate,))
-            trow = cur.fetchone()
-            if not trow:
-                raise HTTPException(404, "Không tìm thấy transaction đang mở")
-
-            tx_id = trow["trans_id"]
-
-            cur.execute("""
-                UPDATE transactions
-                SET time_out=%s,
-                    duration_minutes=%s,
-                    fee=%s,
-                    img_out=%s
-                WHERE trans_id=%s
-            """, (time_out, duration, fee, img_out, tx_id))
-
-            # 5) mark processed
-            if event_id:
-                cur.execute("""
-                    INSERT INTO processed_events(event_id, gateid, event_type)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (event_id) DO NOTHING
-                """, (event_id, gate, "vehicle_out"))
-
-        # outside transaction
-        broadcast({"type": "slot_update", "slotId": slotid, "occupied": False, "plate": None})
-        broadcast({"type": "vehicle_out", "plate": plate, "slot": slotid, "gate": gate})
-
-        return {"ok": True, "duration_minutes": duration, "fee": fee, "slot": slotid}
+    if event_id and await seen_recent(ar, [event_id]):
+        return {"ok": True, "dedup": True}
+
+    res = await apool().fetchval(
+        "SELECT vehicle_out_event($1, $2, $3, $4)",
+        plate, gate, img_out, event_id or None
+    )
+    if res["code"] in ("ok", "dedup"):
+        await remember(ar, [event_id])
+    if res["code"] == "dedup":
+        return {"ok": True, "dedup": True}
+    if res["code"] != "ok":
+        raise event_http_error(res, plate)
+
+    slotid = res["slot"]
+
+    SLOT_MAP.invalidate()
+    SLOT_INDEX.mark(slotid, False)
+    await free_pool_mark([(slotid, False)])
+    broadcast({"type": "slot_update", "slotId": slotid, "occupied": False, "plate": None})
+    broadcast({"type": "vehicle_out", "plate": plate, "slot": slotid, "gate": gate})
+
+    return {"ok": True, "duration_minutes": res["duration_minutes"], "fee": res["fee"], "slot": slotid}
+
+
+# ======================================================
+# EVENT BATCH — gate xả offline queue trong 1 request
+# - dedup: 1 MGET Redis (dedup.py) rồi 1 câu `event_id = ANY($1)` cho phần còn lại
+# - cả lô 1 transaction, mỗi event 1 savepoint (event lỗi không kéo event khác)
+# - giữ thứ tự gửi lên (vào rồi ra cùng lô vẫn đúng)
+# - trả outcome từng event: ok / dedup / lỗi (status + detail như /vehicle_in, /vehicle_out)
+# ======================================================
+EVENT_BATCH_MAX = int(os.getenv("EVENT_BATCH_MAX", "200"))
 
+
+def normalize_batch_event(ev: dict) -> dict:
+    et = ev.get("type") or ev.get("event_type")
+    return {
+        "event_id": (ev.get("event_id") or "").strip(),
+        "type": et,
+        "plate": (ev.get("plate") or "").strip().upper(),
+        "gate": (ev.get("gate") or "").strip().upper() or None,
+        "slot": (ev.get("slot") or "").strip().upper(),
+        "img": ev.get("img_in") if et == "vehicle_in" else ev.get("img_out"),
+    }
+
+
+@app.post("/events/batch")
+async def events_batch(data: dict = Body(...)):
+    events = data.get("events")
+    if not isinstance(events, list) or not events:
+        raise HTTPException(400, "missing events")
+    if len(events) > EVENT_BATCH_MAX:
+        raise HTTPException(413, f"Tối đa {EVENT_BATCH_MAX} event mỗi lô")
+
+    events = [normalize_batch_event(ev) for ev in events]
+
+    ids = [ev["event_id"] for ev in events if ev["event_id"]]
+    recent = await seen_recent(ar, ids)
+
+    # giữ slot cho mọi vehicle_in trong lúc ghi DB (giống /vehicle_in): 1 script nguyên tử cho cả lô
+    wanted = [
+        (ev["slot"], ev["gate"]) for ev in events
+        if ev["type"] == "vehicle_in" and ev["slot"] and ev["gate"] and ev["event_id"] not in recent
+    ]
+    claims = {}
+    if wanted:
+        for pair, res in zip(wanted, await ARES.claim_many(wanted)):
+            claims[pair] = reservation_result(res)
+    claimed = [pair for pair, (ok, _, _) in claims.items() if ok]
+
+    try:
+        outcomes, applied = await _apply_batch(events, recent, claims)
+        # gỡ khỏi free pool TRƯỚC khi nhả reserve => allocate không cấp lại slot vừa có xe
+        if applied:
+            await free_pool_mark([(slot, ev["type"] == "vehicle_in") for ev, slot in applied])
     finally:
-        conn.close()
+        if claimed:
+            try:
+                await ARES.release_many(claimed)
+            except:
+                pass
+
+    # sau commit: nhớ event_id (ok + dedup) trong Redis cho lần gửi lại
+    await remember(ar, [o["event_id"] for o in outcomes if o.get("ok") and o["event_id"] not in recent])
+
+    # sau commit: clear cache + broadcast (giống /vehicle_in, /vehicle_out)
+    if applied:
+        SLOT_MAP.invalidate()
+
+    for ev, slot in applied:
+        occupied = ev["type"] == "vehicle_in"
+        SLOT_INDEX.mark(slot, occupied)
+        broadcast({"type": "slot_update", "slotId": slot, "occupied": occupied,
+                   "plate": ev["plate"] if occupied else None})
+        broadcast({"type": ev["type"], "plate": ev["plate"], "slot": slot, "gate": ev["gate"]})
+
+    return {"ok": True, "results": outcomes}
+
+
+async def _apply_batch(events: list, recent: set, claims: dict) -> tuple[list, list]:
+    """Áp dụng lô trong 1 transaction (mỗi event 1 savepoint). Trả về (outcomes, [(ev, slot)] đã ghi)."""
+    ids = [ev["event_id"] for ev in events if ev["event_id"]]
+    outcomes, applied = [], []
+    async with apool().acquire() as conn:
+        async with conn.transaction():
+            seen = set(recent)
+            missing = [e for e in ids if e not in recent]
+            if missing:
+                seen.update(
+                    row["event_id"] for row in await conn.fetch(
+                        "SELECT event_id FROM processed_events WHERE event_id = ANY($1::text[])", missing
+                    )
+                )
+
+            blocked = False
+            for ev in events:
+                out = {"event_id": ev["event_id"], "type": ev["type"]}
+                outcomes.append(out)
+
+                # event trước còn phải thử lại (reserved / lỗi 500) => không áp dụng phần sau của lô,
+                # vd vehicle_out chạy trước vehicle_in đang chờ sẽ bị từ chối oan
+                if blocked:
+                    out.update(ok=False, status=409, code="deferred", detail="Chờ event trước trong lô")
+                    continue
+
+                if ev["event_id"] and ev["event_id"] in seen:
+                    out.update(ok=True, dedup=True)
+                    continue
+
+                if ev["type"] == "vehicle_in":
+                    if not ev["plate"] or not ev["gate"] or not ev["slot"]:
+                        out.update(ok=False, status=400, detail="missing plate/gate/slot")
+                        continue
+                    ok, owner, _ = claims.get((ev["slot"], ev["gate"]), (True, None, 0))
+                    if not ok:
+                        out.update(ok=False, status=409, code="reserved",
+                                   detail=f"Slot {ev['slot']} đang được giữ bởi gate {owner}")
+                        blocked = True
+                        continue
+                    sql = "SELECT vehicle_in_event($1, $2, $3, $4, $5)"
+                    args = (ev["plate"], ev["gate"], ev["slot"], ev["img"], ev["event_id"] or None)
+                elif ev["type"] == "vehicle_out":
+                    if not ev["plate"]:
+                        out.update(ok=False, status=400, detail="missing plate")
+                        continue
+                    sql = "SELECT vehicle_out_event($1, $2, $3, $4)"
+                    args = (ev["plate"], ev["gate"], ev["img"], ev["event_id"] or None)
+                else:
+                    out.update(ok=False, status=400, detail=f"Unknown event type: {ev['type']}")
+                    continue
+
+                try:
+                    async with conn.transaction():   # savepoint
+                        res = await conn.fetchval(sql, *args)
+                except Exception as e:
+                    out.update(ok=False, status=500, detail=f"{type(e).__name__}: {e}")
+                    blocked = True
+                    continue
+
+                if res["code"] == "dedup":
+                    out.update(ok=True, dedup=True)
+                elif res["code"] != "ok":
+                    err = event_http_error(res, ev["plate"], ev["slot"])
+                    out.update(ok=False, status=err.status_code, code=res["code"], detail=err.detail)
+                else:
+                    out.update(ok=True, slot=res["slot"])
+                    if ev["type"] == "vehicle_out":
+                        out.update(fee=res["fee"], duration_minutes=res["duration_minutes"])
+                    if ev["event_id"]:
+                        seen.add(ev["event_id"])   # trùng event_id trong cùng lô
+                    applied.append((ev, res["slot"]))
+
+    return outcomes, applied
 
 # ======================================================
-# FEE CALCULATOR
+# FEE CALCULATOR (giữ khớp vehicle_out_event trong sql/010_vehicle_events.sql)
 # ======================================================
 def calc_fee(time_in, time_out):
     delta = time_out - time_in
@@ -525,38 +675,37 @@ def calc_fee(time_in, time_out):
 
 
 # ======================================================
-# IMAGE UPLOAD
+# IMAGE UPLOAD — kho ảnh theo SHA-256 (image_store.py)
+# - gate hỏi /upload_image/check trước, ảnh đã có thì không upload lại
+# - upload: parse multipart từ request.stream(), chặn cỡ theo Content-Length + khi nhận byte,
+#   I/O disk trong thread, file tạm + os.replace
 # ======================================================
-@app.post("/upload_image_in")
-async def upload_image_in(
-    plate: str = Form(...),
-    gate: str = Form(...),
-    file: UploadFile = File(...)
-):
-    filename = f"{plate}_{int(time.time())}.jpg"
-    path = f"images/in/{filename}"
+@app.post("/upload_image/check")
+async def upload_image_check(data: dict = Body(...)):
+    sha = normalize_sha(data.get("sha256"))
+    if not sha:
+        raise HTTPException(400, "sha256 không hợp lệ")
+    path = await image_lookup(sha)
+    return {"ok": True, "exists": path is not None, "path": path}
 
-    with open(path, "wb") as f:
-        f.write(await file.read())
 
-    return {"ok": True, "path": path}
+@app.post("/upload_image_in")
+async def upload_image_in(request: Request):
+    # form: plate, gate, sha256 (tùy chọn), file — đọc thẳng từ stream, không qua Form / UploadFile
+    res = await store_upload(request, required=("plate", "gate"))
+    return {"ok": True, "path": res["path"], "dedup": res["dedup"]}
 
 
 @app.post("/upload_image_out")
-async def upload_image_out(
-    plate: str = Form(...),
-    gate: str = Form(...),
-    file: UploadFile = File(...)
-):
-    filename = f"{plate}_{int(time.time())}.jpg"
-    path = f"images/out/{filename}"
-
-    with open(path, "wb") as f:
-        f.write(await file.read())
-
-    return {"ok": True, "path": path}
+async def upload_image_out(request: Request):
+    # form: plate, gate, sha256 (tùy chọn), file — đọc thẳng từ stream, không qua Form / UploadFile
+    res = await store_upload(request, required=("plate", "gate"))
+    return {"ok": True, "path": res["path"], "dedup": res["dedup"]}
 
 
+@app.get("/metrics/images")
+def image_metrics():
+    return {"ok": True, "images": IMAGE_STATS}
 
 
 @app.get("/view_image")
@@ -576,121 +725,507 @@ app.mount("/images", StaticFiles(directory="images"), name="images")
 
 # ======================================================
 # GET TRANSACTIONS (LỊCH SỬ XE VÀO / RA)
+# - keyset pagination: ORDER BY time_in DESC, trans_id DESC + cursor
+# - filter server-side: gate, plate, khoảng ngày (theo time_in), open/closed
+# - index: sql/020_transactions_indexes.sql
 # ======================================================
 import uuid
+import base64
 from fastapi import Query
-@app.get("/transactions")
-def list_transactions():
-    conn = get_conn()
-    cur = conn.cursor()
+
+TX_PAGE_DEFAULT = 100
+TX_PAGE_MAX = 500
+
+
+def parse_day(value: str | None, field: str) -> datetime | None:
+    """'YYYY-MM-DD' -> datetime 00:00 (giờ VN, naive như cột time_in)."""
+    if not value:
+        return None
     try:
-        cur.execute("""
-            SELECT trans_id, plate, slotid, gateid,
-                   time_in, time_out, duration_minutes,
-                   fee, img_in, img_out, payment_id
-            FROM transactions
-            ORDER BY time_in DESC
-        """)
-        rows = cur.fetchall()
-        return {"ok": True, "transactions": rows}
-    finally:
-        conn.close()
+        return datetime.fromisoformat(value.strip()[:10])
+    except ValueError:
+        raise HTTPException(400, f"{field} phải có dạng YYYY-MM-DD")
+
+
+def tx_filters(gate: str | None = None, plate: str | None = None,
+               date_from: str | None = None, date_to: str | None = None,
+               status: str | None = None, args: list | None = None):
+    """
+    Build WHERE cho transactions (param asyncpg $n).
+    Trả về (list điều kiện, list args) — dùng chung cho list / stats / export.
+    """
+    where = []
+    args = args if args is not None else []
+
+    def arg(v):
+        args.append(v)
+        return f"${len(args)}"
+
+    if gate and gate.upper() != "ALL":
+        where.append(f"gateid = {arg(gate.strip().upper())}")
+    if plate:
+        where.append(f"plate = {arg(plate.strip().upper())}")
+
+    d_from = parse_day(date_from, "date_from")
+    d_to = parse_day(date_to, "date_to")
+    if d_from:
+        where.append(f"time_in >= {arg(d_from)}")
+    if d_to:
+        where.append(f"time_in < {arg(d_to + timedelta(days=1))}")  # date_to tính cả ngày
+
+    status = (status or "all").lower()
+    if status == "open":
+        # không có time_in => dò mọi partition (Merge Append theo time_in); dùng date_from để prune
+        where.append("time_out IS NULL")
+    elif status == "closed":
+        where.append("time_out IS NOT NULL")
+    elif status != "all":
+        raise HTTPException(400, "status phải là open | closed | all")
+
+    return where, args
+
+
+def encode_tx_cursor(row) -> str:
+    raw = orjson.dumps({"t": row["time_in"].isoformat(), "id": str(row["trans_id"])})
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_tx_cursor(cursor: str):
+    try:
+        c = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        trans_id = c["id"]
+        return datetime.fromisoformat(c["t"]), int(trans_id) if trans_id.isdigit() else trans_id
+    except Exception:
+        raise HTTPException(400, "cursor không hợp lệ")
+
+
+@app.get("/transactions")
+async def list_transactions(
+    limit: int = Query(default=TX_PAGE_DEFAULT, ge=1, le=TX_PAGE_MAX),
+    cursor: str | None = Query(default=None),
+    gate: str | None = Query(default=None),
+    plate: str | None = Query(default=None),
+    date_from: str | None = Query(default=None),
+    date_to: str | None = Query(default=None),
+    status: str = Query(default="all"),
+):
+    where, args = tx_filters(gate, plate, date_from, date_to, status)
+    where.append("time_in IS NOT NULL")
+
+    if cursor:
+        c_time, c_id = decode_tx_cursor(cursor)
+        args += [c_time, c_id]
+        where.append(f"(time_in, trans_id) < (${len(args) - 1}, ${len(args)})")
+
+    args.append(limit + 1)  # lấy dư 1 dòng để biết còn trang sau
+    rows = await apool().fetch(f"""
+        SELECT trans_id, plate, slotid, gateid,
+               time_in, time_out, duration_minutes,
+               fee, img_in, img_out, payment_id
+        FROM transactions
+        WHERE {" AND ".join(where)}
+        ORDER BY time_in DESC, trans_id DESC
+        LIMIT ${len(args)}
+    """, *args)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return {
+        "ok": True,
+        "transactions": [dict(r) for r in rows],
+        "next_cursor": encode_tx_cursor(rows[-1]) if has_more else None,
+    }
+
+
+# ======================================================
+# EXPORT TRANSACTIONS (STREAMING CSV / NDJSON)
+# - server-side cursor (asyncpg) => RAM phẳng dù bao nhiêu dòng
+# - gửi từng chunk ngay khi có, byte đầu tiên đi liền
+# ======================================================
+import csv
+from fastapi.responses import StreamingResponse
+
+EXPORT_COLUMNS = (
+    "trans_id", "plate", "slotid", "gateid",
+    "time_in", "time_out", "duration_minutes",
+    "fee", "img_in", "img_out", "payment_id",
+)
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))
+
+
+def _csv_lines(rows) -> str:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    for r in rows:
+        w.writerow([
+            v.isoformat() if isinstance(v, datetime) else ("" if v is None else v)
+            for v in (r[c] for c in EXPORT_COLUMNS)
+        ])
+    return buf.getvalue()
+
+
+def _ndjson_lines(rows) -> bytes:
+    return b"".join(orjson.dumps(dict(r), default=str) + b"\n" for r in rows)
+
+
+@app.get("/transactions/export")
+async def export_transactions(
+    format: str = Query(default="csv"),
+    gate: str | None = Query(default=None),
+    plate: str | None = Query(default=None),
+    date_from: str | None = Query(default=None),
+    date_to: str | None = Query(default=None),
+    status: str = Query(default="all"),
+):
+    fmt = format.lower()
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(400, "format phải là csv | ndjson")
+
+    # validate filter TRƯỚC khi bắt đầu stream (sau đó không đổi status code được nữa)
+    where, args = tx_filters(gate, plate, date_from, date_to, status)
+    sql = f"""
+        SELECT {", ".join(EXPORT_COLUMNS)}
+        FROM transactions
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY time_in, trans_id
+    """
+    encode = _csv_lines if fmt == "csv" else _ndjson_lines
+
+    async def stream():
+        if fmt == "csv":
+            yield ",".join(EXPORT_COLUMNS) + "\n"
+
+        async with apool().acquire() as conn:
+            async with conn.transaction():  # cursor asyncpg cần transaction
+                chunk = []
+                async for row in conn.cursor(sql, *args, prefetch=EXPORT_CHUNK_ROWS):
+                    chunk.append(row)
+                    if len(chunk) >= EXPORT_CHUNK_ROWS:
+                        yield encode(chunk)
+                        chunk = []
+                if chunk:
+                    yield encode(chunk)
+
+    media_type = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        stream(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="transactions.{fmt}"'}
+    )
+
+
+# ======================================================
+# STATS (DOANH THU + LƯU LƯỢNG) — ĐỌC TỪ ROLLUP
+# - sql/030_stats_rollup.sql: stats_hourly / stats_daily (gate × zone)
+# - entries: đếm theo time_in
+# - exits / revenue / dwell_minutes: tính theo time_out (lúc thu tiền)
+# ======================================================
+STATS_GROUPS = {
+    # group_by: (bảng rollup, cột thời gian, biểu thức key)
+    "day":  ("stats_daily",  "day",    "to_char(day, 'YYYY-MM-DD')"),
+    "hour": ("stats_hourly", "bucket", "to_char(bucket, 'YYYY-MM-DD HH24:00')"),
+    "gate": ("stats_daily",  "day",    "gateid"),
+    "zone": ("stats_daily",  "day",    "CASE WHEN zone = '' THEN '?' ELSE zone END"),
+}
+
+
+async def query_stats(group_by: str = "day", gate: str | None = None,
+                      date_from: str | None = None, date_to: str | None = None) -> dict:
+    if group_by not in STATS_GROUPS:
+        raise HTTPException(400, f"group_by phải là {' | '.join(STATS_GROUPS)}")
+    table, time_col, key_expr = STATS_GROUPS[group_by]
+
+    where, args = [], []
+    if gate and gate.upper() != "ALL":
+        args.append(gate.strip().upper())
+        where.append(f"gateid = ${len(args)}")
+
+    d_from = parse_day(date_from, "date_from")
+    d_to = parse_day(date_to, "date_to")
+    if d_from:
+        args.append(d_from.date() if table == "stats_daily" else d_from)
+        where.append(f"{time_col} >= ${len(args)}")
+    if d_to:
+        d_end = d_to + timedelta(days=1)
+        args.append(d_end.date() if table == "stats_daily" else d_end)
+        where.append(f"{time_col} < ${len(args)}")
+
+    rows = await apool().fetch(f"""
+        SELECT {key_expr} AS key,
+               SUM(entries)::bigint AS entries,
+               SUM(exits)::bigint AS exits,
+               SUM(revenue)::bigint AS revenue,
+               SUM(dwell_minutes)::bigint AS dwell_minutes
+        FROM {table}
+        {"WHERE " + " AND ".join(where) if where else ""}
+        GROUP BY 1
+        ORDER BY 1
+    """, *args)
+
+    series = [dict(r) for r in rows]
+    totals = {
+        k: sum(s[k] for s in series)
+        for k in ("entries", "exits", "revenue", "dwell_minutes")
+    }
+    return {"ok": True, "group_by": group_by, "totals": totals, "series": series}
+
+
+@app.get("/stats")
+async def stats(
+    group_by: str = Query(default="day"),
+    gate: str | None = Query(default=None),
+    date_from: str | None = Query(default=None),
+    date_to: str | None = Query(default=None),
+):
+    return await query_stats(group_by, gate, date_from, date_to)
+
+
+# ======================================================
+# REPORTS (PDF CHẠY NỀN — reports.py)
+# - POST /reports -> job_id, client poll GET /reports/{job_id}
+#   hoặc nhận WS event "report_ready", rồi tải GET /reports/{job_id}/file
+# ======================================================
+import re
+import reports
+
+REPORT_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _report_done(job_id: str, status: str):
+    broadcast({"type": "report_ready", "job_id": job_id, "status": status})
+
+
+@app.post("/reports")
+def create_report(data: dict = Body(default={})):
+    gate = (data.get("gate") or "").strip().upper()
+    gate = None if gate in ("", "ALL") else gate
+    d_from = parse_day(data.get("date_from"), "date_from")
+    d_to = parse_day(data.get("date_to"), "date_to")
+
+    job_id = reports.submit_report(
+        r, gate,
+        d_from.date() if d_from else None,
+        d_to.date() if d_to else None,
+        on_done=_report_done
+    )
+    return {"ok": True, "job_id": job_id, "status": "queued"}
+
+
+def _get_report_job(job_id: str) -> dict:
+    if not REPORT_ID_RE.match(job_id):
+        raise HTTPException(400, "job_id không hợp lệ")
+    job = reports.get_job(r, job_id)
+    if not job:
+        raise HTTPException(404, "Report không tồn tại hoặc đã hết hạn")
+    return job
+
+
+@app.get("/reports/{job_id}")
+def report_status(job_id: str):
+    job = _get_report_job(job_id)
+    return {"ok": True, "job_id": job_id, **job}
+
+
+@app.get("/reports/{job_id}/file")
+def report_file(job_id: str):
+    job = _get_report_job(job_id)
+    path = reports.report_path(job_id)
+    if job.get("status") != "done":
+        raise HTTPException(409, f"Report chưa xong (status={job.get('status')})")
+    if not os.path.exists(path):
+        # REPORT_DIR không dùng chung giữa các worker / replica (xem reports.py)
+        raise HTTPException(404, "File report không có trên worker này")
+    return FileResponse(path, media_type="application/pdf", filename="parking_report.pdf")
 
 
 @app.get("/slot_info/{slotid}")
 def slot_info(slotid: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT v.*, t.img_in, t.img_out
-        FROM vehicles v
-        LEFT JOIN transactions t ON t.plate = v.plate AND t.time_out IS NULL
-        WHERE v.slotid=%s AND v.time_out IS NULL
-        ORDER BY v.time_in DESC LIMIT 1
-    """, (slotid,))
-    
-    row = cur.fetchone()
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT v.*, t.img_in, t.img_out
+            FROM open_stays o
+            JOIN vehicles v ON v.id = o.vehicle_id AND v.time_in = o.vehicle_time_in
+            LEFT JOIN transactions t ON t.trans_id = o.trans_id AND t.time_in = o.trans_time_in
+            WHERE o.slotid=%s
+            ORDER BY o.vehicle_time_in DESC LIMIT 1
+        """, (slotid,))
+        row = cur.fetchone()
 
     return {"info": row}
 
-@app.get("/suggest_slot/{gateid}")
-def suggest_slot(gateid: str):
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+def load_slot_index():
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT gateid, x, y FROM gates")
+        gates = cur.fetchall()
+        cur.execute("SELECT slotid, x, y, occupied FROM slots")
+        slots = cur.fetchall()
 
-    cur.execute("SELECT x, y FROM gates WHERE gateid=%s", (gateid,))
-    gate = cur.fetchone()
-    if not gate:
-        conn.close()
-        raise HTTPException(404, "Gate không tồn tại")
+    SLOT_INDEX.load(gates, slots)
 
-    gx, gy = gate["x"], gate["y"]
 
-    cur.execute("""
-        SELECT slotid, x, y
-        FROM slots
-        WHERE occupied=false
-          AND x IS NOT NULL
-          AND y IS NOT NULL
-    """)
-    slots = cur.fetchall()
-    conn.close()
+# ======================================================
+# FREE SLOT POOL (slot_pool.py) — Redis ZSET theo gate
+# ======================================================
+def rebuild_free_pool():
+    """Đọc lại DB -> SLOT_INDEX -> ghi free:{gate} (bỏ qua slot vừa được mark trong lúc đọc DB)."""
+    gens = FREE_POOL_REBUILD.snapshot_gens()
+    load_slot_index()
+    FREE_POOL_REBUILD.rebuild(gens, SLOT_INDEX.free_by_gate())
 
-    if not slots:
-        return {"slot": None, "distance": None}
 
-    def dist(s):
-        return math.sqrt(
-            (s["x"] - gx) ** 2 +
-            (s["y"] - gy) ** 2
-        )
+async def free_pool_reconciler():
+    # sửa lệch giữa Redis và Postgres (ghi ZSET lỗi, worker khác, sửa tay DB...)
+    while True:
+        await asyncio.sleep(FREE_POOL_RECONCILE_SEC)
+        try:
+            await asyncio.to_thread(rebuild_free_pool)
+        except Exception as e:
+            print("[free_pool] reconcile error:", e)
+
+
+async def free_pool_mark(changes: list):
+    """changes: [(slotid, occupied), ...] sau khi DB commit."""
+    try:
+        pipe = ar.pipeline(transaction=False)
+        for slotid, occupied in changes:
+            queue_mark(pipe, slotid, occupied, SLOT_INDEX.distances(slotid))
+        await pipe.execute()
+    except:
+        pass
+
+
+@app.post("/allocate_slot/{gateid}")
+async def allocate_slot(gateid: str, data: dict = Body(default={})):
+    """Cấp slot trống gần gate nhất và giữ luôn cho gate (reserve:{slot}, ttl giây)."""
+    gateid = gateid.strip().upper()
+    ttl = int(data.get("ttl", 15))
 
-    best = min(slots, key=dist)
+    best = await FREE_POOL.allocate(gateid, ttl * 1000)
+    if not best:
+        return {"ok": True, "slot": None, "distance": None, "gate": gateid}
+
+    slotid, dist = best
+    return {"ok": True, "slot": slotid, "distance": round(dist, 2), "gate": gateid, "ttl": ttl}
+
+
+@app.get("/suggest_slot/{gateid}")
+def suggest_slot(gateid: str):
+    # đọc từ SLOT_INDEX; chỉ đụng DB khi index cũ / gate mới
+    if SLOT_INDEX.stale() or not SLOT_INDEX.has_gate(gateid):
+        load_slot_index()
+    if not SLOT_INDEX.has_gate(gateid):
+        raise HTTPException(404, "Gate không tồn tại")
+
+    best = SLOT_INDEX.nearest(gateid)
+    if not best:
+        return {"slot": None, "distance": None}
 
+    slotid, dist = best
     return {
-        "slot": best["slotid"],
-        "distance": round(dist(best), 2),
+        "slot": slotid,
+        "distance": round(dist, 2),
         "gate": gateid
     }
 
 
+async def load_slot_rows() -> tuple[list, int]:
+    """(slots, head seq) trong cùng 1 snapshot: mọi thay đổi <= seq đã có trong slots."""
+    async with apool().acquire() as conn:
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            seq = await conn.fetchval("SELECT seq FROM slot_change_head WHERE id = 1") or 0
+            rows = await conn.fetch("""
+                SELECT slotid, zone, x, y, occupied, plate, version, change_seq
+                FROM slots
+                ORDER BY slotid
+            """)
+    return [dict(r) for r in rows], seq
+
+
 @app.get("/slots/map")
-def get_slots_map():
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+async def get_slots_map(request: Request):
+    # body serialize sẵn trong SLOT_MAP; gate gửi If-None-Match => 304 khi không đổi
+    # X-Slot-Seq (cả khi 304) = head seq của snapshot: gate lấy làm since cho /slots/changes
+    # (max change_seq trên slots bỏ qua tombstone => since có thể kẹt dưới floor)
+    body, etag, seq = await SLOT_MAP.get(load_slot_rows)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "X-Slot-Seq": str(seq)}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
-    cur.execute("""
-        SELECT slotid, zone, x, y, occupied, plate, version
-        FROM slots
-        ORDER BY slotid
-    """)
-    rows = cur.fetchall()
-    conn.close()
 
-    return {"slots": rows}
+# ======================================================
+# SLOT CHANGE FEED (sql/040_slot_changes.sql)
+# - gate gửi since = change_seq lớn nhất đã áp dụng
+# - resync=True: gate phải tải lại /slots/map (since quá cũ / DB bị reset)
+# - change_seq cấp theo thứ tự commit (sql/080_slot_change_commit_order.sql):
+#   head + rows đọc trong cùng 1 snapshot => mọi seq <= head đã commit, không bỏ sót
+# ======================================================
+SLOT_CHANGES_LIMIT = int(os.getenv("SLOT_CHANGES_LIMIT", "1000"))
+SLOT_TOMBSTONE_KEEP_DAYS = int(os.getenv("SLOT_TOMBSTONE_KEEP_DAYS", "7"))
 
 
+@app.get("/slots/changes")
+async def slot_changes(
+    since: int = Query(..., ge=0),
+    limit: int = Query(SLOT_CHANGES_LIMIT, ge=1, le=SLOT_CHANGES_LIMIT),
+):
+    async with apool().acquire() as conn:
+        async with conn.transaction(isolation="repeatable_read", readonly=True):
+            head = await conn.fetchval("SELECT seq FROM slot_change_head WHERE id = 1") or 0
+            floor = await conn.fetchval("SELECT floor_seq FROM slot_change_floor WHERE id = 1") or 0
+
+            if since < floor or since > head:
+                return {"ok": True, "resync": True, "seq": head}
+
+            rows = await conn.fetch("""
+                SELECT slotid, zone, x, y, occupied, plate, version, change_seq, FALSE AS deleted
+                FROM slots WHERE change_seq > $1
+                UNION ALL
+                SELECT slotid, NULL, NULL, NULL, NULL, NULL, NULL, change_seq, TRUE
+                FROM slot_tombstones WHERE change_seq > $1
+                ORDER BY change_seq
+                LIMIT $2
+            """, since, limit)
+
+    changes, deleted = [], []
+    for r in rows:
+        if r["deleted"]:
+            deleted.append(r["slotid"])
+        else:
+            item = dict(r)
+            item.pop("deleted")
+            changes.append(item)
+
+    return {
+        "ok": True,
+        "resync": False,
+        "changes": changes,
+        "deleted": deleted,
+        "seq": rows[-1]["change_seq"] if rows else since,
+        "more": len(rows) == limit,
+    }
 
-@app.get("/slots")
-def get_slots(gate_id: str = Query(...)):
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
 
-    cur.execute("SELECT x, y FROM gates WHERE gateid=%s", (gate_id,))
-    gate = cur.fetchone()
-    gx, gy = gate["x"], gate["y"]
 
-    cur.execute("""
-        SELECT slotid, zone, x, y, occupied, plate, version
-        FROM slots
-    """)
-    slots = cur.fetchall()
-    conn.close()
+@app.get("/slots")
+async def get_slots(gate_id: str = Query(...)):
+    # thứ tự theo khoảng cách: SLOT_INDEX (tính sẵn); occupied/plate: SLOT_MAP (hiện tại)
+    if SLOT_INDEX.stale() or not SLOT_INDEX.has_gate(gate_id):
+        await asyncio.to_thread(load_slot_index)
+    if not SLOT_INDEX.has_gate(gate_id):
+        raise HTTPException(404, "Gate không tồn tại")
+
+    rows = await SLOT_MAP.rows(load_slot_rows)
+    by_id = {s["slotid"]: s for s in rows}
 
     result = []
-    for s in slots:
-        dist = math.sqrt((s["x"] - gx)**2 + (s["y"] - gy)**2)
+    for dist, slotid in SLOT_INDEX.order(gate_id):
+        s = by_id.get(slotid)
+        if s is None:
+            continue   # slot vừa bị xóa, index chưa build lại
 
         result.append({
             "slotid": s["slotid"],
@@ -703,24 +1238,10 @@ def get_slots(gate_id: str = Query(...)):
             "distance": round(dist, 2)
         })
 
-    result.sort(key=lambda x: x["distance"])
     return {"slots": result}
 
 from fastapi import Header, HTTPException
 from fastapi import Depends
-import psycopg2
-from psycopg2.extras import RealDictCursor
-
-def get_db():
-    conn = psycopg2.connect(
-        host="postgres",
-        dbname="parking",
-        user="admin",
-        password="admin",
-        port=5432
-    )
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    return conn, cur
 
 def admin_auth(authorization: str = Header(None)):
     if authorization != "Bearer secret-key":
@@ -730,99 +1251,101 @@ def admin_auth(authorization: str = Header(None)):
     
 @app.put("/admin/slots/{slotid}")
 def admin_update_slot(slotid: str, data: dict, user=Depends(admin_auth)):
-    conn, cur = get_db()
-
-    cur.execute("""
-        UPDATE slots
-        SET x=%s, y=%s, zone=%s
-        WHERE slotid=%s
-    """, (data["x"], data["y"], data["zone"], slotid))
-
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE slots
+            SET x=%s, y=%s, zone=%s
+            WHERE slotid=%s
+        """, (data["x"], data["y"], data["zone"], slotid))
+        conn.commit()
 
+    SLOT_MAP.invalidate()
+    SLOT_INDEX.invalidate()
+    publish_internal({"type": "slots_changed"})
+    try:
+        rebuild_free_pool()
+    except Exception as e:
+        print("[free_pool] rebuild error:", e)
     return {"ok": True}
 
 
 
 @app.post("/admin/slots")
 def admin_add_slot(slot: dict, user=Depends(admin_auth)):
-    conn, cur = get_db()   # ⭐ BẮT BUỘC
-
-    cur.execute("""
-        INSERT INTO slots(slotid, zone, x, y, occupied)
-        VALUES (%s, %s, %s, %s, false)
-    """, (slot["slotid"], slot["zone"], slot["x"], slot["y"]))
-
-    conn.commit()
-    cur.close()
-    conn.close()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO slots(slotid, zone, x, y, occupied)
+            VALUES (%s, %s, %s, %s, false)
+        """, (slot["slotid"], slot["zone"], slot["x"], slot["y"]))
+        conn.commit()
 
+    SLOT_MAP.invalidate()
+    SLOT_INDEX.invalidate()
+    publish_internal({"type": "slots_changed"})
+    try:
+        rebuild_free_pool()
+    except Exception as e:
+        print("[free_pool] rebuild error:", e)
     return {"ok": True}
 
 
 @app.delete("/admin/slots/{slotid}")
 def admin_delete_slot(slotid: str, user=Depends(admin_auth)):
-    conn, cur = get_db()
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT occupied FROM slots WHERE slotid=%s", (slotid,))
+        row = cur.fetchone()
 
-    cur.execute("SELECT occupied FROM slots WHERE slotid=%s", (slotid,))
-    row = cur.fetchone()
+        if row and row["occupied"]:
+            raise HTTPException(409, "Slot đang có xe")
 
-    if row and row["occupied"]:
-        cur.close()
-        conn.close()
-        raise HTTPException(409, "Slot đang có xe")
-
-    cur.execute("DELETE FROM slots WHERE slotid=%s", (slotid,))
-    conn.commit()
-
-    cur.close()
-    conn.close()
+        cur.execute("DELETE FROM slots WHERE slotid=%s", (slotid,))
+        conn.commit()
 
+    SLOT_MAP.invalidate()
+    SLOT_INDEX.invalidate()
+    publish_internal({"type": "slots_changed"})
+    try:
+        rebuild_free_pool()
+    except Exception as e:
+        print("[free_pool] rebuild error:", e)
     return {"ok": True}
 
 @app.get("/fee")
-def fee(plate: str = Query(...), gate: str = Query(default="")):
+async def fee(plate: str = Query(...), gate: str = Query(default="")):
     plate = plate.strip().upper()
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
-        cur.execute("""
-            SELECT trans_id, time_in, slotid, gateid
-            FROM transactions
-            WHERE plate=%s AND time_out IS NULL
-            ORDER BY time_in DESC
-            LIMIT 1
-        """, (plate,))
-        t = cur.fetchone()
-        if not t:
-            raise HTTPException(404, "Không tìm thấy xe đang trong bãi")
-
-        time_in = t["time_in"]
-        if getattr(time_in, "tzinfo", None) is None:
-            time_in = TZ.localize(time_in)
-
-        time_out = datetime.now(TZ)
-        fee_value, duration_minutes = calc_fee(time_in, time_out)
-
-        hours = max(1, (duration_minutes + 59) // 60)
-        duration_text = f"{hours} giờ ({duration_minutes} phút)"
+    t = await apool().fetchrow("""
+        SELECT trans_id, trans_time_in AS time_in, slotid, trans_gate AS gateid
+        FROM open_stays
+        WHERE plate=$1 AND trans_id IS NOT NULL
+    """, plate)
+    if not t:
+        raise HTTPException(404, "Không tìm thấy xe đang trong bãi")
 
-        return {
-            "ok": True,
-            "plate": plate,
-            "slot": t["slotid"],
-            "gate": t["gateid"],
-            "time_in": time_in.isoformat(),
-            "time_out": time_out.isoformat(),
-            "duration_minutes": duration_minutes,
-            "duration_text": duration_text,
-            "amount": fee_value,
-            "trans_id": t["trans_id"]
-        }
-    finally:
-        conn.close()
+    time_in = t["time_in"]
+    if getattr(time_in, "tzinfo", None) is None:
+        time_in = TZ.localize(time_in)
+
+    time_out = datetime.now(TZ)
+    fee_value, duration_minutes = calc_fee(time_in, time_out)
+
+    hours = max(1, (duration_minutes + 59) // 60)
+    duration_text = f"{hours} giờ ({duration_minutes} phút)"
+
+    return {
+        "ok": True,
+        "plate": plate,
+        "slot": t["slotid"],
+        "gate": t["gateid"],
+        "time_in": time_in.isoformat(),
+        "time_out": time_out.isoformat(),
+        "duration_minutes": duration_minutes,
+        "duration_text": duration_text,
+        "amount": fee_value,
+        "trans_id": t["trans_id"]
+    }
 
 
 import io
@@ -863,16 +1386,13 @@ def payment_vietqr_create(data: dict = Body(...)):
     transfer_content = f"PARK-{payment_id[:8].upper()}"
 
     # lưu payment PENDING
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
+    with db_conn() as conn:
+        cur = conn.cursor()
         cur.execute("""
             INSERT INTO payments(payment_id, plate, gateid, amount, method, status, transfer_content)
             VALUES (%s::uuid, %s, %s, %s, 'vietqr', 'PENDING', %s)
         """, (payment_id, plate, gate, amount, transfer_content))
         conn.commit()
-    finally:
-        conn.close()
 
     vietqr_url = make_vietqr_url(
         BANK_INFO["bank_code"],
@@ -923,9 +1443,8 @@ def payment_manual_create(data: dict = Body(...)):
     pid_str = str(uuid.uuid4())          # ✅ string
     transfer_content = f"PARK-{pid_str[:8].upper()}"
 
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
+    with db_conn() as conn:
+        cur = conn.cursor()
         cur.execute("""
             INSERT INTO payments(payment_id, plate, gateid, amount, method, status, transfer_content)
             VALUES (%s::uuid, %s, %s, %s, 'online_manual', 'PENDING', %s)
@@ -939,8 +1458,6 @@ def payment_manual_create(data: dict = Body(...)):
             "transfer_content": transfer_content,
             "status": "PENDING"
         }
-    finally:
-        conn.close()
 
 @app.post("/payments/manual/confirm")
 def payment_manual_confirm(data: dict = Body(...)):
@@ -949,9 +1466,8 @@ def payment_manual_confirm(data: dict = Body(...)):
     if not pid_str:
         raise HTTPException(400, "missing payment_id")
 
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
+    with db_conn() as conn:
+        cur = conn.cursor()
         cur.execute("""
             UPDATE payments
             SET status='PAID',
@@ -962,8 +1478,6 @@ def payment_manual_confirm(data: dict = Body(...)):
             raise HTTPException(404, "payment not found")
         conn.commit()
         return {"ok": True, "payment_id": pid_str, "status": "PAID"}
-    finally:
-        conn.close()
 
 @app.post("/payments/cash/confirm")
 def payment_cash_confirm(data: dict = Body(...)):
@@ -975,9 +1489,8 @@ def payment_cash_confirm(data: dict = Body(...)):
 
     pid_str = str(uuid.uuid4())
 
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
+    with db_conn() as conn:
+        cur = conn.cursor()
         cur.execute("""
             INSERT INTO payments(payment_id, plate, gateid, amount, method, status, paid_at)
             VALUES (%s::uuid, %s, %s, %s, 'cash', 'PAID',
@@ -985,8 +1498,6 @@ def payment_cash_confirm(data: dict = Body(...)):
         """, (pid_str, plate, gate, amount))
         conn.commit()
         return {"ok": True, "payment_id": pid_str, "status": "PAID"}
-    finally:
-        conn.close()
 
 from fastapi.responses import JSONResponse
 
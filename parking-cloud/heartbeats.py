@@ -0,0 +1,203 @@
+# heartbeats.py — GATE ONLINE/OFFLINE BẰNG KEY REDIS CÓ TTL
+# ==========================================================
+# - Mỗi heartbeat (WS 4s/gate hoặc POST /heartbeat) = 1 lệnh Redis:
+#     SET gate:alive:{gate} <giờ VN> EX GATE_ONLINE_SEC GET
+#   GET trả về nil => gate vừa online (chỉ đúng 1 worker thấy) -> on_change(gate, True)
+# - Key hết hạn => gate offline: Redis bắn keyspace event `expired`
+#   (cần notify-keyspace-events Ex, docker-compose.yml đã bật) -> expiry_loop()
+# - /gates đọc online từ các key này (MGET), không cần Postgres
+# - gates.last_sync vẫn ghi, nhưng gom theo lô mỗi HEARTBEAT_FLUSH_SEC (flush_loop)
+# ==========================================================
+
+import os
+import asyncio
+import threading
+from datetime import datetime
+
+import pytz
+import redis
+import redis.asyncio as aioredis
+
+from db_async import apool
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+HEARTBEAT_FLUSH_SEC = float(os.getenv("HEARTBEAT_FLUSH_SEC", "5"))
+GATE_ONLINE_SEC = int(os.getenv("GATE_ONLINE_SEC", "60"))
+
+GATE_ALIVE_PREFIX = "gate:alive:"
+
+TZ = pytz.timezone("Asia/Ho_Chi_Minh")
+
+_r = None
+_ar = None
+
+
+def _sync_redis():
+    global _r
+    if _r is None:
+        _r = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    return _r
+
+
+def _async_redis():
+    global _ar
+    if _ar is None:
+        _ar = aioredis.from_url(REDIS_URL, decode_responses=True)
+    return _ar
+
+
+def alive_key(gateid: str) -> str:
+    return f"{GATE_ALIVE_PREFIX}{gateid}"
+
+
+class HeartbeatTracker:
+    def __init__(self, online_sec: int):
+        self.online_sec = online_sec
+        self.on_change = None      # on_change(gateid, online) — gates_api.py gán lúc startup
+
+        self._lock = threading.Lock()   # POST /heartbeat chạy trong threadpool
+        self._pending = {}    # gateid -> last_sync (giờ VN, naive) chưa ghi DB
+
+        self.beats = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.expired = 0
+
+    def _stamp(self, gateid: str) -> datetime:
+        now_vn = datetime.now(TZ).replace(tzinfo=None)
+        with self._lock:
+            self._pending[gateid] = now_vn
+            self.beats += 1
+        return now_vn
+
+    def notify(self, gateid: str, online: bool) -> None:
+        if self.on_change:
+            try:
+                self.on_change(gateid, online)
+            except Exception as e:
+                print("[heartbeat] on_change error:", e)
+
+    def beat(self, gateid: str) -> None:
+        """Endpoint sync."""
+        now_vn = self._stamp(gateid)
+        prev = _sync_redis().set(alive_key(gateid), now_vn.isoformat(), ex=self.online_sec, get=True)
+        if prev is None:
+            self.notify(gateid, True)
+
+    async def abeat(self, gateid: str) -> None:
+        """WS handler / endpoint async."""
+        now_vn = self._stamp(gateid)
+        prev = await _async_redis().set(alive_key(gateid), now_vn.isoformat(), ex=self.online_sec, get=True)
+        if prev is None:
+            self.notify(gateid, True)
+
+    def take_pending(self) -> dict:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+    def requeue(self, pending: dict) -> None:
+        with self._lock:
+            for g, ts in pending.items():
+                self._pending.setdefault(g, ts)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "beats": self.beats,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "expired": self.expired,
+        }
+
+
+HEARTBEATS = HeartbeatTracker(GATE_ONLINE_SEC)
+
+
+async def alive_map(gateids: list) -> dict:
+    """{gateid: lần beat cuối (iso, giờ VN) hoặc None nếu offline} — 1 MGET."""
+    if not gateids:
+        return {}
+    values = await _async_redis().mget([alive_key(g) for g in gateids])
+    return dict(zip(gateids, values))
+
+
+# ======================================================
+# FLUSH last_sync THEO LÔ
+# ======================================================
+async def flush_once() -> int:
+    pending = HEARTBEATS.take_pending()
+    if not pending:
+        return 0
+
+    gateids = list(pending)
+    stamps = [pending[g] for g in gateids]
+    try:
+        await apool().execute("""
+            UPDATE gates g
+            SET last_sync = v.ts
+            FROM unnest($1::text[], $2::timestamp[]) AS v(gateid, ts)
+            WHERE g.gateid = v.gateid
+              AND (g.last_sync IS NULL OR g.last_sync < v.ts)
+        """, gateids, stamps)
+    except Exception as e:
+        # trả lại để lần sau ghi (giữ mốc mới hơn nếu gate đã beat tiếp)
+        HEARTBEATS.requeue(pending)
+        print("[heartbeat] flush error:", e)
+        return 0
+
+    HEARTBEATS.flushes += 1
+    HEARTBEATS.rows_written += len(gateids)
+    return len(gateids)
+
+
+async def flush_loop():
+    while True:
+        await asyncio.sleep(HEARTBEAT_FLUSH_SEC)
+        await flush_once()
+
+
+# ======================================================
+# OFFLINE: KEYSPACE EVENT `expired`
+# ======================================================
+async def enable_expiry_events() -> bool:
+    """Bật thêm cờ E + x nếu Redis chưa bật (Redis managed có thể cấm CONFIG)."""
+    try:
+        ar = _async_redis()
+        flags = (await ar.config_get("notify-keyspace-events")).get("notify-keyspace-events", "")
+        missing = "".join(c for c in "Ex" if c not in flags and not (c == "x" and "A" in flags))
+        if missing:
+            await ar.config_set("notify-keyspace-events", flags + missing)
+        return True
+    except Exception as e:
+        print("[heartbeat] không bật được keyspace events:", e)
+        return False
+
+
+async def expiry_loop(on_offline):
+    """
+    on_offline(gateid): mỗi worker đều nhận event này => chỉ gửi cho gate LOCAL,
+    không publish lại (tránh trùng).
+    """
+    while True:
+        pubsub = _async_redis().pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.psubscribe("__keyevent@*__:expired")
+            async for msg in pubsub.listen():
+                key = msg.get("data")
+                if isinstance(key, str) and key.startswith(GATE_ALIVE_PREFIX):
+                    HEARTBEATS.expired += 1
+                    try:
+                        await on_offline(key[len(GATE_ALIVE_PREFIX):])
+                    except Exception as e:
+                        print("[heartbeat] on_offline error:", e)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("[heartbeat] expiry subscribe error, retry in 1s:", e)
+            await asyncio.sleep(1)
+        finally:
+            try:
+                await pubsub.close()
+            except Exception:
+                pass
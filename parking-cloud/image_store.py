@@ -0,0 +1,196 @@
+# image_store.py — KHO ẢNH THEO NỘI DUNG (SHA-256), CHIA THƯ MỤC CON
+# ==========================================================
+# - Ảnh lưu ở images/cas/ab/cd/<sha256>.jpg (ab, cd = 4 ký tự hex đầu)
+#   => 65536 thư mục, mỗi thư mục ít file kể cả khi có hàng triệu ảnh
+# - Cùng nội dung = cùng path: upload trùng (gate gửi lại khi replay) không tốn thêm disk,
+#   2 ảnh cùng biển số cùng giây không còn ghi đè nhau
+# - Handshake: gate hỏi POST /upload_image/check {sha256} trước, có rồi thì không gửi byte nào
+# - Upload: parse multipart thẳng từ request.stream() (không để Starlette spool cả body ra file tạm),
+#   băm trong lúc ghi, gom UPLOAD_CHUNK byte rồi mới ghi (I/O disk trong thread);
+#   Content-Length quá lớn => 413 trước khi đọc byte nào, không có header thì đếm byte khi nhận
+#   => quá UPLOAD_MAX_BYTES là 413 ngay; file tạm + os.replace => không có ảnh ghi dở
+# - Ảnh cũ (images/in, images/out) giữ nguyên, /view_image vẫn đọc được
+# ==========================================================
+
+import os
+import re
+import uuid
+import asyncio
+import hashlib
+
+from fastapi import HTTPException, Request
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+    from python_multipart.exceptions import MultipartParseError
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+    from multipart.exceptions import MultipartParseError
+
+IMAGE_ROOT = "images"
+CAS_DIR = os.path.join(IMAGE_ROOT, "cas")
+CAS_TMP_DIR = os.path.join(CAS_DIR, "tmp")
+
+UPLOAD_CHUNK = int(os.getenv("UPLOAD_CHUNK", str(64 * 1024)))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+UPLOAD_FORM_SLACK = 64 * 1024   # boundary + header part + field plate / gate / sha256
+UPLOAD_FIELD_MAX = 1024
+
+_SHA_RE = re.compile(r"^[0-9a-f]{64}$")
+
+IMAGE_STATS = {"stored": 0, "dedup": 0, "check_hits": 0, "check_misses": 0, "bytes": 0}
+
+os.makedirs(CAS_TMP_DIR, exist_ok=True)
+
+
+def normalize_sha(sha: str | None) -> str | None:
+    sha = (sha or "").strip().lower()
+    return sha if _SHA_RE.match(sha) else None
+
+
+def cas_path(sha: str) -> str:
+    return f"{IMAGE_ROOT}/cas/{sha[:2]}/{sha[2:4]}/{sha}.jpg"
+
+
+async def lookup(sha: str) -> str | None:
+    """Path ảnh nếu đã có trong kho."""
+    path = cas_path(sha)
+    found = await asyncio.to_thread(os.path.exists, path)
+    IMAGE_STATS["check_hits" if found else "check_misses"] += 1
+    return path if found else None
+
+
+def _discard(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _commit(tmp: str, path: str) -> bool:
+    """Đưa file tạm vào kho. False nếu nội dung này đã có (bỏ file tạm)."""
+    if os.path.exists(path):
+        _discard(tmp)
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp, path)
+    return True
+
+
+def _too_large():
+    return HTTPException(413, f"Ảnh vượt quá {UPLOAD_MAX_BYTES // (1024 * 1024)} MB")
+
+
+def _part_name(headers: dict) -> str:
+    _, params = parse_options_header(headers.get(b"content-disposition"))
+    return params.get(b"name", b"").decode("utf-8", "replace")
+
+
+async def store_upload(request: Request, required: tuple = (), file_field: str = "file") -> dict:
+    """
+    Đọc multipart từ request.stream(), ghi part `file_field` vào kho theo từng chunk.
+    Thiếu field trong `required` => 422, file tạm bị bỏ (không vào kho).
+    Trả về {path, sha256, size, dedup, fields} (fields: các field text, vd plate / gate / sha256).
+    """
+    limit = UPLOAD_MAX_BYTES + UPLOAD_FORM_SLACK
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > limit:
+        raise _too_large()
+
+    ctype, params = parse_options_header(request.headers.get("content-type"))
+    boundary = params.get(b"boundary")
+    if ctype != b"multipart/form-data" or not boundary:
+        raise HTTPException(400, "Cần multipart/form-data")
+
+    # parser gọi callback đồng bộ => chỉ ghi lại sự kiện, xử lý (await) sau mỗi lần write
+    # (header field / value có thể bị cắt giữa 2 chunk => gom đến on_header_end)
+    events = []
+    headers = {}
+    hfield = bytearray()
+    hvalue = bytearray()
+
+    def on_header_end():
+        headers[bytes(hfield).lower()] = bytes(hvalue)
+        hfield.clear()
+        hvalue.clear()
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": headers.clear,
+        "on_header_field": lambda data, start, end: hfield.extend(data[start:end]),
+        "on_header_value": lambda data, start, end: hvalue.extend(data[start:end]),
+        "on_header_end": on_header_end,
+        "on_headers_finished": lambda: events.append(("begin", _part_name(headers))),
+        "on_part_data": lambda data, start, end: events.append(("data", data[start:end])),
+        "on_part_end": lambda: events.append(("end", None)),
+    })
+
+    tmp = os.path.join(CAS_TMP_DIR, f"{uuid.uuid4().hex}.tmp")
+    h = hashlib.sha256()
+    size = 0
+    received = 0
+    fields = {}
+    current = None
+    buf = bytearray()
+    seen_file = False
+    f = await asyncio.to_thread(open, tmp, "wb")
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > limit:
+                raise _too_large()
+            try:
+                parser.write(chunk)
+            except MultipartParseError:
+                raise HTTPException(400, "multipart không hợp lệ")
+
+            for kind, value in events:
+                if kind == "begin":
+                    current = value
+                    if current == file_field:
+                        seen_file = True
+                    else:
+                        fields[current] = b""
+                elif kind == "data" and current == file_field:
+                    size += len(value)
+                    if size > UPLOAD_MAX_BYTES:
+                        raise _too_large()
+                    h.update(value)
+                    buf += value
+                    if len(buf) >= UPLOAD_CHUNK:
+                        await asyncio.to_thread(f.write, bytes(buf))
+                        buf.clear()
+                elif kind == "data":
+                    fields[current] += value
+                    if len(fields[current]) > UPLOAD_FIELD_MAX:
+                        raise HTTPException(400, f"Field {current} quá dài")
+                elif kind == "end":
+                    current = None
+            events.clear()
+
+        parser.finalize()
+        if not seen_file:
+            raise HTTPException(422, f"Thiếu file ({file_field})")
+        if buf:
+            await asyncio.to_thread(f.write, bytes(buf))
+        await asyncio.to_thread(f.close)
+
+        fields = {k: v.decode("utf-8", "replace") for k, v in fields.items()}
+        missing = [k for k in required if not fields.get(k)]
+        if missing:
+            raise HTTPException(422, "Thiếu field: " + ", ".join(missing))
+        sha = h.hexdigest()
+        expected_sha = normalize_sha(fields.get("sha256"))
+        if expected_sha and expected_sha != sha:
+            raise HTTPException(400, "sha256 không khớp nội dung ảnh")
+
+        path = cas_path(sha)
+        created = await asyncio.to_thread(_commit, tmp, path)
+    except BaseException:
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(_discard, tmp)
+        raise
+
+    IMAGE_STATS["stored" if created else "dedup"] += 1
+    if created:
+        IMAGE_STATS["bytes"] += size
+    return {"path": path, "sha256": sha, "size": size, "dedup": not created, "fields": fields}
@@ -0,0 +1,192 @@
+# partitions.py — PARTITION THÁNG CHO transactions / vehicles (sql/070_history_partitions.sql)
+# ==========================================================
+# - maintenance_loop(): chạy trong Cloud, tạo trước PARTITION_AHEAD_MONTHS tháng
+#   (+ lưu trữ tự động nếu HISTORY_ARCHIVE_AUTO=1)
+# - Lưu trữ 1 partition đã cũ (cận trên <= đầu tháng hiện tại - HISTORY_KEEP_MONTHS):
+#     1) COPY -> HISTORY_ARCHIVE_DIR/<partition>.csv.gz (file tạm + os.replace)
+#     2) transaction ngắn: DETACH, đếm lại số dòng (khác lúc COPY => hủy), DROP
+#   partition còn xe / transaction mở (time_out NULL) thì bỏ qua
+#   python partitions.py list
+#   python partitions.py ensure
+#   python partitions.py archive [--keep-months 12]
+# ==========================================================
+
+import os
+import gzip
+import asyncio
+import argparse
+from datetime import datetime
+
+import pytz
+from psycopg2 import sql
+
+from db_pool import db_conn
+
+PARTITIONED_TABLES = ("transactions", "vehicles")
+PARTITION_AHEAD_MONTHS = int(os.getenv("PARTITION_AHEAD_MONTHS", "3"))
+PARTITION_CHECK_SEC = float(os.getenv("PARTITION_CHECK_SEC", str(6 * 3600)))
+HISTORY_KEEP_MONTHS = int(os.getenv("HISTORY_KEEP_MONTHS", "12"))
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "archive")
+HISTORY_ARCHIVE_AUTO = os.getenv("HISTORY_ARCHIVE_AUTO", "0") == "1"
+
+TZ = pytz.timezone("Asia/Ho_Chi_Minh")
+
+
+def archive_cutoff(keep_months: int) -> datetime:
+    """Đầu tháng hiện tại (giờ VN) lùi keep_months tháng."""
+    now = datetime.now(TZ).replace(tzinfo=None)
+    months = now.year * 12 + (now.month - 1) - keep_months
+    return datetime(months // 12, months % 12 + 1, 1)
+
+
+# ======================================================
+# TẠO PARTITION TƯƠNG LAI
+# ======================================================
+async def ensure_all(pool) -> int:
+    created = 0
+    for table in PARTITIONED_TABLES:
+        created += await pool.fetchval(
+            "SELECT history_ensure_partitions($1, $2)", table, PARTITION_AHEAD_MONTHS
+        )
+    return created
+
+
+async def maintenance_loop(pool):
+    while True:
+        try:
+            n = await ensure_all(pool)
+            if n:
+                print(f"[partitions] tạo {n} partition mới")
+            if HISTORY_ARCHIVE_AUTO:
+                await asyncio.to_thread(archive_old, HISTORY_KEEP_MONTHS)
+        except Exception as e:
+            print("[partitions] maintenance error:", e)
+        await asyncio.sleep(PARTITION_CHECK_SEC)
+
+
+# ======================================================
+# LƯU TRỮ PARTITION CŨ
+# ======================================================
+def list_partitions(table: str) -> list:
+    with db_conn() as conn:
+        with conn:
+            cur = conn.cursor()
+            cur.execute("SELECT * FROM history_partitions(%s)", (table,))
+            return cur.fetchall()
+
+
+def _export(conn, part: str, tmp: str):
+    """COPY partition ra tmp (.csv.gz). Trả về {n, open}, None nếu còn dòng đang mở."""
+    ident = sql.Identifier(part)
+    with conn:
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cur.execute(sql.SQL(
+            "SELECT count(*) AS n, count(*) FILTER (WHERE time_out IS NULL) AS open FROM {}"
+        ).format(ident))
+        row = cur.fetchone()
+        if row["open"]:
+            print(f"[partitions] bỏ qua {part}: còn {row['open']} dòng chưa có time_out")
+            return None
+
+        with open(tmp, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+                cur.copy_expert(
+                    sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(ident).as_string(conn),
+                    gz,
+                )
+            raw.flush()
+            os.fsync(raw.fileno())
+    return row
+
+
+def archive_partition(table: str, part: str, out_dir: str = HISTORY_ARCHIVE_DIR) -> str | None:
+    """Trả về đường dẫn file .csv.gz, None nếu bỏ qua (còn dòng đang mở)."""
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"{part}.csv.gz")
+    tmp = path + ".tmp"
+    ident = sql.Identifier(part)
+
+    with db_conn() as conn:
+        # 1) đếm + COPY trong cùng 1 snapshot; lỗi giữa chừng => xóa file tạm
+        try:
+            row = _export(conn, part, tmp)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        if row is None:
+            return None
+        os.replace(tmp, path)
+
+        # 2) detach + drop; có dòng ghi thêm sau COPY thì rollback (partition gắn lại như cũ)
+        with conn:
+            cur = conn.cursor()
+            cur.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(sql.Identifier(table), ident))
+            cur.execute(sql.SQL("SELECT count(*) AS n FROM {}").format(ident))
+            if cur.fetchone()["n"] != row["n"]:
+                raise RuntimeError(f"{part} thay đổi trong lúc lưu trữ, thử lại sau")
+            cur.execute(sql.SQL("DROP TABLE {}").format(ident))
+
+    return path
+
+
+def archive_old(keep_months: int = HISTORY_KEEP_MONTHS, out_dir: str = HISTORY_ARCHIVE_DIR) -> list:
+    cutoff = archive_cutoff(keep_months)
+    done = []
+    for table in PARTITIONED_TABLES:
+        for p in list_partitions(table):
+            if p["is_default"] or p["hi"] is None or p["hi"] > cutoff:
+                continue
+            try:
+                path = archive_partition(table, p["name"], out_dir)
+            except Exception as e:
+                print(f"[partitions] archive {p['name']} lỗi:", e)
+                continue
+            if path:
+                print(f"[partitions] ✔ {p['name']} -> {path}")
+                done.append(path)
+    return done
+
+
+# ======================================================
+# CLI
+# ======================================================
+async def _ensure_cli() -> int:
+    from db_async import init_async_pool, close_async_pool
+
+    pool = await init_async_pool()
+    try:
+        return await ensure_all(pool)
+    finally:
+        await close_async_pool()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parking history partitions")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("list", help="liệt kê partition")
+    sub.add_parser("ensure", help=f"tạo trước {PARTITION_AHEAD_MONTHS} tháng")
+    p = sub.add_parser("archive", help="COPY gzip + detach + drop partition cũ")
+    p.add_argument("--keep-months", type=int, default=HISTORY_KEEP_MONTHS)
+    p.add_argument("--dir", default=HISTORY_ARCHIVE_DIR)
+
+    args = parser.parse_args(argv)
+
+    if args.cmd == "list":
+        for table in PARTITIONED_TABLES:
+            for p in list_partitions(table):
+                bound = "DEFAULT" if p["is_default"] else f"{p['lo'] or 'MINVALUE'} -> {p['hi']}"
+                print(f"{table:13s} {p['name']:28s} {bound}")
+    elif args.cmd == "ensure":
+        n = asyncio.run(_ensure_cli())
+        print(f"✔ Tạo {n} partition mới")
+    elif args.cmd == "archive":
+        done = archive_old(args.keep_months, args.dir)
+        print(f"✔ Lưu trữ {len(done)} partition")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# query_plans.py — KIỂM TRA PLAN CỦA CÁC QUERY NÓNG
+# ==========================================================
+# - HOT_QUERIES: chép nguyên văn các query nóng trong sql/*.sql + gates_api.py
+#   (ghi rõ nguồn từng câu; đổi query ở đó thì đổi ở đây, check mới có nghĩa)
+# - Mỗi query EXPLAIN 2 lần:
+#     1) plan thật: Seq Scan trên bảng >= min_rows dòng => lỗi
+#     2) enable_seqscan=off: vẫn Seq Scan => KHÔNG có index dùng được => lỗi
+#        (bắt được thiếu index cả trên DB dev / CI ít dữ liệu)
+# - Chạy: python schema.py check [--min-rows N]
+# ==========================================================
+
+import os
+import json
+
+PLAN_CHECK_MIN_ROWS = int(os.getenv("PLAN_CHECK_MIN_ROWS", "10000"))
+
+# (tên, sql) — CHÉP NGUYÊN VĂN câu trong function / endpoint (cùng WHERE, ORDER BY, FOR UPDATE),
+# chỉ thay tham số bằng literal để EXPLAIN không phải đoán kiểu
+HOT_QUERIES = [
+    # sql/120_open_stays.sql — vehicle_in_event
+    ("vehicle_in_event: giữ chỗ open_stays", """
+        INSERT INTO open_stays (plate, slotid, vehicle_time_in, trans_time_in, trans_gate)
+        VALUES ('PLAN-CHECK', 'PLAN-CHECK', NOW()::timestamp, NOW()::timestamp, 'PLAN-CHECK')
+        ON CONFLICT (plate) DO NOTHING
+    """),
+    ("vehicle_in_event: chiếm slot", """
+        UPDATE slots
+        SET occupied = true, plate = 'PLAN-CHECK', version = version + 1
+        WHERE slotid = 'PLAN-CHECK' AND occupied IS NOT TRUE
+        RETURNING zone
+    """),
+    # sql/120_open_stays.sql — vehicle_out_event
+    ("vehicle_out_event: xe đang trong bãi", """
+        SELECT vehicle_id, slotid, vehicle_time_in, trans_id, trans_time_in, trans_gate
+        FROM open_stays
+        WHERE plate = 'PLAN-CHECK'
+        FOR UPDATE
+    """),
+    ("vehicle_out_event: đóng vehicle", """
+        UPDATE vehicles SET time_out = NOW() WHERE id = 0 AND time_in = '2000-01-01'
+    """),
+    ("vehicle_out_event: đóng transaction", """
+        UPDATE transactions
+        SET time_out = NOW(),
+            duration_minutes = 0,
+            fee = 0,
+            img_out = NULL
+        WHERE trans_id = 0 AND time_in = '2000-01-01'
+    """),
+    # gates_api.py — GET /fee
+    ("/fee: transaction đang mở", """
+        SELECT trans_id, trans_time_in AS time_in, slotid, trans_gate AS gateid
+        FROM open_stays
+        WHERE plate='PLAN-CHECK' AND trans_id IS NOT NULL
+    """),
+    # gates_api.py — GET /slot_info/{slotid}
+    ("/slot_info: xe ở slot", """
+        SELECT v.*, t.img_in, t.img_out
+        FROM open_stays o
+        JOIN vehicles v ON v.id = o.vehicle_id AND v.time_in = o.vehicle_time_in
+        LEFT JOIN transactions t ON t.trans_id = o.trans_id AND t.time_in = o.trans_time_in
+        WHERE o.slotid='PLAN-CHECK'
+        ORDER BY o.vehicle_time_in DESC LIMIT 1
+    """),
+    # gates_api.py — GET /transactions (keyset, sql/020_transactions_indexes.sql)
+    ("/transactions: trang mới nhất", """
+        SELECT trans_id FROM transactions
+        ORDER BY time_in DESC, trans_id DESC LIMIT 100
+    """),
+    ("/transactions: status=open", """
+        SELECT trans_id FROM transactions
+        WHERE time_out IS NULL
+        ORDER BY time_in DESC, trans_id DESC LIMIT 100
+    """),
+    # sql/050_processed_events_retention.sql — processed_events_prune
+    ("processed_events_prune: lô cũ nhất", """
+        SELECT ctid FROM processed_events
+        WHERE created_at < (NOW() - INTERVAL '30 days')::timestamp
+        ORDER BY created_at
+        LIMIT 5000
+    """),
+]
+
+
+def seq_scans(plan: dict) -> list:
+    """Tên bảng bị Seq Scan trong cây plan."""
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name"))
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child))
+    return found
+
+
+async def _explain(conn, sql: str, seqscan: bool) -> dict:
+    async with conn.transaction():
+        if not seqscan:
+            await conn.execute("SET LOCAL enable_seqscan = off")
+        raw = await conn.fetchval("EXPLAIN (FORMAT JSON) " + sql)
+    if isinstance(raw, str):
+        raw = json.loads(raw)
+    return raw[0]["Plan"]
+
+
+async def check_plans(pool, min_rows: int | None = None) -> list:
+    """In kết quả từng query, trả về [(tên, lý do)] các query lỗi."""
+    min_rows = PLAN_CHECK_MIN_ROWS if min_rows is None else min_rows
+    failures = []
+
+    async with pool.acquire() as conn:
+        sizes = {
+            r["relname"]: r["reltuples"] for r in await conn.fetch("""
+                SELECT relname, reltuples::bigint AS reltuples
+                FROM pg_class WHERE relkind IN ('r', 'p')
+            """)
+        }
+
+        for name, sql in HOT_QUERIES:
+            reasons = []
+
+            big = [t for t in seq_scans(await _explain(conn, sql, True)) if sizes.get(t, 0) >= min_rows]
+            if big:
+                reasons.append("seq scan trên bảng lớn: " + ", ".join(big))
+
+            forced = seq_scans(await _explain(conn, sql, False))
+            if forced:
+                reasons.append("không có index dùng được: " + ", ".join(forced))
+
+            if reasons:
+                failures.append((name, "; ".join(reasons)))
+                print(f"✘ {name}: {'; '.join(reasons)}")
+            else:
+                print(f"✔ {name}")
+
+    return failures
@@ -0,0 +1,195 @@
+# reports.py — BÁO CÁO PDF CHẠY NỀN PHÍA CLOUD
+# ==========================================================
+# - POST /reports tạo job -> chạy trong worker pool (không block API)
+# - Đọc dữ liệu từ rollup stats_daily (sql/030_stats_rollup.sql)
+# - Ghi PDF vào REPORT_DIR (ghi file tạm rồi rename)
+# - Trạng thái job lưu Redis (report:{job_id}) để mọi worker đều đọc được
+# - REPORT_DIR phải là thư mục DÙNG CHUNG cho mọi worker / replica
+#   (docker-compose.yml mount ./reports), nếu không GET /reports/{id}/file ở worker khác
+#   sẽ không thấy file dù Redis báo done => chạy nhiều host thì cần volume chung hoặc sticky routing
+# - cleanup_loop(): xóa PDF (và file tạm) cũ hơn REPORT_TTL, cùng lúc trạng thái job hết hạn
+# ==========================================================
+
+import os
+import uuid
+import glob
+import time
+import asyncio
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A4
+
+from db_pool import db_conn
+
+REPORT_DIR = os.getenv("REPORT_DIR", "reports")
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+REPORT_TTL = int(os.getenv("REPORT_TTL", str(24 * 3600)))   # giữ trạng thái job 24h
+REPORT_SWEEP_SEC = float(os.getenv("REPORT_SWEEP_SEC", "3600"))
+
+os.makedirs(REPORT_DIR, exist_ok=True)
+
+_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+
+
+def _key(job_id: str) -> str:
+    return f"report:{job_id}"
+
+
+def report_path(job_id: str) -> str:
+    return os.path.join(REPORT_DIR, f"{job_id}.pdf")
+
+
+def _set_job(rds, job_id: str, **fields) -> None:
+    rds.hset(_key(job_id), mapping={k: "" if v is None else str(v) for k, v in fields.items()})
+    rds.expire(_key(job_id), REPORT_TTL)
+
+
+def get_job(rds, job_id: str) -> dict | None:
+    job = rds.hgetall(_key(job_id))
+    return job or None
+
+
+# ======================================================
+# DATA (ROLLUP)
+# ======================================================
+def _load_rollup(gate: str | None, date_from: date | None, date_to: date | None):
+    """Khoảng ngày [date_from, date_to] (tính cả 2 đầu). Trả về (theo ngày, theo gate)."""
+    where, args = [], []
+    if gate:
+        where.append("gateid = %s")
+        args.append(gate)
+    if date_from:
+        where.append("day >= %s")
+        args.append(date_from)
+    if date_to:
+        where.append("day <= %s")
+        args.append(date_to)
+    cond = ("WHERE " + " AND ".join(where)) if where else ""
+
+    with db_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT day, SUM(entries) AS entries, SUM(exits) AS exits,
+                   SUM(revenue) AS revenue, SUM(dwell_minutes) AS dwell_minutes
+            FROM stats_daily {cond}
+            GROUP BY day ORDER BY day
+        """, args)
+        by_day = cur.fetchall()
+
+        cur.execute(f"""
+            SELECT gateid, SUM(entries) AS entries, SUM(exits) AS exits,
+                   SUM(revenue) AS revenue
+            FROM stats_daily {cond}
+            GROUP BY gateid ORDER BY gateid
+        """, args)
+        by_gate = cur.fetchall()
+
+    return by_day, by_gate
+
+
+# ======================================================
+# PDF
+# ======================================================
+def _render_pdf(path: str, title_filters: str, by_day, by_gate) -> None:
+    tmp = path + ".tmp"
+    c = canvas.Canvas(tmp, pagesize=A4)
+    w, h = A4
+
+    def line(y, text, font="Helvetica", size=11):
+        c.setFont(font, size)
+        c.drawString(40, y, text)
+        y -= size + 7
+        if y < 40:
+            c.showPage()
+            y = h - 60
+        return y
+
+    entries = sum(int(d["entries"]) for d in by_day)
+    exits = sum(int(d["exits"]) for d in by_day)
+    revenue = sum(int(d["revenue"]) for d in by_day)
+    dwell = sum(int(d["dwell_minutes"]) for d in by_day)
+
+    y = line(h - 50, "BAO CAO THONG KE BAI DO XE", "Helvetica-Bold", 20)
+    y = line(y - 10, title_filters, size=12)
+    y = line(y - 10, f"TONG: {entries} luot vao | {exits} luot ra | Doanh thu: {revenue:,} VND",
+             "Helvetica-Bold", 14)
+    if exits:
+        y = line(y, f"Thoi gian do trung binh: {dwell // exits} phut", size=12)
+
+    y = line(y - 10, "THEO GATE", "Helvetica-Bold", 13)
+    for g in by_gate:
+        y = line(y, f"{g['gateid'] or '---'} | Vao: {g['entries']} | Ra: {g['exits']} | "
+                    f"Doanh thu: {int(g['revenue']):,} VND")
+
+    y = line(y - 10, "THEO NGAY", "Helvetica-Bold", 13)
+    for d in by_day:
+        y = line(y, f"{d['day']} | Vao: {d['entries']} | Ra: {d['exits']} | "
+                    f"Doanh thu: {int(d['revenue']):,} VND")
+
+    c.save()
+    os.replace(tmp, path)
+
+
+def _run(rds, job_id: str, gate, date_from, date_to, on_done) -> None:
+    _set_job(rds, job_id, status="running", started_at=int(time.time()))
+    try:
+        by_day, by_gate = _load_rollup(gate, date_from, date_to)
+        filters = f"Gate: {gate or 'ALL'}   TU: {date_from or '---'}   DEN: {date_to or '---'}"
+        _render_pdf(report_path(job_id), filters, by_day, by_gate)
+        _set_job(rds, job_id, status="done", finished_at=int(time.time()))
+    except Exception as e:
+        _set_job(rds, job_id, status="failed", error=f"{type(e).__name__}: {e}")
+
+    if on_done:
+        try:
+            on_done(job_id, rds.hget(_key(job_id), "status"))
+        except Exception:
+            pass
+
+
+def submit_report(rds, gate: str | None, date_from: date | None, date_to: date | None,
+                  on_done=None) -> str:
+    """Tạo job, trả về job_id ngay. on_done(job_id, status) gọi từ thread worker."""
+    job_id = uuid.uuid4().hex
+    _set_job(
+        rds, job_id,
+        status="queued",
+        gate=gate,
+        date_from=date_from,
+        date_to=date_to,
+        created_at=int(time.time()),
+    )
+    _executor.submit(_run, rds, job_id, gate, date_from, date_to, on_done)
+    return job_id
+
+
+# ======================================================
+# DỌN FILE HẾT HẠN
+# ======================================================
+def cleanup_old_files(max_age: float = REPORT_TTL) -> int:
+    """Xóa file trong REPORT_DIR cũ hơn max_age giây (job Redis đã hết hạn)."""
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in glob.glob(os.path.join(REPORT_DIR, "*.pdf*")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass   # worker khác vừa xóa
+    return removed
+
+
+async def cleanup_loop():
+    while True:
+        try:
+            await asyncio.to_thread(cleanup_old_files)
+        except Exception as e:
+            print("[reports] cleanup error:", e)
+        await asyncio.sleep(REPORT_SWEEP_SEC)
+
+
+def shutdown() -> None:
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,133 @@
+# reservations.py — GIỮ SLOT TẠM (reserve:{slot}) BẰNG LUA SCRIPT
+# ==========================================================
+# - Mỗi thao tác = 1 script chạy nguyên tử trên Redis => 1 round trip, không có
+#   khe hở giữa GET và SET để 2 gate cùng giữ 1 slot
+# - reserve: giữ / gia hạn nếu slot trống hoặc đã là của mình
+# - renew / release: chỉ chủ giữ slot mới gia hạn / nhả được
+# - claim: vehicle_in giữ slot trong lúc ghi DB (trống hoặc của mình), nhả sau commit
+# - claim_many / release_many: như claim / release cho cả lô (/events/batch), 1 script, 1 round trip
+# - Dùng được cho cả client sync (redis.Redis) và async (redis.asyncio)
+# ==========================================================
+
+import os
+
+RESERVE_CLAIM_MS = int(os.getenv("RESERVE_CLAIM_MS", "5000"))   # giữ slot trong lúc vehicle_in ghi DB
+
+# Mọi script trả về {ok (0/1), owner ('' nếu không ai giữ), pttl ms}
+
+RESERVE_LUA = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return {0, owner, redis.call('PTTL', KEYS[1])}
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return {1, ARGV[1], tonumber(ARGV[2])}
+"""
+
+RENEW_LUA = """
+local owner = redis.call('GET', KEYS[1])
+if owner ~= ARGV[1] then
+    return {0, owner or '', redis.call('PTTL', KEYS[1])}
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return {1, owner, tonumber(ARGV[2])}
+"""
+
+RELEASE_LUA = """
+local owner = redis.call('GET', KEYS[1])
+if owner ~= ARGV[1] then
+    return {0, owner or '', redis.call('PTTL', KEYS[1])}
+end
+redis.call('DEL', KEYS[1])
+return {1, owner, 0}
+"""
+
+CLAIM_LUA = """
+local owner = redis.call('GET', KEYS[1])
+if owner then
+    if owner ~= ARGV[1] then
+        return {0, owner, redis.call('PTTL', KEYS[1])}
+    end
+    return {1, owner, redis.call('PTTL', KEYS[1])}
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return {1, ARGV[1], tonumber(ARGV[2])}
+"""
+
+# KEYS = reserve:{slot}..., ARGV = gate tương ứng..., ttl => {{ok, owner, pttl}, ...} theo thứ tự
+CLAIM_MANY_LUA = """
+local ttl = ARGV[#KEYS + 1]
+local out = {}
+for i, key in ipairs(KEYS) do
+    local owner = redis.call('GET', key)
+    if owner and owner ~= ARGV[i] then
+        out[i] = {0, owner, redis.call('PTTL', key)}
+    else
+        if not owner then
+            redis.call('SET', key, ARGV[i], 'PX', ttl)
+        end
+        out[i] = {1, ARGV[i], redis.call('PTTL', key)}
+    end
+end
+return out
+"""
+
+# KEYS = reserve:{slot}..., ARGV = gate tương ứng... => số slot đã nhả
+RELEASE_MANY_LUA = """
+local n = 0
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[i] then
+        redis.call('DEL', key)
+        n = n + 1
+    end
+end
+return n
+"""
+
+
+def reserve_key(slot: str) -> str:
+    return f"reserve:{slot}"
+
+
+def reservation_result(res) -> tuple[bool, str | None, int]:
+    """(ok, owner, pttl_ms) từ kết quả script."""
+    ok, owner, pttl = res
+    if isinstance(owner, bytes):
+        owner = owner.decode()
+    return bool(ok), owner or None, int(pttl)
+
+
+class SlotReservations:
+    """
+    Script đăng ký trên 1 client. Với client async, mỗi method trả về coroutine:
+        ok, owner, pttl = reservation_result(await ARES.claim(slot, gate))
+    """
+
+    def __init__(self, client):
+        self._reserve = client.register_script(RESERVE_LUA)
+        self._renew = client.register_script(RENEW_LUA)
+        self._release = client.register_script(RELEASE_LUA)
+        self._claim = client.register_script(CLAIM_LUA)
+        self._claim_many = client.register_script(CLAIM_MANY_LUA)
+        self._release_many = client.register_script(RELEASE_MANY_LUA)
+
+    def reserve(self, slot: str, gate: str, ttl_ms: int):
+        return self._reserve(keys=[reserve_key(slot)], args=[gate, ttl_ms])
+
+    def renew(self, slot: str, gate: str, ttl_ms: int):
+        return self._renew(keys=[reserve_key(slot)], args=[gate, ttl_ms])
+
+    def release(self, slot: str, gate: str):
+        return self._release(keys=[reserve_key(slot)], args=[gate])
+
+    def claim(self, slot: str, gate: str, ttl_ms: int = RESERVE_CLAIM_MS):
+        return self._claim(keys=[reserve_key(slot)], args=[gate, ttl_ms])
+
+    def claim_many(self, pairs: list, ttl_ms: int = RESERVE_CLAIM_MS):
+        """pairs = [(slot, gate)]; kết quả theo thứ tự, đọc từng phần tử bằng reservation_result()."""
+        return self._claim_many(
+            keys=[reserve_key(s) for s, _ in pairs], args=[g for _, g in pairs] + [ttl_ms]
+        )
+
+    def release_many(self, pairs: list):
+        return self._release_many(keys=[reserve_key(s) for s, _ in pairs], args=[g for _, g in pairs])
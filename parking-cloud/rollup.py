@@ -0,0 +1,40 @@
+# rollup.py — CLI cho bảng rollup thống kê (sql/030_stats_rollup.sql)
+# ==========================================================
+#   python rollup.py backfill                       # tính lại toàn bộ
+#   python rollup.py backfill --from 2025-01-01 --to 2025-01-31
+# Cần Cloud đã khởi động ít nhất 1 lần (schema.py cài function SQL).
+# ==========================================================
+
+import argparse
+from datetime import date, timedelta
+
+from db_pool import db_conn
+
+
+def backfill(date_from: date | None = None, date_to: date | None = None) -> int:
+    """Tính lại stats_hourly / stats_daily cho [date_from, date_to). Trả về số sự kiện đã cộng."""
+    with db_conn() as conn:
+        with conn:
+            cur = conn.cursor()
+            cur.execute("SELECT stats_rollup_backfill(%s, %s) AS n", (date_from, date_to))
+            return cur.fetchone()["n"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parking stats rollup")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("backfill", help="tính lại rollup từ bảng transactions")
+    p.add_argument("--from", dest="date_from", type=date.fromisoformat, help="YYYY-MM-DD")
+    p.add_argument("--to", dest="date_to", type=date.fromisoformat, help="YYYY-MM-DD (tính cả ngày)")
+
+    args = parser.parse_args(argv)
+
+    if args.cmd == "backfill":
+        date_to = args.date_to + timedelta(days=1) if args.date_to else None
+        n = backfill(args.date_from, date_to)
+        print(f"✔ Backfill rollup xong: {n} sự kiện")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# schema.py — MIGRATION CÓ VERSION CHO SCHEMA CLOUD
+# ==========================================================
+# - Mỗi file sql/NNN_ten.sql là 1 migration, version = NNN (chạy theo thứ tự số)
+# - Bảng schema_migrations ghi version đã chạy + checksum => mỗi file chạy ĐÚNG 1 LẦN,
+#   mỗi migration 1 transaction riêng (lỗi giữa chừng không để lại nửa vời)
+# - File đã chạy mà bị sửa (checksum khác) => chỉ cảnh báo, KHÔNG chạy lại:
+#   muốn đổi function / index thì thêm file mới (CREATE OR REPLACE ...)
+# - Advisory lock để nhiều worker khởi động cùng lúc không đụng nhau
+# - Chạy lúc startup (SCHEMA_AUTO_MIGRATE=1, mặc định) hoặc bằng CLI:
+#     python schema.py status     # version nào đã / chưa chạy
+#     python schema.py up         # chạy migration còn thiếu
+#     python schema.py check      # EXPLAIN các query nóng (query_plans.py), exit 1 nếu seq scan
+# ==========================================================
+
+import os
+import re
+import glob
+import asyncio
+import hashlib
+import argparse
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql")
+SCHEMA_LOCK_KEY = "parking_schema"
+SCHEMA_AUTO_MIGRATE = os.getenv("SCHEMA_AUTO_MIGRATE", "1") == "1"
+
+_NAME_RE = re.compile(r"^(\d+)_(.+)\.sql$")
+
+
+def migrations() -> list:
+    """[(version, name, path, checksum)] theo thứ tự version."""
+    found = []
+    for path in glob.glob(os.path.join(SQL_DIR, "*.sql")):
+        m = _NAME_RE.match(os.path.basename(path))
+        if not m:
+            continue
+        with open(path, "rb") as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        found.append((int(m.group(1)), m.group(2), path, checksum))
+
+    found.sort()
+    versions = [v for v, *_ in found]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"Trùng version migration trong {SQL_DIR}")
+    return found
+
+
+async def _ensure_table(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version    INT PRIMARY KEY,
+            name       TEXT NOT NULL,
+            checksum   TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+
+
+async def _applied(conn) -> dict:
+    rows = await conn.fetch("SELECT version, checksum FROM schema_migrations")
+    return {r["version"]: r["checksum"] for r in rows}
+
+
+async def migrate(pool) -> list:
+    """Chạy migration chưa có trong schema_migrations. Trả về tên file đã chạy."""
+    done = []
+    async with pool.acquire() as conn:
+        await conn.execute("SELECT pg_advisory_lock(hashtext($1))", SCHEMA_LOCK_KEY)
+        try:
+            await _ensure_table(conn)
+            applied = await _applied(conn)
+
+            for version, name, path, checksum in migrations():
+                if version in applied:
+                    if applied[version] != checksum:
+                        print(f"[schema] ⚠ {os.path.basename(path)} đã sửa sau khi chạy — bỏ qua, hãy thêm migration mới")
+                    continue
+
+                with open(path, "r", encoding="utf-8") as f:
+                    sql = f.read()
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute(
+                        "INSERT INTO schema_migrations (version, name, checksum) VALUES ($1, $2, $3)",
+                        version, name, checksum
+                    )
+                done.append(os.path.basename(path))
+                print(f"[schema] ✔ {os.path.basename(path)}")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(hashtext($1))", SCHEMA_LOCK_KEY)
+    return done
+
+
+async def apply_schema(pool) -> list:
+    """Startup: tự migrate trừ khi SCHEMA_AUTO_MIGRATE=0 (khi đó chạy CLI trước khi deploy)."""
+    if not SCHEMA_AUTO_MIGRATE:
+        return []
+    return await migrate(pool)
+
+
+async def status(pool) -> list:
+    """[(version, name, trạng thái)] — applied / pending / changed."""
+    async with pool.acquire() as conn:
+        await _ensure_table(conn)
+        applied = await _applied(conn)
+
+    out = []
+    for version, name, _, checksum in migrations():
+        if version not in applied:
+            state = "pending"
+        elif applied[version] != checksum:
+            state = "changed"
+        else:
+            state = "applied"
+        out.append((version, name, state))
+    return out
+
+
+# ======================================================
+# CLI
+# ======================================================
+async def _run_cli(args) -> int:
+    from db_async import init_async_pool, close_async_pool
+
+    pool = await init_async_pool()
+    try:
+        if args.cmd == "status":
+            for version, name, state in await status(pool):
+                print(f"{version:04d}  {state:8s} {name}")
+            return 0
+
+        if args.cmd == "up":
+            done = await migrate(pool)
+            print(f"✔ Đã chạy {len(done)} migration" if done else "✔ Schema đã mới nhất")
+            return 0
+
+        if args.cmd == "check":
+            from query_plans import check_plans
+            failures = await check_plans(pool, min_rows=args.min_rows)
+            return 1 if failures else 0
+    finally:
+        await close_async_pool()
+    return 2
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parking cloud schema migrations")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("status", help="liệt kê migration đã / chưa chạy")
+    sub.add_parser("up", help="chạy migration còn thiếu")
+    p = sub.add_parser("check", help="EXPLAIN query nóng, lỗi nếu seq scan")
+    p.add_argument("--min-rows", type=int, default=None,
+                   help="chỉ coi seq scan là lỗi trên bảng >= số dòng này (mặc định PLAN_CHECK_MIN_ROWS)")
+
+    args = parser.parse_args(argv)
+    raise SystemExit(asyncio.run(_run_cli(args)))
+
+
+if __name__ == "__main__":
+    main()
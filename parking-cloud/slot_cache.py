@@ -0,0 +1,82 @@
+# slot_cache.py — CACHE SLOT MAP TRONG PROCESS CLOUD
+# ==========================================================
+# - /slots/map trả body JSON đã serialize sẵn, không query Postgres mỗi lần
+# - Mọi thao tác ghi slot gọi invalidate() -> version tăng, lần đọc sau build lại
+# - Ghi từ worker khác tới qua Redis relay (at-most-once, mất khi relay_loop subscribe lại)
+#   => cache tự build lại sau SLOT_MAP_MAX_AGE giây dù không nhận được invalidate nào
+# - ETag = head seq của change feed (slot_change_head, đọc cùng snapshot với rows):
+#   mọi thay đổi slot đều tăng seq => ETag đổi đúng khi DB đổi, giống nhau giữa các worker
+# ==========================================================
+
+import os
+import time
+import asyncio
+import threading
+
+import orjson
+
+SLOT_MAP_MAX_AGE = float(os.getenv("SLOT_MAP_MAX_AGE", "30"))
+
+
+class SlotMapCache:
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self._version = 0
+        self._version_lock = threading.Lock()   # invalidate() được gọi cả từ threadpool
+        self._build_lock = asyncio.Lock()
+
+        self._built_version = -1
+        self._built_at = None
+        self._seq = 0
+        self._rows = []
+        self._body = b""
+        self._etag = ""
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self) -> None:
+        with self._version_lock:
+            self._version += 1
+
+    def fresh(self) -> bool:
+        if self._built_version != self._version or self._built_at is None:
+            return False
+        return time.monotonic() - self._built_at <= self.max_age
+
+    async def _ensure(self, loader) -> None:
+        if self.fresh():
+            return
+        async with self._build_lock:
+            if self.fresh():
+                return
+            # chụp version TRƯỚC khi load: ghi xen giữa sẽ làm lần đọc sau build lại
+            version = self._version
+            rows, seq = await loader()
+            if seq != self._seq or not self._body:
+                self._rows = rows
+                self._body = orjson.dumps({"slots": rows, "seq": seq})
+                self._etag = f'W/"slots-{seq}"'
+                self._seq = seq
+            self._built_version = version
+            self._built_at = time.monotonic()
+
+    async def get(self, loader) -> tuple[bytes, str, int]:
+        """(body JSON, etag, head seq). loader: async () -> (list[dict] slots, head seq) đọc từ DB."""
+        await self._ensure(loader)
+        return self._body, self._etag, self._seq
+
+    async def rows(self, loader) -> list:
+        await self._ensure(loader)
+        return self._rows
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+SLOT_MAP = SlotMapCache(SLOT_MAP_MAX_AGE)
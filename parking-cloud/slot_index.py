@@ -0,0 +1,146 @@
+# slot_index.py — BẢNG KHOẢNG CÁCH GATE × SLOT + SLOT TRỐNG GẦN NHẤT (RAM)
+# ==========================================================
+# - load(): ma trận khoảng cách gate × slot tính bằng NumPy (chỉ khi tọa độ đổi),
+#   argsort từng hàng => thứ tự slot theo khoảng cách cho mỗi gate
+# - /slots?gate_id=: ghép thứ tự sẵn này với occupied hiện tại, không sort lại
+# - Mỗi gate giữ thêm list (distance, slotid) các slot TRỐNG, sort sẵn
+#   => suggest_slot lấy phần tử đầu, O(1), không query Postgres
+# - Slot đổi trạng thái: mark() chèn / gỡ bằng bisect trong list từng gate
+# - Admin sửa slot: invalidate() -> lần gọi sau build lại từ DB
+# - Ghi từ worker khác tới qua Redis relay (ws_relay.py); lỡ mất event thì
+#   tự build lại sau SLOT_INDEX_MAX_AGE giây
+#   (vehicle_in vẫn check slot trống trong DB, nên gợi ý cũ chỉ gây 409)
+# ==========================================================
+
+import os
+import time
+import bisect
+import threading
+
+import numpy as np
+
+SLOT_INDEX_MAX_AGE = float(os.getenv("SLOT_INDEX_MAX_AGE", "30"))
+
+
+class SlotIndex:
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+        self._gate_idx = {}     # gateid -> hàng trong _dist
+        self._slot_idx = {}     # slotid -> cột trong _dist (chỉ slot có tọa độ)
+        self._dist = np.zeros((0, 0))
+        self._geo_key = None    # tọa độ gate + slot lúc tính _dist
+        self._order = {}        # gateid -> [(distance, slotid), ...] mọi slot, gần -> xa
+        self._free = {}         # gateid -> [(distance, slotid), ...] slot trống, gần -> xa
+        self._free_ids = set()
+
+        self._built_at = None
+
+    def stale(self) -> bool:
+        return self._built_at is None or time.monotonic() - self._built_at > self.max_age
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._built_at = None
+
+    def load(self, gates: list, slots: list) -> None:
+        """gates: [{gateid, x, y}], slots: [{slotid, x, y, occupied}]"""
+        gates = [g for g in gates if g["x"] is not None and g["y"] is not None]
+        # sort theo slotid: argsort stable => cùng khoảng cách thì theo slotid,
+        # khớp thứ tự tuple (distance, slotid) mà bisect trong mark() dùng
+        slots = sorted(
+            (s for s in slots if s["x"] is not None and s["y"] is not None),
+            key=lambda s: s["slotid"],
+        )
+
+        gate_ids = [g["gateid"] for g in gates]
+        slot_ids = [s["slotid"] for s in slots]
+        geo_key = (
+            tuple((g["gateid"], g["x"], g["y"]) for g in gates),
+            tuple((s["slotid"], s["x"], s["y"]) for s in slots),
+        )
+
+        if geo_key == self._geo_key:
+            # tọa độ không đổi (rebuild vì hết hạn) -> giữ ma trận + thứ tự cũ
+            dist, order = self._dist, self._order
+        else:
+            gxy = np.array([(g["x"], g["y"]) for g in gates], dtype=float).reshape(-1, 2)
+            sxy = np.array([(s["x"], s["y"]) for s in slots], dtype=float).reshape(-1, 2)
+
+            dist = np.hypot(gxy[:, None, 0] - sxy[None, :, 0], gxy[:, None, 1] - sxy[None, :, 1])
+            order_idx = np.argsort(dist, axis=1, kind="stable")
+
+            order = {}
+            for gi, gid in enumerate(gate_ids):
+                row = dist[gi].tolist()
+                order[gid] = [(row[j], slot_ids[j]) for j in order_idx[gi].tolist()]
+
+        free_ids = {s["slotid"] for s in slots if not s["occupied"]}
+        free = {gid: [e for e in order[gid] if e[1] in free_ids] for gid in gate_ids}
+
+        with self._lock:
+            self._gate_idx = {gid: i for i, gid in enumerate(gate_ids)}
+            self._slot_idx = {sid: j for j, sid in enumerate(slot_ids)}
+            self._dist = dist
+            self._geo_key = geo_key
+            self._order = order
+            self._free = free
+            self._free_ids = free_ids
+            self._built_at = time.monotonic()
+
+    def mark(self, slotid: str, occupied: bool) -> None:
+        """Slot vừa đổi trạng thái (sau khi DB commit)."""
+        with self._lock:
+            if self._built_at is None or slotid not in self._slot_idx:
+                return
+            if occupied == (slotid not in self._free_ids):
+                return
+
+            col = self._dist[:, self._slot_idx[slotid]].tolist()
+            for gid, gi in self._gate_idx.items():
+                entry = (col[gi], slotid)
+                lst = self._free[gid]
+                if occupied:
+                    i = bisect.bisect_left(lst, entry)
+                    if i < len(lst) and lst[i] == entry:
+                        del lst[i]
+                else:
+                    bisect.insort(lst, entry)
+
+            if occupied:
+                self._free_ids.discard(slotid)
+            else:
+                self._free_ids.add(slotid)
+
+    def has_gate(self, gateid: str) -> bool:
+        return self._built_at is not None and gateid in self._gate_idx
+
+    def nearest(self, gateid: str):
+        """(slotid, distance) slot trống gần gate nhất, None nếu hết chỗ."""
+        with self._lock:
+            lst = self._free.get(gateid)
+            if not lst:
+                return None
+            dist, sid = lst[0]
+            return sid, dist
+
+    def distances(self, slotid: str) -> dict:
+        """{gateid: distance} của 1 slot ({} nếu index chưa có slot này)."""
+        with self._lock:
+            if self._built_at is None or slotid not in self._slot_idx:
+                return {}
+            col = self._dist[:, self._slot_idx[slotid]].tolist()
+            return {gid: col[gi] for gid, gi in self._gate_idx.items()}
+
+    def free_by_gate(self) -> dict:
+        """{gateid: [(distance, slotid), ...]} bản sao các list slot trống."""
+        with self._lock:
+            return {gid: list(lst) for gid, lst in self._free.items()}
+
+    def order(self, gateid: str) -> list:
+        """[(distance, slotid), ...] mọi slot có tọa độ, gần -> xa (list không bị sửa sau load)."""
+        return self._order.get(gateid, [])
+
+
+SLOT_INDEX = SlotIndex(SLOT_INDEX_MAX_AGE)
@@ -0,0 +1,131 @@
+# slot_pool.py — POOL SLOT TRỐNG TRÊN REDIS (CẤP SLOT CHO GATE)
+# ==========================================================
+# - free:{gate}: ZSET slot trống, score = khoảng cách tới gate (lấy từ SLOT_INDEX)
+# - /allocate_slot/{gate}: 1 Lua script lấy slot gần nhất chưa ai giữ
+#   và SET reserve:{slot} NX luôn => không còn reserve -> 409 -> thử slot khác
+# - Slot đã cấp vẫn nằm trong ZSET tới khi vehicle_in commit;
+#   reserve hết hạn mà xe không vào thì slot tự dùng lại được
+# - Postgres vẫn là nguồn đúng: sau commit vehicle_in/out cập nhật ZSET,
+#   rebuild toàn bộ lúc startup / admin sửa slot / định kỳ (sửa lệch)
+# - free_pool:gen (HASH slotid -> gen): mỗi lần cập nhật sau commit (queue_mark) tăng gen.
+#   Rebuild chụp gen TRƯỚC khi đọc DB; REBUILD_LUA chỉ sửa slot có gen chưa đổi
+#   => vehicle_in commit + mark trong lúc rebuild đang đọc DB không bị rebuild ghi đè
+#   thành "trống" (ngược lại cũng vậy với vehicle_out)
+# - Độ lệch còn lại: mark sau commit bị lỗi (Redis rớt) => slot sai trạng thái trong ZSET
+#   tối đa FREE_POOL_RECONCILE_SEC; slot đã có xe mà bị cấp thì vehicle_in_event vẫn trả 409
+# - Script tự ghép key reserve:{slot} => chỉ dùng với 1 Redis (không cluster)
+# ==========================================================
+
+import os
+import json
+
+FREE_POOL_SCAN = int(os.getenv("FREE_POOL_SCAN", "50"))                     # số slot đọc mỗi lượt ZRANGE khi cấp
+FREE_POOL_RECONCILE_SEC = int(os.getenv("FREE_POOL_RECONCILE_SEC", "60"))
+
+SLOT_GEN_KEY = "free_pool:gen"   # không dùng tiền tố free: (trùng free:{gate})
+
+
+def free_key(gate: str) -> str:
+    return f"free:{gate}"
+
+
+# KEYS[1] = free:{gate}; ARGV = gate, ttl_ms, scan
+# đọc ZSET từng lượt `scan` slot (gần -> xa) tới khi giữ được 1 slot hoặc hết ZSET
+# => 50 slot đầu bị gate khác giữ hết vẫn cấp được slot xa hơn
+# trả về {slotid, distance} hoặc nil nếu hết chỗ thật
+ALLOCATE_LUA = """
+local scan = tonumber(ARGV[3])
+local start = 0
+while true do
+    local cands = redis.call('ZRANGE', KEYS[1], start, start + scan - 1, 'WITHSCORES')
+    if #cands == 0 then
+        return nil
+    end
+    for i = 1, #cands, 2 do
+        local sid = cands[i]
+        local rk = 'reserve:' .. sid
+        if redis.call('SET', rk, ARGV[1], 'NX', 'PX', ARGV[2]) then
+            return {sid, cands[i + 1]}
+        end
+        if redis.call('GET', rk) == ARGV[1] then
+            redis.call('PEXPIRE', rk, ARGV[2])
+            return {sid, cands[i + 1]}
+        end
+    end
+    start = start + scan
+end
+"""
+
+
+# KEYS[1] = free_pool:gen; ARGV[1] = {slotid: gen lúc đọc DB}, ARGV[2] = {gate: [[slotid, distance], ...]}
+# chỉ thêm / bỏ slot có gen hiện tại == gen đã chụp (không ai mark trong lúc đọc DB)
+REBUILD_LUA = """
+local gens = cjson.decode(ARGV[1])
+local pools = cjson.decode(ARGV[2])
+local function unchanged(sid)
+    return (redis.call('HGET', KEYS[1], sid) or '0') == (gens[sid] or '0')
+end
+for gate, entries in pairs(pools) do
+    local key = 'free:' .. gate
+    local want = {}
+    for _, e in ipairs(entries) do
+        want[e[1]] = e[2]
+    end
+    for _, sid in ipairs(redis.call('ZRANGE', key, 0, -1)) do
+        if want[sid] == nil and unchanged(sid) then
+            redis.call('ZREM', key, sid)
+        end
+    end
+    for sid, dist in pairs(want) do
+        if unchanged(sid) then
+            redis.call('ZADD', key, dist, sid)
+        end
+    end
+end
+return 1
+"""
+
+
+class FreeSlotPool:
+    def __init__(self, client):
+        self._allocate = client.register_script(ALLOCATE_LUA)
+
+    async def allocate(self, gate: str, ttl_ms: int):
+        """(slotid, distance) đã giữ cho gate, None nếu hết chỗ (client async)."""
+        res = await self._allocate(keys=[free_key(gate)], args=[gate, ttl_ms, FREE_POOL_SCAN])
+        if not res:
+            return None
+        return res[0], float(res[1])
+
+
+def queue_mark(pipe, slotid: str, occupied: bool, distances: dict) -> None:
+    """Thêm lệnh cập nhật 1 slot vào pipeline (sync hoặc async); caller execute()."""
+    pipe.hincrby(SLOT_GEN_KEY, slotid, 1)
+    for gate, dist in distances.items():
+        if occupied:
+            pipe.zrem(free_key(gate), slotid)
+        else:
+            pipe.zadd(free_key(gate), {slotid: dist})
+
+
+class FreePoolRebuilder:
+    """Rebuild free:{gate} từ DB (client sync, gọi trong thread); script đăng ký 1 lần."""
+
+    def __init__(self, client):
+        self._client = client
+        self._rebuild = client.register_script(REBUILD_LUA)
+
+    def snapshot_gens(self) -> dict:
+        """Gọi TRƯỚC khi đọc DB để rebuild."""
+        return self._client.hgetall(SLOT_GEN_KEY)
+
+    def rebuild(self, gens: dict, free_by_gate: dict) -> None:
+        """
+        free_by_gate: gate -> [(distance, slotid), ...] slot trống (đọc DB sau snapshot_gens).
+        1 script => ZSET đổi nguyên tử, không có lúc rỗng.
+        """
+        pools = {gate: [[sid, dist] for dist, sid in entries] for gate, entries in free_by_gate.items()}
+        self._rebuild(
+            keys=[SLOT_GEN_KEY],
+            args=[json.dumps({k: str(v) for k, v in gens.items()}), json.dumps(pools)],
+        )
@@ -0,0 +1,166 @@
+-- ==========================================================
+-- vehicle_in_event / vehicle_out_event
+-- Gộp toàn bộ xe vào / xe ra thành 1 lần gọi server-side (1 round trip).
+-- Trả về jsonb {"code": ok | dedup | not_found | slot_occupied | plate_in_yard, ...}
+-- Mọi kiểm tra chạy TRƯỚC khi ghi => không cần rollback khi trả mã lỗi,
+-- row slots chỉ bị lock từ lúc UPDATE tới khi commit.
+-- ==========================================================
+
+CREATE OR REPLACE FUNCTION vehicle_in_event(
+    p_plate    TEXT,
+    p_gate     TEXT,
+    p_slot     TEXT,
+    p_img_in   TEXT,
+    p_event_id TEXT
+) RETURNS jsonb
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_now  TIMESTAMP := NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh';
+    v_zone slots.zone%TYPE;
+BEGIN
+    -- 0) dedup
+    IF p_event_id IS NOT NULL THEN
+        PERFORM 1 FROM processed_events WHERE event_id = p_event_id;
+        IF FOUND THEN
+            RETURN jsonb_build_object('code', 'dedup');
+        END IF;
+    END IF;
+
+    -- 1) gate tồn tại?
+    PERFORM 1 FROM gates WHERE gateid = p_gate;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('code', 'not_found', 'what', 'gate');
+    END IF;
+
+    -- 2) xe đã ở trong bãi?
+    PERFORM 1 FROM vehicles WHERE plate = p_plate AND time_out IS NULL;
+    IF FOUND THEN
+        RETURN jsonb_build_object('code', 'plate_in_yard');
+    END IF;
+
+    -- 3) chiếm slot có điều kiện (check + update trong 1 câu)
+    UPDATE slots
+    SET occupied = true, plate = p_plate, version = version + 1
+    WHERE slotid = p_slot AND occupied IS NOT TRUE
+    RETURNING zone INTO v_zone;
+
+    IF NOT FOUND THEN
+        PERFORM 1 FROM slots WHERE slotid = p_slot;
+        IF FOUND THEN
+            RETURN jsonb_build_object('code', 'slot_occupied');
+        END IF;
+        RETURN jsonb_build_object('code', 'not_found', 'what', 'slot');
+    END IF;
+
+    -- 4) ghi lịch sử
+    INSERT INTO vehicles (plate, slotid, gateid, source_gate, time_in)
+    VALUES (p_plate, p_slot, p_gate, p_gate, v_now);
+
+    INSERT INTO transactions (plate, slotid, gateid, time_in, img_in)
+    VALUES (p_plate, p_slot, p_gate, v_now, p_img_in);
+
+    -- 5) rollup thống kê (sql/030_stats_rollup.sql)
+    PERFORM stats_rollup_add(v_now, p_gate, v_zone, 1, 0, 0, 0);
+
+    -- 6) mark processed
+    IF p_event_id IS NOT NULL THEN
+        INSERT INTO processed_events (event_id, gateid, event_type)
+        VALUES (p_event_id, p_gate, 'vehicle_in')
+        ON CONFLICT (event_id) DO NOTHING;
+    END IF;
+
+    RETURN jsonb_build_object('code', 'ok', 'slot', p_slot, 'time_in', v_now);
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION vehicle_out_event(
+    p_plate    TEXT,
+    p_gate     TEXT,
+    p_img_out  TEXT,
+    p_event_id TEXT
+) RETURNS jsonb
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_now     TIMESTAMP := NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh';
+    v_vid     vehicles.id%TYPE;
+    v_slot    vehicles.slotid%TYPE;
+    v_time_in vehicles.time_in%TYPE;
+    v_tx      transactions.trans_id%TYPE;
+    v_tx_gate transactions.gateid%TYPE;
+    v_zone    slots.zone%TYPE;
+    v_minutes INT;
+    v_hours   INT;
+    v_fee     INT;
+BEGIN
+    -- 0) dedup
+    IF p_event_id IS NOT NULL THEN
+        PERFORM 1 FROM processed_events WHERE event_id = p_event_id;
+        IF FOUND THEN
+            RETURN jsonb_build_object('code', 'dedup');
+        END IF;
+    END IF;
+
+    -- 1) xe đang trong bãi
+    SELECT id, slotid, time_in
+    INTO v_vid, v_slot, v_time_in
+    FROM vehicles
+    WHERE plate = p_plate AND time_out IS NULL
+    ORDER BY time_in DESC
+    LIMIT 1
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('code', 'not_found', 'what', 'vehicle');
+    END IF;
+
+    -- 2) transaction đang mở
+    SELECT trans_id, gateid
+    INTO v_tx, v_tx_gate
+    FROM transactions
+    WHERE plate = p_plate AND time_out IS NULL
+    ORDER BY time_in DESC
+    LIMIT 1
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('code', 'not_found', 'what', 'transaction');
+    END IF;
+
+    -- 3) tính phí (giữ khớp calc_fee() trong gates_api.py)
+    v_minutes := floor(extract(epoch FROM (v_now - v_time_in)) / 60)::int;
+    v_hours := v_minutes / 60 + CASE WHEN v_minutes % 60 > 0 THEN 1 ELSE 0 END;
+    v_fee := CASE WHEN v_hours <= 1 THEN 5000 ELSE 5000 + (v_hours - 1) * 3000 END;
+
+    -- 4) ghi
+    UPDATE slots
+    SET occupied = false, plate = NULL, version = version + 1
+    WHERE slotid = v_slot
+    RETURNING zone INTO v_zone;
+
+    UPDATE vehicles SET time_out = v_now WHERE id = v_vid;
+
+    UPDATE transactions
+    SET time_out = v_now,
+        duration_minutes = v_minutes,
+        fee = v_fee,
+        img_out = p_img_out
+    WHERE trans_id = v_tx;
+
+    -- rollup: exits/doanh thu tính cho gate vào của transaction (giống /stats)
+    PERFORM stats_rollup_add(v_now, v_tx_gate, v_zone, 0, 1, v_fee, v_minutes);
+
+    IF p_event_id IS NOT NULL THEN
+        INSERT INTO processed_events (event_id, gateid, event_type)
+        VALUES (p_event_id, p_gate, 'vehicle_out')
+        ON CONFLICT (event_id) DO NOTHING;
+    END IF;
+
+    RETURN jsonb_build_object(
+        'code', 'ok',
+        'slot', v_slot,
+        'fee', v_fee,
+        'duration_minutes', v_minutes
+    );
+END;
+$$;
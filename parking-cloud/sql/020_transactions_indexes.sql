@@ -0,0 +1,21 @@
+-- ==========================================================
+-- Index cho GET /transactions (keyset: time_in DESC, trans_id DESC)
+-- Mỗi filter có index cùng thứ tự sort => mỗi trang O(page size)
+-- ==========================================================
+
+-- không filter / lọc theo ngày / closed
+CREATE INDEX IF NOT EXISTS idx_transactions_time_in
+    ON transactions (time_in DESC, trans_id DESC);
+
+-- lọc theo gate (+ ngày)
+CREATE INDEX IF NOT EXISTS idx_transactions_gate_time_in
+    ON transactions (gateid, time_in DESC, trans_id DESC);
+
+-- lọc theo biển số (+ ngày)
+CREATE INDEX IF NOT EXISTS idx_transactions_plate_time_in
+    ON transactions (plate, time_in DESC, trans_id DESC);
+
+-- status=open (xe đang trong bãi)
+CREATE INDEX IF NOT EXISTS idx_transactions_open_time_in
+    ON transactions (time_in DESC, trans_id DESC)
+    WHERE time_out IS NULL;
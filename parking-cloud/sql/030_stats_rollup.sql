@@ -0,0 +1,109 @@
+-- ==========================================================
+-- ROLLUP THỐNG KÊ (giờ / ngày × gate × zone)
+-- - Cập nhật tăng dần trong vehicle_in_event / vehicle_out_event
+-- - /stats + báo cáo đọc từ đây => chi phí O(số ngày), không O(số giao dịch)
+-- - entries theo time_in; exits / revenue / dwell theo time_out (giống /stats)
+-- - Backfill dữ liệu cũ: python rollup.py backfill [--from YYYY-MM-DD] [--to YYYY-MM-DD]
+-- ==========================================================
+
+CREATE TABLE IF NOT EXISTS stats_hourly (
+    bucket        TIMESTAMP   NOT NULL,              -- date_trunc('hour', giờ VN)
+    gateid        VARCHAR(20) NOT NULL DEFAULT '',
+    zone          VARCHAR(1)  NOT NULL DEFAULT '',
+    entries       INT         NOT NULL DEFAULT 0,
+    exits         INT         NOT NULL DEFAULT 0,
+    revenue       BIGINT      NOT NULL DEFAULT 0,
+    dwell_minutes BIGINT      NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, gateid, zone)
+);
+
+CREATE TABLE IF NOT EXISTS stats_daily (
+    day           DATE        NOT NULL,
+    gateid        VARCHAR(20) NOT NULL DEFAULT '',
+    zone          VARCHAR(1)  NOT NULL DEFAULT '',
+    entries       INT         NOT NULL DEFAULT 0,
+    exits         INT         NOT NULL DEFAULT 0,
+    revenue       BIGINT      NOT NULL DEFAULT 0,
+    dwell_minutes BIGINT      NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, gateid, zone)
+);
+
+
+CREATE OR REPLACE FUNCTION stats_rollup_add(
+    p_ts      TIMESTAMP,
+    p_gate    TEXT,
+    p_zone    TEXT,
+    p_entries INT,
+    p_exits   INT,
+    p_revenue BIGINT,
+    p_dwell   BIGINT
+) RETURNS void
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO stats_hourly AS h (bucket, gateid, zone, entries, exits, revenue, dwell_minutes)
+    VALUES (date_trunc('hour', p_ts), COALESCE(p_gate, ''), COALESCE(p_zone, ''),
+            p_entries, p_exits, p_revenue, p_dwell)
+    ON CONFLICT (bucket, gateid, zone) DO UPDATE
+    SET entries       = h.entries + EXCLUDED.entries,
+        exits         = h.exits + EXCLUDED.exits,
+        revenue       = h.revenue + EXCLUDED.revenue,
+        dwell_minutes = h.dwell_minutes + EXCLUDED.dwell_minutes;
+
+    INSERT INTO stats_daily AS d (day, gateid, zone, entries, exits, revenue, dwell_minutes)
+    VALUES (p_ts::date, COALESCE(p_gate, ''), COALESCE(p_zone, ''),
+            p_entries, p_exits, p_revenue, p_dwell)
+    ON CONFLICT (day, gateid, zone) DO UPDATE
+    SET entries       = d.entries + EXCLUDED.entries,
+        exits         = d.exits + EXCLUDED.exits,
+        revenue       = d.revenue + EXCLUDED.revenue,
+        dwell_minutes = d.dwell_minutes + EXCLUDED.dwell_minutes;
+END;
+$$;
+
+
+-- Tính lại rollup từ transactions cho khoảng [p_from, p_to) (NULL = không giới hạn)
+CREATE OR REPLACE FUNCTION stats_rollup_backfill(
+    p_from DATE,
+    p_to   DATE
+) RETURNS bigint
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_rows bigint;
+BEGIN
+    -- chặn upsert live trong lúc tính lại (giao dịch đang chạy sẽ cộng sau khi commit)
+    LOCK TABLE stats_hourly, stats_daily IN EXCLUSIVE MODE;
+
+    DELETE FROM stats_hourly
+    WHERE (p_from IS NULL OR bucket >= p_from) AND (p_to IS NULL OR bucket < p_to);
+    DELETE FROM stats_daily
+    WHERE (p_from IS NULL OR day >= p_from) AND (p_to IS NULL OR day < p_to);
+
+    CREATE TEMP TABLE _rollup_ev ON COMMIT DROP AS
+    SELECT t.time_in AS ts, COALESCE(t.gateid, '') AS gateid, COALESCE(s.zone, '') AS zone,
+           1 AS entries, 0 AS exits, 0::bigint AS revenue, 0::bigint AS dwell
+    FROM transactions t
+    LEFT JOIN slots s ON s.slotid = t.slotid
+    WHERE t.time_in IS NOT NULL
+      AND (p_from IS NULL OR t.time_in >= p_from) AND (p_to IS NULL OR t.time_in < p_to)
+    UNION ALL
+    SELECT t.time_out, COALESCE(t.gateid, ''), COALESCE(s.zone, ''),
+           0, 1, COALESCE(t.fee, 0)::bigint, COALESCE(t.duration_minutes, 0)::bigint
+    FROM transactions t
+    LEFT JOIN slots s ON s.slotid = t.slotid
+    WHERE t.time_out IS NOT NULL
+      AND (p_from IS NULL OR t.time_out >= p_from) AND (p_to IS NULL OR t.time_out < p_to);
+
+    INSERT INTO stats_hourly (bucket, gateid, zone, entries, exits, revenue, dwell_minutes)
+    SELECT date_trunc('hour', ts), gateid, zone, SUM(entries), SUM(exits), SUM(revenue), SUM(dwell)
+    FROM _rollup_ev
+    GROUP BY 1, 2, 3;
+
+    INSERT INTO stats_daily (day, gateid, zone, entries, exits, revenue, dwell_minutes)
+    SELECT ts::date, gateid, zone, SUM(entries), SUM(exits), SUM(revenue), SUM(dwell)
+    FROM _rollup_ev
+    GROUP BY 1, 2, 3;
+
+    SELECT count(*) INTO v_rows FROM _rollup_ev;
+    RETURN v_rows;
+END;
+$$;
@@ -0,0 +1,94 @@
+-- ==========================================================
+-- CHANGE FEED CHO SLOTS (/slots/changes?since=<seq>)
+-- - Mỗi lần INSERT/UPDATE slot: trigger gán change_seq = nextval(slot_change_seq)
+-- - DELETE slot: ghi tombstone (slotid, change_seq) để gate xóa bản local
+-- - Tombstone cũ bị prune -> slot_change_floor.floor_seq tăng;
+--   gate có since < floor_seq phải tải lại toàn bộ /slots/map
+-- ==========================================================
+
+CREATE SEQUENCE IF NOT EXISTS slot_change_seq;
+
+ALTER TABLE slots ADD COLUMN IF NOT EXISTS change_seq BIGINT;
+
+CREATE TABLE IF NOT EXISTS slot_tombstones (
+    slotid     VARCHAR(20) PRIMARY KEY,
+    change_seq BIGINT    NOT NULL,
+    deleted_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh')
+);
+
+CREATE TABLE IF NOT EXISTS slot_change_floor (
+    id        INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    floor_seq BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO slot_change_floor(id, floor_seq) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;
+
+CREATE INDEX IF NOT EXISTS idx_slots_change_seq ON slots (change_seq);
+CREATE INDEX IF NOT EXISTS idx_slot_tombstones_change_seq ON slot_tombstones (change_seq);
+
+
+CREATE OR REPLACE FUNCTION slots_bump_change_seq() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    -- UPDATE không đổi gì thì không tính là thay đổi
+    IF TG_OP = 'UPDATE' AND NEW IS NOT DISTINCT FROM OLD THEN
+        RETURN NEW;
+    END IF;
+
+    NEW.change_seq := nextval('slot_change_seq');
+
+    IF TG_OP = 'INSERT' THEN
+        DELETE FROM slot_tombstones WHERE slotid = NEW.slotid;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION slots_record_tombstone() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO slot_tombstones(slotid, change_seq)
+    VALUES (OLD.slotid, nextval('slot_change_seq'))
+    ON CONFLICT (slotid) DO UPDATE
+        SET change_seq = EXCLUDED.change_seq,
+            deleted_at = EXCLUDED.deleted_at;
+    RETURN OLD;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_slots_change_seq ON slots;
+CREATE TRIGGER trg_slots_change_seq
+    BEFORE INSERT OR UPDATE ON slots
+    FOR EACH ROW EXECUTE FUNCTION slots_bump_change_seq();
+
+DROP TRIGGER IF EXISTS trg_slots_tombstone ON slots;
+CREATE TRIGGER trg_slots_tombstone
+    AFTER DELETE ON slots
+    FOR EACH ROW EXECUTE FUNCTION slots_record_tombstone();
+
+-- slot có sẵn trước khi có trigger
+UPDATE slots SET change_seq = nextval('slot_change_seq') WHERE change_seq IS NULL;
+
+
+-- Xóa tombstone cũ hơn p_keep, nâng floor_seq tương ứng. Trả về số tombstone đã xóa.
+CREATE OR REPLACE FUNCTION slot_tombstones_prune(p_keep INTERVAL)
+RETURNS bigint
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_max_seq BIGINT;
+    v_n       BIGINT;
+BEGIN
+    WITH gone AS (
+        DELETE FROM slot_tombstones
+        WHERE deleted_at < (NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh') - p_keep
+        RETURNING change_seq
+    )
+    SELECT MAX(change_seq), COUNT(*) INTO v_max_seq, v_n FROM gone;
+
+    IF v_max_seq IS NOT NULL THEN
+        UPDATE slot_change_floor
+        SET floor_seq = GREATEST(floor_seq, v_max_seq)
+        WHERE id = 1;
+    END IF;
+    RETURN v_n;
+END;
+$$;
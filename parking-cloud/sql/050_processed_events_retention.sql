@@ -0,0 +1,34 @@
+-- ==========================================================
+-- processed_events: GIỮ CÓ THỜI HẠN
+-- - Tầng 1 dedup là key Redis dedup:{event_id} (dedup.py), bảng này là tầng 2
+-- - Index created_at để xóa theo tuổi không phải quét cả bảng
+-- - processed_events_prune(): xóa 1 lô mỗi lần gọi (transaction ngắn),
+--   dedup.py gọi lặp tới khi hết; advisory lock => chỉ 1 worker xóa cùng lúc
+-- ==========================================================
+
+CREATE INDEX IF NOT EXISTS idx_processed_events_created_at
+    ON processed_events (created_at);
+
+
+CREATE OR REPLACE FUNCTION processed_events_prune(p_keep INTERVAL, p_batch INT)
+RETURNS bigint
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_n BIGINT;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('processed_events_prune')) THEN
+        RETURN 0;
+    END IF;
+
+    -- created_at mặc định NOW() (giờ session) => so với NOW() cùng kiểu
+    DELETE FROM processed_events
+    WHERE ctid = ANY (ARRAY(
+        SELECT ctid FROM processed_events
+        WHERE created_at < (NOW() - p_keep)::timestamp
+        ORDER BY created_at
+        LIMIT p_batch
+    ));
+    GET DIAGNOSTICS v_n = ROW_COUNT;
+    RETURN v_n;
+END;
+$$;
@@ -0,0 +1,33 @@
+-- ==========================================================
+-- Index cho các đường truy cập nóng (query_plans.py EXPLAIN kiểm tra)
+-- - partial WHERE time_out IS NULL: chỉ chứa xe đang trong bãi => nhỏ, không phình theo lịch sử
+-- - INCLUDE: đủ cột cho query => index-only scan khi visibility map sạch
+-- - transactions ORDER BY time_in DESC: đã có idx_transactions_time_in (020)
+-- ==========================================================
+
+-- vehicle_in_event (xe đã trong bãi?) + vehicle_out_event (xe đang trong bãi, mới nhất)
+CREATE INDEX IF NOT EXISTS idx_vehicles_open_plate
+    ON vehicles (plate, time_in DESC)
+    INCLUDE (id, slotid)
+    WHERE time_out IS NULL;
+
+-- /slot_info/{slotid}: xe đang đậu ở slot
+CREATE INDEX IF NOT EXISTS idx_vehicles_open_slot
+    ON vehicles (slotid, time_in DESC)
+    WHERE time_out IS NULL;
+
+-- vehicle_out_event + /fee: transaction đang mở theo biển số
+CREATE INDEX IF NOT EXISTS idx_transactions_open_plate
+    ON transactions (plate, time_in DESC)
+    INCLUDE (trans_id, gateid, slotid)
+    WHERE time_out IS NULL;
+
+-- slot trống (SlotIndex / free pool rebuild lọc occupied)
+CREATE INDEX IF NOT EXISTS idx_slots_free
+    ON slots (slotid)
+    INCLUDE (x, y)
+    WHERE occupied IS NOT TRUE;
+
+ANALYZE vehicles;
+ANALYZE transactions;
+ANALYZE slots;
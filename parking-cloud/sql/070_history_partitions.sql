@@ -0,0 +1,162 @@
+-- ==========================================================
+-- transactions / vehicles: PARTITION THEO THÁNG (RANGE time_in, giờ VN)
+-- - history_partition_table(): chuyển bảng thường -> partitioned tại chỗ
+--     bảng cũ đổi tên <t>_legacy và gắn làm partition (MINVALUE -> đầu tháng hiện tại)
+--     => không copy lịch sử, chỉ chuyển dòng từ đầu tháng này / time_in NULL
+-- - <t>_pYYYYMM: 1 partition / tháng; <t>_default: time_in NULL hoặc tháng chưa tạo
+-- - history_ensure_partitions(): tạo trước p_ahead tháng (partitions.py gọi định kỳ)
+-- - Bảng cha không có PRIMARY KEY (PK phải chứa time_in, mà time_in có thể NULL);
+--   id / trans_id vẫn lấy từ sequence SERIAL cũ (OWNED BY chuyển sang bảng cha)
+-- - Lưu trữ partition cũ: python partitions.py archive (COPY gzip -> detach -> drop)
+-- ==========================================================
+
+CREATE OR REPLACE FUNCTION history_month_start(p_ts TIMESTAMP) RETURNS DATE
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT date_trunc('month', p_ts)::date
+$$;
+
+
+CREATE OR REPLACE FUNCTION history_is_partitioned(p_table TEXT) RETURNS BOOLEAN
+LANGUAGE sql STABLE AS $$
+    SELECT EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass(p_table) AND relkind = 'p')
+$$;
+
+
+-- partition của bảng: (tên, cận dưới, cận trên, default?) — MINVALUE => lo NULL
+CREATE OR REPLACE FUNCTION history_partitions(p_table TEXT)
+RETURNS TABLE (name TEXT, lo TIMESTAMP, hi TIMESTAMP, is_default BOOLEAN)
+LANGUAGE sql STABLE AS $$
+    SELECT c.relname::text,
+           substring(b.expr FROM 'FROM \(''([^'']+)''\)')::timestamp,
+           substring(b.expr FROM 'TO \(''([^'']+)''\)')::timestamp,
+           b.expr = 'DEFAULT'
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    CROSS JOIN LATERAL (SELECT pg_get_expr(c.relpartbound, c.oid) AS expr) b
+    WHERE i.inhparent = to_regclass(p_table)
+    ORDER BY 3 NULLS LAST
+$$;
+
+
+CREATE OR REPLACE FUNCTION history_add_partition(p_table TEXT, p_month DATE) RETURNS BOOLEAN
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_name TEXT := format('%s_p%s', p_table, to_char(p_month, 'YYYYMM'));
+    v_lo   TIMESTAMP := p_month::timestamp;
+    v_hi   TIMESTAMP := (p_month + INTERVAL '1 month')::timestamp;
+BEGIN
+    IF to_regclass(v_name) IS NOT NULL THEN
+        RETURN FALSE;
+    END IF;
+
+    -- dòng tháng này đã rơi vào default (lúc ghi chưa có partition) -> chuyển sang rồi mới attach
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS)', v_name, p_table);
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM %I WHERE time_in >= $1 AND time_in < $2 RETURNING *) '
+        'INSERT INTO %I SELECT * FROM moved',
+        p_table || '_default', v_name
+    ) USING v_lo, v_hi;
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   p_table, v_name, v_lo, v_hi);
+    RETURN TRUE;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION history_ensure_partitions(p_table TEXT, p_ahead INT) RETURNS INT
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_now   DATE := history_month_start((NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh')::timestamp);
+    v_month DATE;
+    v_n     INT := 0;
+BEGIN
+    IF NOT history_is_partitioned(p_table) THEN
+        RETURN 0;
+    END IF;
+
+    -- tháng bị bỏ lỡ (server tắt lâu hơn p_ahead tháng) đang nằm ở default
+    EXECUTE format('SELECT history_month_start(min(time_in)) FROM %I', p_table || '_default')
+        INTO v_month;
+    v_month := LEAST(COALESCE(v_month, v_now), v_now);
+
+    WHILE v_month <= v_now + make_interval(months => p_ahead) LOOP
+        IF history_add_partition(p_table, v_month) THEN
+            v_n := v_n + 1;
+        END IF;
+        v_month := (v_month + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN v_n;
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION history_partition_table(p_table TEXT, p_ahead INT) RETURNS BOOLEAN
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_legacy TEXT := p_table || '_legacy';
+    v_cut    TIMESTAMP := history_month_start((NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh')::timestamp)::timestamp;
+    v_defs   TEXT[] := '{}';
+    v_def    TEXT;
+    r        RECORD;
+BEGIN
+    IF to_regclass(p_table) IS NULL OR history_is_partitioned(p_table) THEN
+        RETURN FALSE;
+    END IF;
+
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', p_table, v_legacy);
+
+    -- index thường (020, 060...): đổi tên bản cũ, dựng lại trên bảng cha cùng tên
+    -- (PK / UNIQUE không dựng được trên bảng cha vì thiếu time_in -> chỉ còn ở partition cũ)
+    FOR r IN
+        SELECT c.relname, pg_get_indexdef(i.indexrelid) AS def
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = to_regclass(v_legacy)
+          AND NOT i.indisunique
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = i.indexrelid)
+    LOOP
+        v_defs := v_defs || regexp_replace(
+            r.def, ' ON (ONLY )?(\S+\.)?' || v_legacy || ' ', ' ON \2' || p_table || ' '
+        );
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', r.relname, left(r.relname, 48) || '_legacy');
+    END LOOP;
+
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS) PARTITION BY RANGE (time_in)',
+                   p_table, v_legacy);
+
+    -- sequence SERIAL thuộc về bảng cha: drop partition cũ không kéo theo sequence
+    FOR r IN
+        SELECT a.attname, pg_get_serial_sequence(v_legacy, a.attname) AS seq
+        FROM pg_attribute a
+        WHERE a.attrelid = to_regclass(v_legacy) AND a.attnum > 0 AND NOT a.attisdropped
+    LOOP
+        IF r.seq IS NOT NULL THEN
+            EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.%I', r.seq, p_table, r.attname);
+        END IF;
+    END LOOP;
+
+    EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', p_table || '_default', p_table);
+    PERFORM history_ensure_partitions(p_table, p_ahead);
+
+    -- phần "nóng" (từ đầu tháng này / time_in NULL) sang partition mới, phần còn lại gắn nguyên
+    EXECUTE format('INSERT INTO %I SELECT * FROM %I WHERE time_in IS NULL OR time_in >= $1',
+                   p_table, v_legacy) USING v_cut;
+    EXECUTE format('DELETE FROM %I WHERE time_in IS NULL OR time_in >= $1', v_legacy) USING v_cut;
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (MINVALUE) TO (%L)',
+                   p_table, v_legacy, v_cut);
+
+    -- index tương đương trên partition cũ được gắn lại, không build lại
+    FOREACH v_def IN ARRAY v_defs LOOP
+        EXECUTE v_def;
+    END LOOP;
+    RETURN TRUE;
+END;
+$$;
+
+
+SELECT history_partition_table('transactions', 3);
+SELECT history_partition_table('vehicles', 3);
+
+-- UPDATE ... WHERE id / trans_id (vehicle_out_event): thay cho PK của bảng cũ
+CREATE INDEX IF NOT EXISTS idx_vehicles_id ON vehicles (id);
+CREATE INDEX IF NOT EXISTS idx_transactions_trans_id ON transactions (trans_id);
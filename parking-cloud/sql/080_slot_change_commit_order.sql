@@ -0,0 +1,64 @@
+-- ==========================================================
+-- CHANGE FEED SLOTS: change_seq THEO THỨ TỰ COMMIT
+-- - Trước đây change_seq = nextval(slot_change_seq) lúc ghi: A lấy 10, B lấy 11,
+--   B commit trước => gate poll giữa chừng nhận 11, A (10) hiện ra sau và bị bỏ sót
+-- - Nay lấy seq từ 1 dòng đếm duy nhất (slot_change_head) bằng UPDATE ... RETURNING:
+--   khóa dòng giữ tới khi commit => transaction sau phải chờ transaction trước commit
+--   mới lấy được seq => seq lớn hơn luôn commit sau, mọi seq <= head đã nhìn thấy được
+-- - Đổi lại: các transaction ghi slot xếp hàng ở bước lấy seq (chỉ phần còn lại
+--   của transaction đó: vehicle_in_event / vehicle_out_event sau UPDATE slots)
+-- - /slots/changes đọc head từ bảng này (không đọc last_value của sequence,
+--   vốn tính cả giá trị của transaction chưa commit)
+-- ==========================================================
+
+CREATE TABLE IF NOT EXISTS slot_change_head (
+    id  INT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    seq BIGINT NOT NULL DEFAULT 0
+);
+
+-- tiếp nối seq đã cấp bởi slot_change_seq (040)
+INSERT INTO slot_change_head (id, seq)
+SELECT 1, GREATEST(
+    (SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM slot_change_seq),
+    (SELECT COALESCE(MAX(change_seq), 0) FROM slots),
+    (SELECT COALESCE(MAX(change_seq), 0) FROM slot_tombstones)
+)
+ON CONFLICT (id) DO NOTHING;
+
+
+CREATE OR REPLACE FUNCTION slot_change_next() RETURNS BIGINT
+LANGUAGE sql AS $$
+    UPDATE slot_change_head SET seq = seq + 1 WHERE id = 1 RETURNING seq
+$$;
+
+
+CREATE OR REPLACE FUNCTION slots_bump_change_seq() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    -- UPDATE không đổi gì thì không tính là thay đổi
+    IF TG_OP = 'UPDATE' AND NEW IS NOT DISTINCT FROM OLD THEN
+        RETURN NEW;
+    END IF;
+
+    NEW.change_seq := slot_change_next();
+
+    IF TG_OP = 'INSERT' THEN
+        DELETE FROM slot_tombstones WHERE slotid = NEW.slotid;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION slots_record_tombstone() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO slot_tombstones(slotid, change_seq)
+    VALUES (OLD.slotid, slot_change_next())
+    ON CONFLICT (slotid) DO UPDATE
+        SET change_seq = EXCLUDED.change_seq,
+            deleted_at = EXCLUDED.deleted_at;
+    RETURN OLD;
+END;
+$$;
+
+DROP SEQUENCE IF EXISTS slot_change_seq;
@@ -0,0 +1,8 @@
+-- ==========================================================
+-- Bỏ idx_slots_free (060): không query nào lọc slot trống theo occupied
+-- - load_slot_index / rebuild_free_pool đọc TOÀN BỘ slots (không WHERE)
+-- - UPDATE ... WHERE slotid = ? AND occupied IS NOT TRUE (vehicle_in_event) đi theo unique slotid
+-- => index chỉ tốn công ghi mỗi lần xe vào / ra
+-- ==========================================================
+
+DROP INDEX IF EXISTS idx_slots_free;
@@ -0,0 +1,34 @@
+-- ==========================================================
+-- history_ensure_partitions: khóa advisory trong transaction
+-- - Mọi worker uvicorn đều chạy partitions.maintenance_loop(); 2 worker khởi động cùng lúc
+--   cùng thấy to_regclass(...) IS NULL rồi cùng CREATE TABLE => 1 worker lỗi
+-- - Worker sau chờ khóa, vào tới nơi thì partition đã có => không tạo gì, không lỗi
+-- ==========================================================
+
+CREATE OR REPLACE FUNCTION history_ensure_partitions(p_table TEXT, p_ahead INT) RETURNS INT
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_now   DATE := history_month_start((NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh')::timestamp);
+    v_month DATE;
+    v_n     INT := 0;
+BEGIN
+    IF NOT history_is_partitioned(p_table) THEN
+        RETURN 0;
+    END IF;
+
+    PERFORM pg_advisory_xact_lock(hashtext('history_partitions:' || p_table));
+
+    -- tháng bị bỏ lỡ (server tắt lâu hơn p_ahead tháng) đang nằm ở default
+    EXECUTE format('SELECT history_month_start(min(time_in)) FROM %I', p_table || '_default')
+        INTO v_month;
+    v_month := LEAST(COALESCE(v_month, v_now), v_now);
+
+    WHILE v_month <= v_now + make_interval(months => p_ahead) LOOP
+        IF history_add_partition(p_table, v_month) THEN
+            v_n := v_n + 1;
+        END IF;
+        v_month := (v_month + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN v_n;
+END;
+$$;
@@ -0,0 +1,53 @@
+-- ==========================================================
+-- transactions / vehicles (đã partition ở 070): KHÔI PHỤC PRIMARY KEY
+-- - PK trên bảng partition phải chứa khóa partition => (id, time_in) / (trans_id, time_in)
+-- - time_in NULL (dữ liệu cũ): điền từ created_at / time_out, không có thì 1970-01-01
+--   (dòng tự chuyển từ partition default sang đúng partition), rồi NOT NULL + DEFAULT giờ VN
+-- - id / trans_id lấy từ sequence nên PK (id, time_in) giữ được tính duy nhất thực tế;
+--   keyset /transactions (time_in, trans_id) và vehicle_out_event dựa vào điều này
+-- - PK phục vụ luôn tra cứu theo id / trans_id => bỏ index thường của 070
+-- - <t>_legacy (070) còn PK 1 cột cũ (vehicles_pkey / transactions_pkey): 1 bảng chỉ có 1 PK
+--   => bỏ PK đó trước, PK của bảng cha tự dựng index (id, time_in) trên mọi partition
+-- ==========================================================
+
+UPDATE vehicles
+SET time_in = COALESCE(created_at, time_out, TIMESTAMP '1970-01-01')
+WHERE time_in IS NULL;
+
+UPDATE transactions
+SET time_in = COALESCE(time_out, TIMESTAMP '1970-01-01')
+WHERE time_in IS NULL;
+
+ALTER TABLE vehicles ALTER COLUMN time_in SET DEFAULT (NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh');
+ALTER TABLE vehicles ALTER COLUMN time_in SET NOT NULL;
+ALTER TABLE transactions ALTER COLUMN time_in SET DEFAULT (NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh');
+ALTER TABLE transactions ALTER COLUMN time_in SET NOT NULL;
+
+DO $$
+DECLARE
+    r RECORD;
+BEGIN
+    FOR r IN
+        SELECT k.conrelid::regclass AS part, k.conname
+        FROM pg_constraint k
+        JOIN pg_inherits i ON i.inhrelid = k.conrelid
+        WHERE i.inhparent IN ('vehicles'::regclass, 'transactions'::regclass)
+          AND k.contype = 'p'
+          AND k.conparentid = 0
+    LOOP
+        EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', r.part, r.conname);
+    END LOOP;
+
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid = 'vehicles'::regclass AND contype = 'p') THEN
+        ALTER TABLE vehicles ADD CONSTRAINT vehicles_pkey_part PRIMARY KEY (id, time_in);
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                   WHERE conrelid = 'transactions'::regclass AND contype = 'p') THEN
+        ALTER TABLE transactions ADD CONSTRAINT transactions_pkey_part PRIMARY KEY (trans_id, time_in);
+    END IF;
+END;
+$$;
+
+DROP INDEX IF EXISTS idx_vehicles_id;
+DROP INDEX IF EXISTS idx_transactions_trans_id;
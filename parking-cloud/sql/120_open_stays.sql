@@ -0,0 +1,218 @@
+-- ==========================================================
+-- open_stays: BẢNG NÓNG CHO XE ĐANG TRONG BÃI
+-- - vehicles / transactions partition theo time_in (070), nhưng tra cứu nóng lọc theo
+--   plate / slotid + time_out IS NULL, không có time_in => không prune, dò index MỌI partition
+-- - open_stays: 1 dòng / xe đang trong bãi (plate PK), giữ (id, time_in) của vehicle và transaction
+--   => vehicle_in/out_event, /fee, /slot_info tra ở đây (bảng nhỏ, không phình theo lịch sử),
+--      rồi đụng vehicles / transactions bằng PK (id, time_in) => chỉ 1 partition
+-- - vehicle_in_event chèn open_stays TRƯỚC khi ghi gì khác: plate PK chặn luôn 2 gate
+--   cho cùng 1 xe vào đồng thời (trước đây PERFORM ... rồi INSERT có khe hở)
+-- - Index open-plate / open-slot của 060 không còn query nào dùng => bỏ
+-- ==========================================================
+
+DO $$
+DECLARE
+    v_trans_type TEXT;
+BEGIN
+    SELECT format_type(atttypid, atttypmod) INTO v_trans_type
+    FROM pg_attribute
+    WHERE attrelid = 'transactions'::regclass AND attname = 'trans_id';
+
+    EXECUTE format($f$
+        CREATE TABLE IF NOT EXISTS open_stays (
+            plate           VARCHAR(20) PRIMARY KEY,
+            slotid          VARCHAR(20),
+            vehicle_id      INT,
+            vehicle_time_in TIMESTAMP NOT NULL,
+            trans_id        %s,
+            trans_time_in   TIMESTAMP,
+            trans_gate      VARCHAR(20)
+        )
+    $f$, v_trans_type);
+END;
+$$;
+
+CREATE INDEX IF NOT EXISTS idx_open_stays_slot ON open_stays (slotid);
+
+-- xe đang trong bãi lúc nâng cấp (mới nhất theo biển số, giống vehicle_out_event cũ)
+INSERT INTO open_stays (plate, slotid, vehicle_id, vehicle_time_in, trans_id, trans_time_in, trans_gate)
+SELECT v.plate, v.slotid, v.id, v.time_in, t.trans_id, t.time_in, t.gateid
+FROM (
+    SELECT DISTINCT ON (plate) id, plate, slotid, time_in
+    FROM vehicles
+    WHERE time_out IS NULL
+    ORDER BY plate, time_in DESC
+) v
+LEFT JOIN LATERAL (
+    SELECT trans_id, time_in, gateid
+    FROM transactions
+    WHERE plate = v.plate AND time_out IS NULL
+    ORDER BY time_in DESC
+    LIMIT 1
+) t ON TRUE
+ON CONFLICT (plate) DO NOTHING;
+
+
+CREATE OR REPLACE FUNCTION vehicle_in_event(
+    p_plate    TEXT,
+    p_gate     TEXT,
+    p_slot     TEXT,
+    p_img_in   TEXT,
+    p_event_id TEXT
+) RETURNS jsonb
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_now  TIMESTAMP := NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh';
+    v_zone slots.zone%TYPE;
+    v_vid  vehicles.id%TYPE;
+    v_tx   transactions.trans_id%TYPE;
+BEGIN
+    -- 0) dedup: giành event_id TRƯỚC (replay đồng thời chờ unique key rồi thấy trùng);
+    --    kết quả lỗi thì nhả ra (DELETE) => replay nhận lại đúng lỗi, không thành 'dedup'
+    IF p_event_id IS NOT NULL THEN
+        INSERT INTO processed_events (event_id, gateid, event_type)
+        VALUES (p_event_id, p_gate, 'vehicle_in')
+        ON CONFLICT (event_id) DO NOTHING;
+        IF NOT FOUND THEN
+            RETURN jsonb_build_object('code', 'dedup');
+        END IF;
+    END IF;
+
+    -- 1) gate tồn tại?
+    PERFORM 1 FROM gates WHERE gateid = p_gate;
+    IF NOT FOUND THEN
+        DELETE FROM processed_events WHERE event_id = p_event_id;
+        RETURN jsonb_build_object('code', 'not_found', 'what', 'gate');
+    END IF;
+
+    -- 2) xe đã ở trong bãi? giữ chỗ trong open_stays (PK plate => gate khác chờ rồi thấy trùng)
+    INSERT INTO open_stays (plate, slotid, vehicle_time_in, trans_time_in, trans_gate)
+    VALUES (p_plate, p_slot, v_now, v_now, p_gate)
+    ON CONFLICT (plate) DO NOTHING;
+    IF NOT FOUND THEN
+        DELETE FROM processed_events WHERE event_id = p_event_id;
+        RETURN jsonb_build_object('code', 'plate_in_yard');
+    END IF;
+
+    -- 3) chiếm slot có điều kiện (check + update trong 1 câu)
+    UPDATE slots
+    SET occupied = true, plate = p_plate, version = version + 1
+    WHERE slotid = p_slot AND occupied IS NOT TRUE
+    RETURNING zone INTO v_zone;
+
+    IF NOT FOUND THEN
+        DELETE FROM processed_events WHERE event_id = p_event_id;
+        DELETE FROM open_stays WHERE plate = p_plate;
+        PERFORM 1 FROM slots WHERE slotid = p_slot;
+        IF FOUND THEN
+            RETURN jsonb_build_object('code', 'slot_occupied');
+        END IF;
+        RETURN jsonb_build_object('code', 'not_found', 'what', 'slot');
+    END IF;
+
+    -- 4) ghi lịch sử
+    INSERT INTO vehicles (plate, slotid, gateid, source_gate, time_in)
+    VALUES (p_plate, p_slot, p_gate, p_gate, v_now)
+    RETURNING id INTO v_vid;
+
+    INSERT INTO transactions (plate, slotid, gateid, time_in, img_in)
+    VALUES (p_plate, p_slot, p_gate, v_now, p_img_in)
+    RETURNING trans_id INTO v_tx;
+
+    UPDATE open_stays SET vehicle_id = v_vid, trans_id = v_tx WHERE plate = p_plate;
+
+    -- 5) rollup thống kê (sql/030_stats_rollup.sql)
+    PERFORM stats_rollup_add(v_now, p_gate, v_zone, 1, 0, 0, 0);
+
+    RETURN jsonb_build_object('code', 'ok', 'slot', p_slot, 'time_in', v_now);
+END;
+$$;
+
+
+CREATE OR REPLACE FUNCTION vehicle_out_event(
+    p_plate    TEXT,
+    p_gate     TEXT,
+    p_img_out  TEXT,
+    p_event_id TEXT
+) RETURNS jsonb
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_now        TIMESTAMP := NOW() AT TIME ZONE 'Asia/Ho_Chi_Minh';
+    v_vid        vehicles.id%TYPE;
+    v_slot       vehicles.slotid%TYPE;
+    v_time_in    vehicles.time_in%TYPE;
+    v_tx         transactions.trans_id%TYPE;
+    v_tx_time_in transactions.time_in%TYPE;
+    v_tx_gate    transactions.gateid%TYPE;
+    v_zone       slots.zone%TYPE;
+    v_minutes    INT;
+    v_hours      INT;
+    v_fee        INT;
+BEGIN
+    -- 0) dedup: giành event_id TRƯỚC (replay đồng thời chờ unique key rồi thấy trùng);
+    --    kết quả lỗi thì nhả ra (DELETE) => replay nhận lại đúng lỗi, không thành 'dedup'
+    IF p_event_id IS NOT NULL THEN
+        INSERT INTO processed_events (event_id, gateid, event_type)
+        VALUES (p_event_id, p_gate, 'vehicle_out')
+        ON CONFLICT (event_id) DO NOTHING;
+        IF NOT FOUND THEN
+            RETURN jsonb_build_object('code', 'dedup');
+        END IF;
+    END IF;
+
+    -- 1) xe đang trong bãi + transaction đang mở (bảng nóng, không dò partition)
+    SELECT vehicle_id, slotid, vehicle_time_in, trans_id, trans_time_in, trans_gate
+    INTO v_vid, v_slot, v_time_in, v_tx, v_tx_time_in, v_tx_gate
+    FROM open_stays
+    WHERE plate = p_plate
+    FOR UPDATE;
+
+    IF NOT FOUND OR v_vid IS NULL THEN
+        DELETE FROM processed_events WHERE event_id = p_event_id;
+        RETURN jsonb_build_object('code', 'not_found', 'what', 'vehicle');
+    END IF;
+
+    -- 2) transaction đang mở
+    IF v_tx IS NULL THEN
+        DELETE FROM processed_events WHERE event_id = p_event_id;
+        RETURN jsonb_build_object('code', 'not_found', 'what', 'transaction');
+    END IF;
+
+    -- 3) tính phí (giữ khớp calc_fee() trong gates_api.py)
+    v_minutes := floor(extract(epoch FROM (v_now - v_time_in)) / 60)::int;
+    v_hours := v_minutes / 60 + CASE WHEN v_minutes % 60 > 0 THEN 1 ELSE 0 END;
+    v_fee := CASE WHEN v_hours <= 1 THEN 5000 ELSE 5000 + (v_hours - 1) * 3000 END;
+
+    -- 4) ghi (PK (id, time_in) => chỉ đụng 1 partition)
+    UPDATE slots
+    SET occupied = false, plate = NULL, version = version + 1
+    WHERE slotid = v_slot
+    RETURNING zone INTO v_zone;
+
+    UPDATE vehicles SET time_out = v_now WHERE id = v_vid AND time_in = v_time_in;
+
+    UPDATE transactions
+    SET time_out = v_now,
+        duration_minutes = v_minutes,
+        fee = v_fee,
+        img_out = p_img_out
+    WHERE trans_id = v_tx AND time_in = v_tx_time_in;
+
+    DELETE FROM open_stays WHERE plate = p_plate;
+
+    -- rollup: exits/doanh thu tính cho gate vào của transaction (giống /stats)
+    PERFORM stats_rollup_add(v_now, v_tx_gate, v_zone, 0, 1, v_fee, v_minutes);
+
+    RETURN jsonb_build_object(
+        'code', 'ok',
+        'slot', v_slot,
+        'fee', v_fee,
+        'duration_minutes', v_minutes
+    );
+END;
+$$;
+
+
+DROP INDEX IF EXISTS idx_vehicles_open_plate;
+DROP INDEX IF EXISTS idx_vehicles_open_slot;
+DROP INDEX IF EXISTS idx_transactions_open_plate;
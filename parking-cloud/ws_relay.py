@@ -0,0 +1,126 @@
+# ws_relay.py — RELAY EVENT GIỮA CÁC WORKER / HOST QUA REDIS PUB/SUB
+# ==========================================================
+# - Gate chỉ nối WS tới 1 worker; event xử lý ở worker khác phải đi qua Redis
+# - Mọi event publish lên `parking:events` dạng envelope:
+#     {"origin": WORKER_ID, "msg_id": ..., "internal": bool, "event": {...}}
+# - Mỗi worker chạy relay_loop(): bỏ event của chính mình (đã gửi local rồi),
+#   bỏ msg_id đã thấy, còn lại -> on_event (xóa cache) + gửi cho gate đang nối tới worker này
+# - internal=True: chỉ để worker khác cập nhật cache, không gửi xuống gate
+# ==========================================================
+
+import os
+import uuid
+import socket
+import asyncio
+from collections import OrderedDict
+
+import orjson
+import redis.asyncio as aioredis
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+EVENTS_CHANNEL = "parking:events"
+RELAY_DEDUP_SIZE = int(os.getenv("RELAY_DEDUP_SIZE", "4096"))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+_client = None
+
+
+def _redis():
+    global _client
+    if _client is None:
+        _client = aioredis.from_url(REDIS_URL, decode_responses=True)
+    return _client
+
+
+def envelope(event: dict, internal: bool = False) -> str:
+    return orjson.dumps({
+        "origin": WORKER_ID,
+        "msg_id": uuid.uuid4().hex,
+        "internal": internal,
+        "event": event,
+    }).decode()
+
+
+async def publish(event: dict, internal: bool = False) -> None:
+    try:
+        await _redis().publish(EVENTS_CHANNEL, envelope(event, internal))
+    except Exception:
+        pass
+
+
+class SeenIds:
+    """LRU msg_id đã relay (Redis có thể giao lại khi reconnect / publish trùng)."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._ids = OrderedDict()
+
+    def check_add(self, msg_id) -> bool:
+        """True nếu đã thấy msg_id."""
+        if not msg_id:
+            return False
+        if msg_id in self._ids:
+            self._ids.move_to_end(msg_id)
+            return True
+        self._ids[msg_id] = None
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+        return False
+
+
+RELAY_STATS = {"received": 0, "relayed": 0, "own": 0, "dup": 0, "errors": 0}
+
+
+async def relay_loop(deliver, on_event=None):
+    """
+    deliver(event): async, gửi event cho các gate nối tới worker này.
+    on_event(event, internal): sync, cập nhật cache local (SLOT_MAP, SLOT_INDEX...).
+    Tự subscribe lại khi mất kết nối Redis.
+    """
+    seen = SeenIds(RELAY_DEDUP_SIZE)
+    while True:
+        pubsub = _redis().pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(EVENTS_CHANNEL)
+            async for msg in pubsub.listen():
+                RELAY_STATS["received"] += 1
+                try:
+                    env = orjson.loads(msg["data"])
+                except Exception:
+                    continue
+                if not isinstance(env, dict):
+                    continue
+
+                if "event" not in env:
+                    # publish từ nơi khác không có envelope -> coi như event thường
+                    env = {"event": env}
+                if env.get("origin") == WORKER_ID:
+                    RELAY_STATS["own"] += 1
+                    continue
+                if seen.check_add(env.get("msg_id")):
+                    RELAY_STATS["dup"] += 1
+                    continue
+
+                event = env["event"]
+                internal = bool(env.get("internal"))
+                if on_event:
+                    try:
+                        on_event(event, internal)
+                    except Exception as e:
+                        print("[relay] on_event error:", e)
+                if not internal:
+                    await deliver(event)
+                RELAY_STATS["relayed"] += 1
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            RELAY_STATS["errors"] += 1
+            print("[relay] pubsub error, resubscribe in 1s:", e)
+            await asyncio.sleep(1)
+        finally:
+            try:
+                await pubsub.close()
+            except Exception:
+                pass